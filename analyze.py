@@ -0,0 +1,411 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from array import array
+from collections import deque
+
+import pygame
+
+from main import (ACC, FRIC, GRAV, JUMP, JUMP_MIN, JUMP_WINDOW, MAX_FALL_SPEED, SCREEN_WIDTH, SCREEN_HEIGHT,
+                  ANIMATIONS, TILE_SIZE, FINAL_COINS, image_mask, load_image, load_stage, open_levels)
+
+# Define search resolution, states closer than this are treated as the same state
+POSITION_STEP = 8                           # Pixels
+VELOCITY_STEP = 2                           # Pixels per frame
+INPUT_FRAMES = 4                            # Frames each input is held for, keys change at most this often
+FALL_MARGIN = 64                            # Pixels below the stage after which a falling player is lost
+
+# Define where results are kept between runs, so only edited levels are searched again
+CACHE_PATH = "res/levels/reachability.cache"
+CACHE_VERSION = 2
+
+# Define what the search records when the player touches it
+ITEMS = ("coins", "keys", "skeys", "respawns", "exits")
+
+# Define outcomes of one simulated frame
+ALIVE = 0
+DEAD = 1
+EXITED = 2
+
+# Define key events the player can send in a frame
+NO_EVENT = 0
+JUMP_EVENT = 1
+CANCEL_EVENT = 2
+
+
+# Define collision table flags, one byte per player position
+OBSTACLE = 1
+HAZARD = 2
+LOCK = 4
+SPIKE = 8
+SLOW = 16
+EXIT = 32
+ITEM = 64
+FLOAT = 128
+
+
+levels = None                               # Campaign the levels come from, opened once per process
+
+
+def level_source():
+    global levels
+    if levels is None:
+        levels = open_levels(loose=True)    # The files being edited rather than a pack built from them
+    return levels
+
+
+def play_route():
+    # Stages in the order their exits lead through them, special stages are only reached through doors
+    route = []
+    stage = level_source().start
+    while stage is not None and stage not in route:
+        route.append(stage)
+        stage = level_source().info(stage)["exit"]
+    return route
+
+
+def hazard_mask(obj):
+    # Frames swap on a clock the search does not follow, so a hazard is wherever any of its frames has pixels
+    mask = image_mask(obj.image).copy()
+    animation = getattr(obj, "animation", None)
+    for filename in ANIMATIONS[animation].frames if animation else ():
+        mask.draw(image_mask(load_image(filename)), (0, 0))
+    return mask
+
+
+# Everything about a level the physics can touch, read through the game's own loader so the sprites match
+class Level:
+    def __init__(self, number):
+        self.number = number
+        arrays = {name: [] for name in ("obstacles", "hazards", "exits", "coins", "respawns", "spikes", "slow",
+                                        "decorative", "locks", "lockleafs", "keys", "skeys", "sdoors",
+                                        "tombstones", "chests", "returns", "floats", "rings", "swords",
+                                        "fdoors")}
+        key_coins = level_source().info(number)["key_coins"]     # Enough coins for a special key to show up
+        spawn = load_stage(level_source().location(number)[0], arrays["obstacles"], arrays["hazards"], arrays["exits"],
+                           arrays["coins"], arrays["respawns"], arrays["spikes"], arrays["slow"],
+                           arrays["decorative"], arrays["locks"], arrays["lockleafs"], arrays["keys"],
+                           arrays["skeys"], arrays["sdoors"], arrays["tombstones"], arrays["chests"],
+                           arrays["returns"], arrays["floats"], key_coins or 0, number,
+                           arrays["rings"], arrays["swords"], arrays["fdoors"],
+                           text=level_source().text(number), key_coins=key_coins)
+        self.playable = spawn.x >= 0
+        self.spawn = (spawn.x, spawn.y)
+        self.bounds = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.player_mask = image_mask(load_image("res/img/player.bmp"))
+        self.player_size = self.player_mask.get_size()
+
+        # Eyes move on a timer the search does not model, so they are left out and the level is marked approximate
+        moving_hazards = [obj for obj in arrays["hazards"] if hasattr(obj, "speed")]
+        self.obstacles = [obj.rect for obj in arrays["obstacles"]]
+        # A float can be waited for anywhere along its path, or be somewhere else when the player falls by
+        self.floats = [pygame.Rect(obj.left + 32 - obj.speed, obj.rect.y,
+                                   SCREEN_WIDTH - 80 + 2 * obj.speed + obj.rect.width, obj.rect.height)
+                       for obj in arrays["floats"]]
+        self.approximate = bool(arrays["floats"] or moving_hazards)
+        self.locked = bool(arrays["locks"] or arrays["lockleafs"])
+        self.items = {name: [obj.rect for obj in arrays[name]] for name in ITEMS}
+
+        # Precompute what the player rect touches at every position it can be in, so a frame is a few lookups
+        self.left = self.bounds.left - self.player_size[0]
+        self.top = self.bounds.top - self.player_size[1]
+        self.height = self.bounds.height + FALL_MARGIN + 2 * self.player_size[1]
+        size = (self.bounds.width + 2 * self.player_size[0]) * self.height
+        self.flags = bytearray(size)
+        self.first_obstacle = array('h', [-1]) * size
+        self.first_float = array('h', [-1]) * size
+        self.touches = {}                           # Items touched by position
+        for index in reversed(range(len(self.obstacles))):      # Lowest index wins, like hits[0] in the game
+            for cell in self.cells_under(self.obstacles[index]):
+                self.flags[cell] |= OBSTACLE
+                self.first_obstacle[cell] = index
+        for index in reversed(range(len(self.floats))):
+            for cell in self.cells_under(self.floats[index]):
+                self.flags[cell] |= FLOAT
+                self.first_float[cell] = index
+        for flag, sprites in ((HAZARD, [obj for obj in arrays["hazards"] if obj not in moving_hazards]),
+                              (LOCK, arrays["locks"] + arrays["lockleafs"]),
+                              (SPIKE, arrays["spikes"]), (SLOW, arrays["slow"])):
+            for obj in sprites:
+                # Hazards kill by their pixels like in the game, slow terrain still works by rect
+                for cell in self.cells_under(obj.rect, None if flag == SLOW else hazard_mask(obj)):
+                    self.flags[cell] |= flag
+        for name in ITEMS:
+            for index, rect in enumerate(self.items[name]):
+                for cell in self.cells_under(rect):
+                    self.flags[cell] |= EXIT if name == "exits" else ITEM
+                    self.touches.setdefault(cell, []).append((name, index))
+
+    def cells_under(self, rect, mask=None):
+        # Every player position, by top left corner, whose rect overlaps this one, or whose pixels overlap the mask
+        width, height = self.player_size
+        for x in range(max(rect.left - width + 1, self.left), min(rect.right, self.bounds.right + width)):
+            base = (x - self.left) * self.height - self.top
+            for y in range(max(rect.top - height + 1, self.top), min(rect.bottom, self.top + self.height)):
+                if mask is None or self.player_mask.overlap(mask, (rect.x - x, rect.y - y)):
+                    yield base + y
+
+    def step(self, state, move, down, event, locked, ride):
+        # One frame of the main loop for the player: key event, then Player.update, then the slow handler
+        x, y, vx, vy, air = state
+        if event == JUMP_EVENT and air < JUMP_WINDOW:
+            vy = JUMP
+        elif event == CANCEL_EVENT and air > 0 and vy < JUMP_MIN:
+            vy = JUMP_MIN
+        if vy > MAX_FALL_SPEED:
+            vy = MAX_FALL_SPEED
+        ax = ACC * move
+        if down:
+            vx = 0
+        ax += vx * FRIC
+        vx += ax
+        vy += GRAV
+        x += vx + 0.5 * ax
+        y += vy + 0.5 * GRAV
+        if x + 24 > self.bounds.right:
+            x = self.bounds.right - 24
+        if x < self.bounds.left + 24:
+            x = self.bounds.left + 24
+        if y < self.bounds.top + 32:
+            y = self.bounds.top + 32
+            vy = 0
+        if y > self.bounds.bottom + FALL_MARGIN:
+            return None, (), DEAD
+        # Same rounding as assigning the float position to rect.midbottom
+        cell = (int(x + 0.5) - self.player_size[0] // 2 - self.left) * self.height \
+            + int(y + 0.5) - self.player_size[1] - self.top
+        flags = self.flags[cell]
+
+        on_ground = False
+        if vy > 0 and flags & (OBSTACLE | FLOAT if ride else OBSTACLE):
+            if flags & OBSTACLE:                # Walls and platforms come before floats in the game's groups
+                obstacle = self.obstacles[self.first_obstacle[cell]]
+            else:
+                obstacle = self.floats[self.first_float[cell]]
+            if y < obstacle.bottom:
+                y = obstacle.top + 1
+                vy = 0
+                air = 0
+                on_ground = True
+        if not on_ground:
+            air = min(air + 1, JUMP_WINDOW)     # Nothing tells longer falls apart
+
+        if flags & HAZARD or (locked and flags & LOCK):
+            return None, (), DEAD
+        if flags & EXIT:
+            return None, self.touches[cell], EXITED
+        touched = self.touches[cell] if flags & ITEM else ()
+        if vy > 0 and flags & SPIKE:
+            return None, touched, DEAD
+        if flags & SLOW:
+            air = 0
+            vx = max(-2, min(2, vx))
+            if vy > 2:
+                vy = 2
+            elif vy < -5:
+                vy = -5
+        return (x, y, vx, vy, air), touched, ALIVE
+
+
+def state_key(state):
+    x, y, vx, vy, air = state
+    # Packed into one int so millions of visited states stay small
+    return (((int(x // POSITION_STEP) * 4096 + int(y // POSITION_STEP)) * 1024 + round(vx / VELOCITY_STEP) + 512)
+            * 1024 + round(vy / VELOCITY_STEP) + 512) * 16 + air
+
+
+def search(level, xcancel):
+    # Breadth first over every input the player could give, merging states that land in the same bucket
+    reached = {name: set() for name in ITEMS}
+    visited = set()
+    key_states = []                             # Where keys were touched, the unlock happens at the last of them
+    moves = [(move, down) for move in (-1, 0, 1) for down in ((False, True) if xcancel else (False,))]
+    rides = (True, False) if level.floats else (True,)
+    spawns = deque([level.spawn])
+    seen_spawns = set()
+
+    def run(seeds, locked):
+        queue = deque(seeds)
+        while queue:
+            state = queue.popleft()
+            x, y, vx, vy, air = state
+            events = [NO_EVENT]
+            if air < JUMP_WINDOW:
+                events.append(JUMP_EVENT)
+            if 0 < air and vy < JUMP_MIN:
+                events.append(CANCEL_EVENT)
+            inputs = [(move, down, event, ride) for move, down in moves for event in events for ride in rides]
+            for move, down, event, ride in inputs:
+                new_state = state
+                for frame in range(INPUT_FRAMES):   # The key event comes first, then the keys stay held
+                    new_state, touched, outcome = level.step(new_state, move, down,
+                                                             event if frame == 0 else NO_EVENT, locked, ride)
+                    for name, index in touched:
+                        reached[name].add(index)
+                        if name == "keys" and locked and new_state is not None:
+                            key_states.append(new_state)
+                        if name == "respawns":  # Dying after this puts the player back here
+                            rect = level.items["respawns"][index]
+                            spawns.append((rect.x + 8, rect.y - 8))
+                    if outcome != ALIVE:
+                        break
+                if outcome != ALIVE:
+                    continue
+                key = state_key(new_state)
+                if key not in visited:
+                    visited.add(key)
+                    queue.append(new_state)
+
+    def spawn_states():
+        seeds = []
+        while spawns:
+            spawn = spawns.popleft()
+            if spawn not in seen_spawns:
+                seen_spawns.add(spawn)
+                seeds.append((spawn[0], spawn[1], 0.0, 0.0, 0))
+        return seeds
+
+    locked = level.locked
+    seeds = spawn_states()
+    while seeds:
+        run(seeds, locked)
+        seeds = spawn_states()                  # Respawn points found on the way become new places to start from
+    unlocked = not locked
+    if locked and len(reached["keys"]) == len(level.items["keys"]) and level.items["keys"]:
+        unlocked = True                         # Every key can be taken, so search again without the locks
+        visited.clear()
+        seen_spawns.clear()
+        spawns.append(level.spawn)
+        for index in reached["respawns"]:
+            rect = level.items["respawns"][index]
+            spawns.append((rect.x + 8, rect.y - 8))
+        seeds = spawn_states() + key_states
+        while seeds:
+            run(seeds, False)
+            seeds = spawn_states()
+    return reached, unlocked, len(visited)
+
+
+def analyze_level(job):
+    number, xcancel = job
+    level = Level(number)
+    result = {"level": number, "xcancel": xcancel, "playable": level.playable,
+              "approximate": level.approximate, "locks": level.locked}
+    totals = {name: len(rects) for name, rects in level.items.items()}
+    if not level.playable:
+        result.update(reached={name: 0 for name in ITEMS}, totals=totals, missing={}, unlocked=True, states=0)
+        return result
+    reached, unlocked, states = search(level, xcancel)
+    missing = {}
+    for name in ITEMS:
+        lost = sorted(set(range(totals[name])) - reached[name])
+        if lost:                                # Report as tile column and row like the level file
+            missing[name] = [(level.items[name][index].centerx // TILE_SIZE,
+                              level.items[name][index].centery // TILE_SIZE) for index in lost]
+    result.update(reached={name: len(reached[name]) for name in ITEMS}, totals=totals, missing=missing,
+                  unlocked=unlocked, states=states)
+    return result
+
+
+def cache_key(job):
+    number, xcancel = job
+    level = level_source().text(number).encode()
+    settings = (CACHE_VERSION, ACC, FRIC, GRAV, JUMP, JUMP_MIN, JUMP_WINDOW, MAX_FALL_SPEED,
+                level_source().info(number)["key_coins"], POSITION_STEP, VELOCITY_STEP, INPUT_FRAMES, FALL_MARGIN,
+                xcancel)
+    return hashlib.sha1(level + repr(settings).encode()).hexdigest()
+
+
+def load_cache():
+    try:
+        with open(CACHE_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    temp = CACHE_PATH + ".tmp"
+    with open(temp, 'w') as file:
+        json.dump(cache, file)
+    os.replace(temp, CACHE_PATH)
+
+
+def report(results, xcancel):
+    by_level = {result["level"]: result for result in results if result["xcancel"] == xcancel}
+    route = play_route()
+    ok = True
+    print("with the chest (DOWN cancels momentum)" if xcancel else "without the chest")
+    for number, result in sorted(by_level.items()):
+        if not result["playable"]:
+            print(f"  level {number}: game over screen, nothing to reach")
+            continue
+        counts = ", ".join(f"{name} {result['reached'][name]}/{result['totals'][name]}" for name in ITEMS)
+        notes = []
+        if result["locks"]:
+            notes.append("unlocked" if result["unlocked"] else "LOCKED")
+        if result["approximate"]:
+            notes.append("approximate, moving platforms or eyes")
+        print(f"  level {number}: {counts}" + (f" ({', '.join(notes)})" if notes else "")
+              + f" [{result['states']} states]")
+        for name, cells in result["missing"].items():
+            print(f"    unreachable {name} at " + " ".join(f"({column},{row})" for column, row in cells))
+        if number in route and result["totals"]["exits"] and not result["reached"]["exits"]:
+            ok = False
+
+    def coins_before(stage):
+        return sum(by_level[number]["reached"]["coins"] for number in route[:route.index(stage)]
+                   if number in by_level)
+
+    key_stages = [(stage, level_source().info(stage)["key_coins"]) for stage in route
+                  if level_source().info(stage)["key_coins"] is not None]
+    checks = [(f"stage {stage} special key", key_coins, coins_before(stage), f"before stage {stage}")
+              for stage, key_coins in key_stages]
+    checks.append(("FINAL_COINS", FINAL_COINS, sum(by_level[number]["reached"]["coins"] for number in route
+                                                    if number in by_level), "in the whole route"))
+    if not all(number in by_level for number in route):
+        checks = []                             # Coin totals only add up over the whole route
+    for name, needed, available, where in checks:
+        status = "ok" if available >= needed else "NOT ACHIEVABLE"
+        ok = ok and available >= needed
+        print(f"  {name} needs {needed}: {available} coins reachable {where}, {status}")
+    for stage, _ in key_stages:
+        if stage in by_level and by_level[stage]["totals"]["skeys"] and not by_level[stage]["reached"]["skeys"]:
+            print(f"  special key in stage {stage} is unreachable")
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check which coins, keys and exits every level lets the player reach")
+    parser.add_argument("levels", nargs="*", type=int, help="level numbers to check (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="levels searched at once")
+    parser.add_argument("--fresh", action="store_true", help="search every level again, ignoring saved results")
+    options = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))   # Asset paths are relative to the game folder
+
+    numbers = options.levels or list(level_source().stages())
+    skipped = [number for number in numbers if level_source().is_large(number)]
+    for number in skipped:
+        print(f"level {number}: large levels are not analyzed")
+    jobs = [(number, xcancel) for xcancel in (False, True) for number in numbers if number not in skipped]
+    cache = {} if options.fresh else load_cache()
+    keys = {job: cache_key(job) for job in jobs}
+    results = [cache[keys[job]] for job in jobs if keys[job] in cache]
+    todo = [job for job in jobs if keys[job] not in cache]
+    if todo:
+        with multiprocessing.Pool(max(1, min(options.jobs, len(todo)))) as pool:
+            for result in pool.imap_unordered(analyze_level, todo):
+                results.append(result)
+                cache[keys[(result["level"], result["xcancel"])]] = result
+        save_cache(cache)
+    ok = report(results, False)
+    report(results, True)                       # The game is meant to be fully completable without the chest
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+import glob
+import io
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+
+import pygame
+
+# Define bundle layout
+BUNDLE_MAGIC = b"LLAB"
+BUNDLE_VERSION = 3
+BUNDLE_HEADER = struct.Struct("<4sHHQI")    # Magic, version, reserved, index size, index crc32
+BUNDLE_ALIGN = 16                           # Blobs start on aligned offsets so pixel rows map cleanly
+BUNDLE_PATH = "res/assets.bundle"
+
+# Define what gets packed
+IMAGE_PATTERNS = ("res/img/*.bmp", "res/img/*.png")
+FILE_PATTERNS = ("res/audio/*", "res/levels/*.txt", "res/levels/*.json", "res/misc/*.ttf")
+
+# Define palettized images
+PALETTE_SIZE = 256                          # Colors an 8-bit image can hold, images with more stay 32-bit
+
+
+class BundleError(Exception):
+    pass
+
+
+# Read only view of a packed asset bundle, mapped into memory and sliced on demand
+class AssetBundle:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        # Copy-on-write mapping gives pygame the writable buffer it wants without copying anything up front
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(self.data) < BUNDLE_HEADER.size:
+            raise BundleError(f"{filename} is too small to be an asset bundle")
+        magic, version, _, index_size, index_crc = BUNDLE_HEADER.unpack_from(self.data, 0)
+        if magic != BUNDLE_MAGIC:
+            raise BundleError(f"{filename} is not an asset bundle")
+        if version != BUNDLE_VERSION:
+            raise BundleError(f"{filename} is bundle version {version}, expected {BUNDLE_VERSION}")
+        raw_index = self.data[BUNDLE_HEADER.size:BUNDLE_HEADER.size + index_size]
+        if zlib.crc32(raw_index) != index_crc:
+            raise BundleError(f"{filename} has a corrupt index")
+        self.index = json.loads(raw_index)
+        self.sheets = {}                    # Surfaces made straight from the mapping, by sheet name
+        self.verified = set()               # Blob offsets whose checksum has already been checked
+        self.lock = threading.RLock()       # The game reads the bundle from its io threads too
+
+    def __contains__(self, filename):
+        return filename in self.index["images"] or filename in self.index["files"]
+
+    def blob(self, entry):
+        view = memoryview(self.data)[entry["offset"]:entry["offset"] + entry["size"]]
+        with self.lock:
+            if entry["offset"] not in self.verified:    # Checked on first use so startup only touches what it needs
+                if zlib.crc32(view) != entry["crc"]:
+                    raise BundleError(f"{self.filename} has a corrupt blob at offset {entry['offset']}")
+                self.verified.add(entry["offset"])
+        return view
+
+    def sheet(self, name):
+        with self.lock:
+            sheet = self.sheets.get(name)
+            if sheet is None:
+                entry = self.index["sheets"][name]
+                sheet = pygame.image.frombuffer(self.blob(entry), (entry["width"], entry["height"]), entry["format"])
+                if entry["format"] == "P":
+                    sheet.set_palette(entry["palette"])
+                    if entry["colorkey"] is not None:
+                        sheet.set_colorkey(entry["colorkey"])
+                self.sheets[name] = sheet
+        return sheet
+
+    def image(self, filename):
+        entry = self.index["images"][filename]
+        if "sheet" not in entry:                # Packed as its file, see build_bundle
+            return pygame.image.load(io.BytesIO(self.blob(entry)), filename)
+        return self.sheet(entry["sheet"]).subsurface(entry["rect"])     # Shares pixels and palette with the sheet
+
+    def file_view(self, filename):
+        return self.blob(self.index["files"][filename])
+
+    def open(self, filename):
+        return io.BytesIO(self.file_view(filename))
+
+    def location(self, filename):
+        entry = self.index["files"][filename]
+        self.blob(entry)                        # Checksummed before anything reads the range itself
+        return self.filename, entry["offset"], entry["size"]
+
+    def read_text(self, filename):
+        return str(self.file_view(filename), "utf-8")
+
+    def verify(self):
+        for entry in list(self.index["sheets"].values()) + list(self.index["files"].values()):
+            self.blob(entry)
+
+
+def open_bundle(filename=BUNDLE_PATH):
+    if not os.path.exists(filename):
+        return None
+    return AssetBundle(filename)
+
+
+def index_pixels(data):
+    # RGBA bytes as one palette index per pixel, or None when there are too many colors or partly transparent pixels
+    # Every fully transparent pixel shares one index, which becomes the colorkey
+    pixels = memoryview(data).cast("I")
+    colors = set(pixels)
+    palette = []
+    lookup = {}
+    colorkey = None
+    for color in sorted(colors):
+        red, green, blue, alpha = color.to_bytes(4, sys.byteorder)
+        if alpha == 0:
+            if colorkey is None:
+                colorkey = len(palette)
+                palette.append((0, 0, 0))
+            lookup[color] = colorkey
+        elif alpha == 255:
+            lookup[color] = len(palette)
+            palette.append((red, green, blue))
+        else:
+            return None
+        if len(palette) > PALETTE_SIZE:
+            return None
+    return bytes(map(lookup.__getitem__, pixels)), palette, colorkey
+
+
+def indexed_image(indices, palette, colorkey, size):
+    image = pygame.image.frombytes(indices, size, "P")
+    image.set_palette(palette)
+    if colorkey is not None:
+        image.set_colorkey(colorkey)
+    return image
+
+
+def palettize(surface):
+    # 8-bit copy of an image with few enough colors, a quarter of the memory of 32-bit, otherwise the image itself
+    if surface.get_bytesize() == 2:             # Blits widen 16-bit colors differently than reading them does
+        return surface
+    indexed = index_pixels(pygame.image.tobytes(surface, "RGBA"))
+    if indexed is None:
+        return surface
+    return indexed_image(*indexed, surface.get_size())
+
+
+def frame_groups(filenames):
+    # Group animation frames like coin1..coin4 or bush/bush2 that share a size into one sheet
+    groups = {}
+    for filename in filenames:
+        name = os.path.basename(filename)
+        match = re.match(r"^(.*?)(\d*)\.(bmp|png)$", name)
+        groups.setdefault(match.group(1), []).append(filename)
+    for base, members in sorted(groups.items()):
+        members.sort(key=lambda filename: (len(filename), filename))
+        yield base, members
+
+
+def build_bundle(output=BUNDLE_PATH):
+    sheets = {}
+    images = {}
+    files = {}
+    blobs = []
+
+    image_files = sorted(filename for pattern in IMAGE_PATTERNS for filename in glob.glob(pattern))
+    for base, members in frame_groups(image_files):
+        by_size = {}
+        for filename in members:
+            surface = pygame.image.load(filename)
+            if surface.get_bytesize() == 2:     # Blits widen 16-bit colors differently than reading them as RGBA
+                with open(filename, 'rb') as file:
+                    entry = {}
+                    images[filename.replace(os.sep, "/")] = entry
+                    blobs.append((entry, file.read()))
+                continue
+            by_size.setdefault(surface.get_size(), []).append((filename, surface))
+        for (width, height), frames in sorted(by_size.items()):
+            name = f"{base}_{width}x{height}"
+            pixels = [pygame.image.tobytes(surface, "RGBA") for _, surface in frames]
+            rows = []
+            for row in range(height):           # Lay the frames side by side, copying pixels exactly
+                for data in pixels:
+                    rows.append(data[row * width * 4:(row + 1) * width * 4])
+            data = b"".join(rows)
+            sheets[name] = {"width": width * len(frames), "height": height, "format": "RGBA"}
+            indexed = index_pixels(data)        # Frames of a sheet share one palette
+            if indexed is not None:
+                data, palette, colorkey = indexed
+                sheets[name].update(format="P", palette=palette, colorkey=colorkey)
+            blobs.append((sheets[name], data))
+            for number, (filename, _) in enumerate(frames):
+                images[filename.replace(os.sep, "/")] = {"sheet": name, "rect": [number * width, 0, width, height]}
+
+    other_files = sorted(filename for pattern in FILE_PATTERNS for filename in glob.glob(pattern))
+    for filename in other_files:
+        with open(filename, 'rb') as file:
+            entry = {}
+            files[filename.replace(os.sep, "/")] = entry
+            blobs.append((entry, file.read()))
+
+    # Offsets depend on the index size and the index contains offsets, so settle the size first
+    index = {"sheets": sheets, "images": images, "files": files}
+    for entry, data in blobs:
+        entry.update(offset=0, size=len(data), crc=zlib.crc32(data))
+    while True:
+        index_size = len(json.dumps(index, separators=(",", ":")).encode())
+        offset = BUNDLE_HEADER.size + index_size
+        for entry, data in blobs:
+            offset += -offset % BUNDLE_ALIGN
+            entry["offset"] = offset
+            offset += len(data)
+        raw_index = json.dumps(index, separators=(",", ":")).encode()
+        if len(raw_index) == index_size:
+            break
+
+    temp = output + ".tmp"
+    with open(temp, 'wb') as file:
+        file.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, 0, len(raw_index), zlib.crc32(raw_index)))
+        file.write(raw_index)
+        for entry, data in blobs:
+            file.write(b"\0" * (entry["offset"] - file.tell()))
+            file.write(data)
+    os.replace(temp, output)
+    return index
+
+
+def drawn(image):
+    # Pixels an image leaves when blitted onto a frame, the way the game draws it
+    frame = pygame.Surface(image.get_size(), 0, 32)
+    frame.fill((255, 0, 255))                   # Not a color any image uses, so transparent pixels show
+    frame.blit(image, (0, 0))
+    return pygame.image.tobytes(frame, "RGB")
+
+
+def mismatched_images(bundle):
+    # Packed images that draw differently from their loose files loaded the way the game loads them
+    return [filename for filename in bundle.index["images"]
+            if drawn(bundle.image(filename)) != drawn(palettize(pygame.image.load(filename)))]
+
+
+def main():
+    output = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else BUNDLE_PATH)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))   # Asset paths are relative to the game folder
+    index = build_bundle(output)
+    bundle = AssetBundle(output)
+    bundle.verify()
+    mismatched = mismatched_images(bundle)
+    if mismatched:
+        raise BundleError(f"{output} draws these images differently from their files: {', '.join(mismatched)}")
+    print(f"Packed {len(index['images'])} images into {len(index['sheets'])} sheets "
+          f"and {len(index['files'])} files into {output} ({os.path.getsize(output)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
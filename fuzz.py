@@ -0,0 +1,484 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+
+import pygame
+from pygame.locals import K_LEFT, K_RIGHT, K_DOWN
+
+import main as game
+from main import (GAME_FLAGS, SPECIAL_KEY_SPRITES, STAGE_GROUPS, UPDATE_GROUPS, TILE_SIZE, FloatingPlatform,
+                  Player, Stage, animation_clock, game_state, open_levels, vec)
+
+# Define input bits, every simulated frame is driven by one byte of input
+LEFT = 1                                    # Held
+RIGHT = 2                                   # Held
+DOWN = 4                                    # Held, cancels momentum once the chest is taken
+JUMP_PRESS = 8                              # Key down event
+JUMP_RELEASE = 16                           # Key up event, after the key down if both are in one frame
+
+# Define fuzzing values
+RUN_FRAMES = 1800                           # Longest input sequence played from a stage's spawn
+ROUND_SECONDS = 15                          # Longest a process works on one stage before corpora are merged
+HOLD_FRAMES = 40                            # Longest a random input is held for
+COVERAGE_STEP = 8                           # Pixels per coverage cell
+CORPUS_SIZE = 256                           # Inputs kept per stage to mutate, the ones that found the most cells
+EMBED_DEPTH = 4                             # Pixels a standing player may overlap an obstacle by on both axes
+PROBE_STEP = 32                             # Pixels per cell that softlock probes are run once for
+PROBE_ROLLOUTS = 24                         # Random continuations tried before a state counts as a softlock
+PROBE_FRAMES = 900                          # Frames per continuation
+MINIMIZE_RUNS = 300                         # Replays spent shrinking each failing input
+REPRO_FOLDER = "fuzz"
+
+# Define what a run can end with besides the player staying in the stage
+ENDINGS = ("exit", "door", "back", "final")
+
+# Define anomalies, by what the repro files call them
+MISSED_LANDING = "missed-landing"           # Fell into a floor that the player was above, without landing on it
+FELL_THROUGH = "fell-through"               # Passed a floor completely in one frame
+EMBEDDED = "embedded"                       # Standing still while overlapping an obstacle
+OUT_OF_STAGE = "out-of-stage"               # Fell below the stage, where nothing kills or lands the player
+STUCK_IN_SLOW = "stuck-in-slow"             # No continuation leaves the slow terrain the player is in
+SOFTLOCK = "softlock"                       # No continuation reaches an exit or a death
+PROBED = (STUCK_IN_SLOW, SOFTLOCK)          # Found by probing where a run ended instead of by a frame check
+ANOMALIES = (MISSED_LANDING, FELL_THROUGH, EMBEDDED, OUT_OF_STAGE, STUCK_IN_SLOW, SOFTLOCK)
+
+# Define repro file names as write_repro makes them, the only files a run deletes from its output folder
+REPRO_NAME = re.compile(r"stage-?\d+-(" + "|".join(ANOMALIES) + r")--?\d+--?\d+(-chest)?\.json")
+
+# Define keys held for every combination of the held input bits
+HELD = [{K_LEFT: bool(bits & LEFT), K_RIGHT: bool(bits & RIGHT), K_DOWN: bool(bits & DOWN)} for bits in range(8)]
+
+
+# Sound the fuzzer hands to Player.jump, nothing is played
+class Silent:
+    def play(self, loops=0):
+        pass
+
+
+SILENT = Silent()
+
+
+def sprite_state(obj):
+    # Everything a sprite changes while it is played, rects and vectors copied so later frames do not touch them
+    return {name: value.copy() if isinstance(value, (pygame.Rect, vec)) else value
+            for name, value in vars(obj).items() if not name.startswith("_")}
+
+
+def restore_sprite(obj, state):
+    obj.__dict__.update({name: value.copy() if isinstance(value, (pygame.Rect, vec)) else value
+                         for name, value in state.items()})
+
+
+# One stage played frame by frame the way the main loop plays it, without a window, sound or drawing
+class Simulation:
+    def __init__(self, number, xcancel):
+        self.number = number
+        self.xcancel = xcancel
+        self.info = level_source().info(number)
+        game_state.restore({name: False for name in GAME_FLAGS})
+        self.stage = Stage(number, self.info["key_coins"] or 0)     # Enough coins for a special key to show up
+        self.playable = not self.stage.game_over
+        self.members = self.stage.members["sprites"]
+        self.floors = [obj.rect for obj in self.stage.members["obstacles"] if not isinstance(obj, FloatingPlatform)]
+        game_state.set("has_xcancel", xcancel)
+        self.spawn = self.stage.spawn
+        self.player = Player(self.spawn.x, self.spawn.y, self.stage.bounds)
+        self.frame = 0
+        self.pristine = self.snapshot()         # Every run starts from here, animation clock included
+
+    def snapshot(self):
+        killed = {id(obj) for obj in self.members if not obj.alive()}
+        return ([sprite_state(obj) for obj in self.members], killed, sprite_state(self.player),
+                game_state.snapshot(), animation_clock.snapshot(), self.stage.unlocked, vec(self.spawn), self.frame)
+
+    def restore(self, snapshot):
+        states, killed, player, flags, clock, unlocked, spawn, frame = snapshot
+        for obj, state in zip(self.members, states):
+            restore_sprite(obj, state)
+        for name in STAGE_GROUPS:
+            group = getattr(self.stage, name)
+            group.empty()
+            group.add(*[obj for obj in self.stage.members[name] if id(obj) not in killed])
+        restore_sprite(self.player, player)
+        game_state.restore(flags)
+        animation_clock.restore(clock)
+        self.stage.unlocked = unlocked
+        self.spawn = vec(spawn)
+        self.frame = frame
+
+    def start(self):
+        self.restore(self.pristine)
+
+    def slowed(self):
+        return pygame.sprite.spritecollideany(self.player, self.stage.slow) is not None
+
+    def step(self, bits):
+        # One frame: key events, Player.update, what the main loop does with its result, then the sprite updates
+        # Returns what ended the run or "death", and the anomaly seen this frame if any
+        stage = self.stage
+        player = self.player
+        if bits & JUMP_PRESS:
+            player.jump(SILENT)
+        if bits & JUMP_RELEASE:
+            player.cancel_jump()
+        start_bottom = player.pos.y
+        start_rect = player.rect.copy()
+        check = player.update(stage.obstacles, stage.hazards, stage.stage_exit, stage.collectibles,
+                              stage.respawn_point, stage.spikes, stage.slow, stage.keys, stage.skeys,
+                              stage.sdoors, stage.chests, stage.returns, stage.rings, stage.swords,
+                              stage.fdoors, HELD[bits & 7])
+        self.frame += 1
+        anomaly = None if check in (1, 2) else self.check_frame(start_bottom, start_rect)
+
+        outcome = None
+        if check == 1:
+            player.kill()
+            self.player = Player(self.spawn.x, self.spawn.y, stage.bounds)
+            outcome = "death"
+        if check == 2 and self.info["exit"] is not None:
+            outcome = "exit"
+        if check == 4:
+            self.spawn = stage.respawn
+        if check == 5:
+            player.air = 0
+            if player.vel.x > 2:
+                player.vel.x = 2
+            elif player.vel.x < -2:
+                player.vel.x = -2
+            if player.vel.y > 2:
+                player.vel.y = 2
+            elif player.vel.y < -5:
+                player.vel.y = -5
+        if check == 6 and not stage.keys_remaining():
+            stage.unlock()
+        if check == 7:
+            game_state.set(SPECIAL_KEY_SPRITES[self.info["special_key"]][0].flag, True)
+        if check == 8:
+            game_state.set("has_xcancel", True)
+        if (check == 9 and self.info["door"] is not None
+                and getattr(game_state, SPECIAL_KEY_SPRITES[self.info["special_key"]][0].flag)):
+            outcome = "door"
+        if check == 10 and self.info["back"] is not None:
+            outcome = "back"
+        if check == 11:
+            game_state.set("has_ring", True)
+        if check == 12:
+            game_state.set("has_sword", True)
+        if check == 13 and self.info["final"] is not None:
+            outcome = "final"
+        animation_clock.tick()
+        for name, _ in UPDATE_GROUPS:
+            for obj in getattr(stage, name):
+                obj.update()
+        if outcome is None and self.player.rect.top > stage.bounds.bottom:
+            anomaly = (OUT_OF_STAGE, "fell below the stage")
+            outcome = "lost"
+        return outcome, anomaly
+
+    def check_frame(self, start_bottom, start_rect):
+        player = self.player
+        if player.vel.y > 0:                    # Still falling, so nothing was landed on this frame
+            for index in player.rect.collidelistall(self.floors):
+                floor = self.floors[index]
+                if start_bottom <= floor.top + 1:
+                    return MISSED_LANDING, f"fell into the floor at {tile_name(floor)} without landing on it"
+            for index in start_rect.union(player.rect).collidelistall(self.floors):
+                floor = self.floors[index]
+                if start_bottom <= floor.top + 1 and player.rect.top >= floor.bottom:
+                    return FELL_THROUGH, f"passed through the floor at {tile_name(floor)} in one frame"
+        elif player.vel.y == 0 and player.air == 0:
+            rect = player.rect.copy()
+            rect.midbottom = player.pos         # Where it is drawn next frame, landing moves pos but not the rect
+            for index in rect.collidelistall(self.floors):
+                overlap = rect.clip(self.floors[index])
+                if overlap.width > EMBED_DEPTH and overlap.height > EMBED_DEPTH:
+                    return EMBEDDED, f"standing inside the obstacle at {tile_name(self.floors[index])}"
+        return None
+
+    def cell(self):
+        vel_y = self.player.vel.y
+        motion = 0 if vel_y == 0 else (1 if vel_y > 0 else 2)
+        return (int(self.player.pos.x) // COVERAGE_STEP * 4096 + int(self.player.pos.y) // COVERAGE_STEP) * 4 + motion
+
+    def run(self, inputs, coverage=None):
+        # Play inputs from the spawn, returns how many frames were played, how the run ended and the first anomaly
+        self.start()
+        for frame, bits in enumerate(inputs):
+            outcome, anomaly = self.step(bits)
+            if coverage is not None:
+                coverage.add(self.cell())
+            if anomaly is not None:
+                return frame + 1, outcome, anomaly
+            if outcome in ENDINGS or outcome == "lost":
+                return frame + 1, outcome, None
+        return len(inputs), None, None
+
+    def probe(self, rng):
+        # Random continuations from where the run ended, any that exits or dies is a way out
+        # Returns the anomaly if there is no way out and how many frames were played looking for one
+        start = self.snapshot()
+        slowed = self.slowed()
+        frames = 0
+        for _ in range(PROBE_ROLLOUTS):
+            self.restore(start)
+            for bits in random_inputs(rng, PROBE_FRAMES, self.xcancel):
+                outcome, _ = self.step(bits)
+                frames += 1
+                if outcome is not None and outcome != "lost":
+                    self.restore(start)
+                    return None, frames
+                if slowed and not self.slowed():
+                    slowed = False              # Leaving the slow terrain is not enough, it still has to get out
+                if outcome == "lost":
+                    break
+        self.restore(start)
+        if slowed:
+            return (STUCK_IN_SLOW, f"no way out of the slow terrain at {tile_name(self.player.rect)}"), frames
+        return (SOFTLOCK, f"no exit or death reachable from {tile_name(self.player.rect)}"), frames
+
+
+def tile_name(rect):
+    return f"({rect.centerx // TILE_SIZE},{rect.centery // TILE_SIZE})"
+
+
+def random_inputs(rng, frames, xcancel):
+    # Held keys that change every few frames, with the jump key pressed and released like a player would
+    inputs = bytearray()
+    moves = (0, LEFT, RIGHT, LEFT, RIGHT) + ((DOWN, LEFT | DOWN, RIGHT | DOWN) if xcancel else ())
+    while len(inputs) < frames:
+        hold = rng.randint(1, HOLD_FRAMES)
+        segment = bytearray([rng.choice(moves)]) * hold
+        if rng.random() < 0.6:
+            segment[0] |= JUMP_PRESS
+            release = rng.randint(0, hold - 1)
+            segment[release] |= JUMP_RELEASE
+        inputs += segment
+    return inputs[:frames]
+
+
+def mutate(rng, parent, xcancel):
+    if not parent or rng.random() < 0.1:
+        return random_inputs(rng, rng.randint(60, RUN_FRAMES), xcancel)
+    cut = rng.randint(0, len(parent))
+    choice = rng.random()
+    if choice < 0.6:                            # Keep the start and try something new from some point on
+        tail = random_inputs(rng, rng.randint(30, RUN_FRAMES // 4), xcancel)
+        return (parent[:cut] + tail)[:RUN_FRAMES]
+    if choice < 0.8:                            # Replace a stretch in the middle
+        span = random_inputs(rng, rng.randint(1, HOLD_FRAMES), xcancel)
+        return (parent[:cut] + span + parent[cut + len(span):])[:RUN_FRAMES]
+    inputs = bytearray(parent)                  # Flip a few bits
+    for _ in range(rng.randint(1, 4)):
+        inputs[rng.randrange(len(inputs))] ^= 1 << rng.randrange(5)
+    return inputs
+
+
+simulations = {}                            # Built stages by (stage, xcancel), kept for the life of a process
+
+
+def level_source():
+    if game.levels is None:
+        game.levels = open_levels(loose=True)   # The files being edited rather than a pack built from them
+    return game.levels
+
+
+def simulation(number, xcancel):
+    key = (number, xcancel)
+    if key not in simulations:
+        simulations[key] = Simulation(number, xcancel)
+    return simulations[key]
+
+
+def fuzz_stage(job):
+    number, xcancel, corpus, coverage, seed, seconds = job
+    sim = simulation(number, xcancel)
+    rng = random.Random(seed)
+    coverage = set(coverage)
+    corpus = [bytearray(inputs) for inputs in corpus]
+    found = []                                  # (inputs, cells it added) that added coverage
+    anomalies = []
+    probed = set()
+    frames = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        inputs = mutate(rng, rng.choice(corpus) if corpus else None, xcancel)
+        cells = set()
+        played, outcome, anomaly = sim.run(inputs, cells)
+        frames += played
+        new = len(cells - coverage)
+        if new:
+            coverage |= cells
+            found.append((bytes(inputs[:played]), new))
+            corpus.append(inputs[:played])
+        if anomaly is not None:
+            anomalies.append((anomaly[0], anomaly[1], bytes(inputs[:played]), sim.player.rect.center))
+        elif outcome is None:
+            rect = sim.player.rect
+            key = (rect.centerx // PROBE_STEP, rect.centery // PROBE_STEP)
+            if key not in probed:
+                probed.add(key)
+                anomaly, probed_frames = sim.probe(rng)
+                frames += probed_frames
+                if anomaly is not None:
+                    anomalies.append((anomaly[0], anomaly[1], bytes(inputs[:played]), rect.center))
+    return {"stage": number, "xcancel": xcancel, "frames": frames, "found": found,
+            "coverage": coverage, "anomalies": anomalies}
+
+
+def reproduces(sim, inputs, kind, rng):
+    played, outcome, anomaly = sim.run(inputs)
+    if kind in PROBED:
+        if played < len(inputs) or outcome is not None:
+            return False
+        anomaly, _ = sim.probe(rng)
+        return anomaly is not None and anomaly[0] == kind
+    return anomaly is not None and anomaly[0] == kind
+
+
+def minimize_anomaly(job):
+    # Delta debugging: drop ever smaller stretches of input while the same kind of anomaly still happens
+    number, xcancel, kind, inputs, seed = job
+    sim = simulation(number, xcancel)
+    rng = random.Random(seed)
+    inputs = bytearray(inputs)
+    budget = MINIMIZE_RUNS // 10 if kind in PROBED else MINIMIZE_RUNS   # Each probed check is a full probe
+    chunk = len(inputs) // 2
+    while chunk >= 1 and budget > 0:
+        start = 0
+        while start < len(inputs) and budget > 0:
+            candidate = inputs[:start] + inputs[start + chunk:]
+            budget -= 1
+            if candidate and reproduces(sim, candidate, kind, random.Random(seed)):
+                inputs = candidate
+            else:
+                start += chunk
+        chunk //= 2
+    played, outcome, anomaly = sim.run(inputs)
+    if kind in PROBED:
+        anomaly, _ = sim.probe(rng)
+    return {"stage": number, "xcancel": xcancel, "kind": kind, "inputs": bytes(inputs[:played]),
+            "detail": anomaly[1] if anomaly else "did not reproduce after minimizing",
+            "position": list(sim.player.rect.center), "seed": seed}
+
+
+def encode_inputs(inputs):
+    # Run length pairs of [input bits, frames], held keys make long runs
+    runs = []
+    for bits in inputs:
+        if runs and runs[-1][0] == bits:
+            runs[-1][1] += 1
+        else:
+            runs.append([bits, 1])
+    return runs
+
+
+def decode_inputs(runs):
+    return bytearray(b for bits, count in runs for b in bytes([bits]) * count)
+
+
+def write_repro(result, folder):
+    os.makedirs(folder, exist_ok=True)
+    x, y = result["position"]
+    filename = f"{folder}/stage{result['stage']}-{result['kind']}-{x // TILE_SIZE}-{y // TILE_SIZE}" \
+               f"{'-chest' if result['xcancel'] else ''}.json"
+    with open(filename, 'w') as file:
+        json.dump({"stage": result["stage"], "chest": result["xcancel"], "kind": result["kind"],
+                   "detail": result["detail"], "frames": len(result["inputs"]), "position": result["position"],
+                   "probe_seed": result["seed"], "inputs": encode_inputs(result["inputs"])}, file)
+    return filename
+
+
+def replay(filename):
+    with open(filename, 'r') as file:
+        repro = json.load(file)
+    sim = simulation(repro["stage"], repro["chest"])
+    inputs = decode_inputs(repro["inputs"])
+    found = reproduces(sim, inputs, repro["kind"], random.Random(repro["probe_seed"]))
+    print(f"{filename}: stage {repro['stage']} {repro['kind']} after {len(inputs)} frames, "
+          f"{'still happens' if found else 'no longer happens'} (player at {tile_name(sim.player.rect)})")
+    return found
+
+
+def fuzz(numbers, jobs, seconds, seed, folder):
+    stages = [(number, xcancel) for xcancel in (False, True) for number in numbers]
+    corpora = {stage: [] for stage in stages}  # (cells added, inputs)
+    coverage = {stage: set() for stage in stages}
+    anomalies = {}                              # First input seen per (stage, chest, kind, tile)
+    frames = 0
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    deadline = started + seconds
+    with multiprocessing.Pool(jobs) as pool:
+        while time.perf_counter() < deadline:
+            remaining = deadline - time.perf_counter()
+            share = max(1.0, min(ROUND_SECONDS, remaining * jobs / len(stages)))
+            work = [(number, xcancel, [inputs for _, inputs in corpora[(number, xcancel)]],
+                     coverage[(number, xcancel)], rng.getrandbits(32), share) for number, xcancel in stages]
+            for result in pool.imap_unordered(fuzz_stage, work):
+                stage = (result["stage"], result["xcancel"])
+                frames += result["frames"]
+                coverage[stage] |= result["coverage"]
+                corpus = corpora[stage] + [(new, inputs) for inputs, new in result["found"]]
+                corpus.sort(key=lambda entry: -entry[0])
+                corpora[stage] = corpus[:CORPUS_SIZE]
+                for kind, detail, inputs, (x, y) in result["anomalies"]:
+                    key = (*stage, kind, x // TILE_SIZE, y // TILE_SIZE)
+                    if key not in anomalies or len(inputs) < len(anomalies[key][1]):
+                        anomalies[key] = (detail, inputs)
+            elapsed = time.perf_counter() - started
+            print(f"{elapsed:.0f} s: {frames} frames ({frames / elapsed * 3600 / 1e6:.1f} million an hour), "
+                  f"{sum(len(cells) for cells in coverage.values())} cells covered, {len(anomalies)} anomalies")
+
+        work = [(number, xcancel, kind, inputs, rng.getrandbits(32))
+                for (number, xcancel, kind, _, _), (_, inputs) in sorted(anomalies.items())]
+        written = {}
+        for result in pool.imap_unordered(minimize_anomaly, work):
+            filename = write_repro(result, folder)
+            if filename not in written:
+                written[filename] = result
+    for filename, result in sorted(written.items()):
+        print(f"  {filename}: {result['detail']}, {len(result['inputs'])} frames")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the game's physics with random and coverage guided input "
+                                                 "on every stage and report clipping, falling and softlock bugs")
+    parser.add_argument("levels", nargs="*", type=int, help="level numbers to fuzz (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="processes fuzzing at once")
+    parser.add_argument("--minutes", type=float, default=10, help="how long to fuzz for")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the inputs tried, for repeatable runs")
+    parser.add_argument("--output", help=f"folder the repro files are written to (default {REPRO_FOLDER} in the game folder)")
+    parser.add_argument("--replay", nargs="+", metavar="FILE", help="replay repro files instead of fuzzing")
+    options = parser.parse_args()
+    if options.replay:                                      # Paths given on the command line are relative to where it ran
+        options.replay = [os.path.abspath(filename) for filename in options.replay]
+    options.output = os.path.abspath(options.output) if options.output else REPRO_FOLDER
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))   # Asset paths are relative to the game folder
+
+    if options.replay:
+        found = [replay(filename) for filename in options.replay]
+        sys.exit(1 if any(found) else 0)
+    numbers = options.levels or list(level_source().stages())
+    playable = []
+    for number in numbers:
+        if level_source().is_large(number):
+            print(f"level {number}: large levels are not fuzzed")
+        elif simulation(number, False).playable:
+            playable.append(number)
+    for filename in glob.glob(f"{options.output}/stage*.json"):
+        if REPRO_NAME.fullmatch(os.path.basename(filename)):
+            os.remove(filename)                 # Repro files from an earlier run that may have been fixed since
+    written = fuzz(playable, max(1, options.jobs), options.minutes * 60,
+                   options.seed if options.seed is not None else random.randrange(1 << 32), options.output)
+    sys.exit(1 if written else 0)
+
+
+if __name__ == "__main__":
+    main()
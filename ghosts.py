@@ -0,0 +1,139 @@
+import os
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+
+from saves import SAVE_FOLDER, campaign_prefix, write_atomic
+
+# Define ghost file layout
+GHOST_MAGIC = b"LLGH"
+GHOST_VERSION = 1
+GHOST_HEADER = struct.Struct("<4sHHII")     # Magic, version, track count, body size, body crc32
+GHOST_TRACK = struct.Struct("<iBIiiI")      # Stage, kind, frames, first x, first y, size of the moves that follow
+
+# Define track kinds
+BEST = 0                                    # Fewest frames from entering the stage to leaving through its exit
+ATTEMPT = 1                                 # One of the latest visits to the stage, however it ended
+
+# One visit to a stage, where the player was drawn on every frame of it
+# moves holds how far it went each frame after the first as deflated zigzag varints, mostly one byte a frame,
+# or the Recording of a visit made since the ghosts were read
+GhostTrack = namedtuple("GhostTrack", ("stage", "kind", "frames", "start", "moves"))
+
+
+class GhostError(Exception):
+    pass
+
+
+# Positions of a visit as the game recorded them, deflated by the writer the first time they are saved
+class Recording:
+    def __init__(self, xs, ys):
+        self.xs = xs
+        self.ys = ys
+        self.moves = None
+
+
+def ghost_path(campaign=None, folder=SAVE_FOLDER):
+    return f"{folder}/{campaign_prefix(campaign)}ghosts.dat"
+
+
+def make_moves(xs, ys):
+    data = bytearray()
+    for values in (xs, ys):
+        previous = values[0]
+        for value in values[1:]:
+            step = value - previous
+            previous = value
+            step = step * 2 if step >= 0 else -step * 2 - 1     # Zigzag, small steps either way stay small
+            while step >= 0x80:
+                data.append(step & 0x7f | 0x80)
+                step >>= 7
+            data.append(step)
+    return zlib.compress(bytes(data), 9)
+
+
+def track_moves(track):
+    moves = track.moves
+    if isinstance(moves, Recording):
+        if moves.moves is None:             # Only ever on the writer, which writes one file at a time
+            moves.moves = make_moves(moves.xs, moves.ys)
+        return moves.moves
+    return moves
+
+
+def decode_track(track):
+    # Positions of every frame of a track as two int arrays, x and y
+    if isinstance(track.moves, Recording):
+        return [track.moves.xs, track.moves.ys]
+    steps = []
+    step = shift = 0
+    for byte in zlib.decompress(track.moves):
+        step |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            steps.append(step >> 1 if step & 1 == 0 else -(step + 1 >> 1))
+            step = shift = 0
+    if len(steps) != 2 * (track.frames - 1):
+        raise GhostError(f"ghost of stage {track.stage} has {len(steps)} moves for {track.frames} frames")
+    positions = []
+    for start, moves in zip(track.start, (steps[:track.frames - 1], steps[track.frames - 1:])):
+        values = array('i', [start])
+        value = start
+        for move in moves:
+            value += move
+            values.append(value)
+        positions.append(values)
+    return positions
+
+
+def add_visit(tracks, stage, xs, ys, exited, attempts):
+    # The visit becomes the newest attempt of its stage, and its best run when it reached the exit sooner
+    visit = GhostTrack(stage, ATTEMPT, len(xs), (xs[0], ys[0]), Recording(xs, ys))
+    best = [track for track in tracks if track.stage == stage and track.kind == BEST]
+    if exited and (not best or visit.frames < best[0].frames):
+        best = [visit._replace(kind=BEST)]
+    recent = [track for track in tracks if track.stage == stage and track.kind == ATTEMPT] + [visit]
+    return [track for track in tracks if track.stage != stage] + best + (recent[-attempts:] if attempts else [])
+
+
+def encode(tracks):
+    body = bytearray()
+    for track in tracks:
+        moves = track_moves(track)
+        body += GHOST_TRACK.pack(track.stage, track.kind, track.frames, *track.start, len(moves))
+        body += moves
+    return GHOST_HEADER.pack(GHOST_MAGIC, GHOST_VERSION, len(tracks), len(body), zlib.crc32(body)) + body
+
+
+def decode(data, filename):
+    if len(data) < GHOST_HEADER.size:
+        raise GhostError(f"{filename} is too small to hold ghosts")
+    magic, version, count, size, crc = GHOST_HEADER.unpack_from(data, 0)
+    if magic != GHOST_MAGIC:
+        raise GhostError(f"{filename} does not hold ghosts")
+    if version != GHOST_VERSION:
+        raise GhostError(f"{filename} is ghost version {version}, expected {GHOST_VERSION}")
+    body = memoryview(data)[GHOST_HEADER.size:GHOST_HEADER.size + size]
+    if len(body) != size or zlib.crc32(body) != crc:
+        raise GhostError(f"{filename} is corrupt")
+    tracks = []
+    offset = 0
+    for _ in range(count):
+        stage, kind, frames, x, y, moves_size = GHOST_TRACK.unpack_from(body, offset)
+        offset += GHOST_TRACK.size
+        tracks.append(GhostTrack(stage, kind, frames, (x, y), bytes(body[offset:offset + moves_size])))
+        offset += moves_size
+    return tracks
+
+
+def read_ghosts(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'rb') as file:
+        return decode(file.read(), filename)
+
+
+def write_ghosts(filename, tracks):
+    write_atomic(filename, encode(tracks))
@@ -0,0 +1,218 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+# Define level pack layout
+PACK_MAGIC = b"LLPK"
+PACK_VERSION = 2
+PACK_HEADER = struct.Struct("<4sHHIiI")     # Magic, version, reserved, stage count, start stage, names size
+PACK_RECORD = struct.Struct("<6iIHHHHBBQII")    # Stage, exit, door, back, final, key coins, text offset, name size,
+                                            # background size, music size, flags, theme, special key, data offset,
+                                            # data size, data crc32
+PACK_ALIGN = 16
+PACK_PATH = "res/levels/campaign.pack"
+CAMPAIGN_PATH = "res/levels/campaign.json"
+
+# Define stage routing, each edge is the stage a tile leads to
+ROUTES = ("exit", "door", "back", "final")  # Exit tile, secret door, return door, final door
+NO_STAGE = -1                               # Edge or key threshold a stage does not have
+RETURNS = 1                                 # Flag for a return door that leads back to where the secret door was
+
+# Define stage looks, read by the game instead of going by stage numbers
+THEMES = 3                                  # Wall colors, 1 is res/img/wall.bmp and the rest its palette swaps
+SPECIAL_KEYS = (1, 2)                       # Which special key a stage's key tile gives and its secret doors show
+
+
+class PackError(Exception):
+    pass
+
+
+def campaign_stage(entry, folder):
+    # One stage of a campaign description, with every field filled in the way a pack record stores it
+    filename = entry.get("file", f"level{entry['id']}.txt")     # Relative to the campaign description
+    stage = {"id": entry["id"], "name": entry.get("name", str(entry["id"])),
+             "key_coins": entry.get("key_coins"), "returns": bool(entry.get("returns", False)),
+             "theme": entry.get("theme", 1), "special_key": entry.get("special_key", 1),
+             "background": entry.get("background"), "music": entry.get("music"),
+             "file": f"{folder}/{filename}" if folder else filename}
+    for route in ROUTES:
+        stage[route] = entry.get(route)
+    return stage
+
+
+# Read only view of a level pack, only the header is read up front and stages are found by binary search
+class LevelPack:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < PACK_HEADER.size:
+            raise PackError(f"{filename} is too small to be a level pack")
+        magic, version, _, self.count, self.start, self.names_size = PACK_HEADER.unpack_from(self.data, 0)
+        if magic != PACK_MAGIC:
+            raise PackError(f"{filename} is not a level pack")
+        if version != PACK_VERSION:
+            raise PackError(f"{filename} is level pack version {version}, expected {PACK_VERSION}")
+        self.names = PACK_HEADER.size + self.count * PACK_RECORD.size
+        if len(self.data) < self.names + self.names_size:
+            raise PackError(f"{filename} is truncated")
+        self.verified = set()               # Stages whose checksum has already been checked
+        self.lock = threading.Lock()        # Stages are read ahead on the game's io threads too
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, stage):
+        return self.find(stage) is not None
+
+    def record(self, slot):
+        return PACK_RECORD.unpack_from(self.data, PACK_HEADER.size + slot * PACK_RECORD.size)
+
+    def find(self, stage):
+        low = 0
+        high = self.count
+        while low < high:                   # Records are sorted by stage, so a lookup reads a handful of them
+            middle = (low + high) // 2
+            found = self.record(middle)[0]
+            if found == stage:
+                return middle
+            if found < stage:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def slot(self, stage):
+        slot = self.find(stage)
+        if slot is None:
+            raise KeyError(f"{self.filename} has no stage {stage}")
+        return slot
+
+    def info(self, stage):
+        return self.info_at(self.slot(stage))
+
+    def info_at(self, slot):
+        # Stages in id order, so a level select can page through a pack of any size
+        (number, *routes, key_coins, text_offset, name_size, background_size, music_size, flags, theme,
+         special_key, _, _, _) = self.record(slot)
+        texts = []
+        start = self.names + text_offset
+        for size in (name_size, background_size, music_size):   # Stored one after the other, empty when unset
+            texts.append(str(self.data[start:start + size], "utf-8"))
+            start += size
+        name, background, music = texts
+        info = {"id": number, "name": name, "key_coins": None if key_coins == NO_STAGE else key_coins,
+                "returns": bool(flags & RETURNS), "theme": theme, "special_key": special_key,
+                "background": background or None, "music": music or None}
+        for route, target in zip(ROUTES, routes):
+            info[route] = None if target == NO_STAGE else target
+        return info
+
+    def stages(self):
+        for slot in range(self.count):
+            yield self.record(slot)[0]
+
+    def location(self, stage):
+        *_, offset, size, crc = self.record(self.slot(stage))
+        with self.lock:
+            if offset not in self.verified:     # Checked on first use so only stages that are played are read
+                if zlib.crc32(memoryview(self.data)[offset:offset + size]) != crc:
+                    raise PackError(f"{self.filename} has a corrupt stage {stage}")
+                self.verified.add(offset)
+        return self.filename, offset, size
+
+    def text(self, stage):
+        _, offset, size = self.location(stage)
+        return str(self.data[offset:offset + size], "utf-8")
+
+    def is_large(self, stage):
+        _, offset, size = self.location(stage)
+        end = self.data.find(b'\n', offset, offset + size)
+        return b',' in self.data[offset:end if end != -1 else offset + size]
+
+    def verify(self):
+        for stage in self.stages():
+            self.location(stage)
+
+
+def open_pack(filename=PACK_PATH):
+    if not os.path.exists(filename):
+        return None
+    return LevelPack(filename)
+
+
+def parse_campaign(text, filename=CAMPAIGN_PATH):
+    data = json.loads(text)
+    folder = os.path.dirname(filename).replace(os.sep, "/")
+    stages = [campaign_stage(entry, folder) for entry in data["stages"]]
+    ids = {stage["id"] for stage in stages}
+    if len(ids) != len(stages):
+        raise PackError(f"{filename} lists a stage twice")
+    if data["start"] not in ids:
+        raise PackError(f"{filename} starts at stage {data['start']}, which it does not list")
+    for stage in stages:
+        for route in ROUTES:
+            if stage[route] is not None and stage[route] not in ids:
+                raise PackError(f"{filename}: stage {stage['id']} {route} leads to missing stage {stage[route]}")
+        if not 1 <= stage["theme"] <= THEMES:
+            raise PackError(f"{filename}: stage {stage['id']} has theme {stage['theme']}, expected 1 to {THEMES}")
+        if stage["special_key"] not in SPECIAL_KEYS:
+            raise PackError(f"{filename}: stage {stage['id']} has special key {stage['special_key']}, "
+                            f"expected one of {SPECIAL_KEYS}")
+    return data["start"], stages
+
+
+def build_pack(campaign=CAMPAIGN_PATH, output=PACK_PATH):
+    with open(campaign, 'r') as file:
+        start, stages = parse_campaign(file.read(), campaign)
+    stages.sort(key=lambda stage: stage["id"])
+    names = bytearray()
+    blobs = []
+    for stage in stages:
+        texts = [(stage[field] or "").encode() for field in ("name", "background", "music")]
+        with open(stage["file"], 'rb') as file:
+            blobs.append((stage, len(names), texts, file.read()))
+        names += b"".join(texts)
+
+    offset = PACK_HEADER.size + len(stages) * PACK_RECORD.size + len(names)
+    records = []
+    offsets = []
+    for stage, text_offset, texts, data in blobs:
+        offset += -offset % PACK_ALIGN
+        offsets.append(offset)
+        routes = [NO_STAGE if stage[route] is None else stage[route] for route in ROUTES]
+        key_coins = NO_STAGE if stage["key_coins"] is None else stage["key_coins"]
+        records.append(PACK_RECORD.pack(stage["id"], *routes, key_coins, text_offset, *map(len, texts),
+                                        RETURNS if stage["returns"] else 0, stage["theme"], stage["special_key"],
+                                        offset, len(data), zlib.crc32(data)))
+        offset += len(data)
+
+    temp = output + ".tmp"
+    with open(temp, 'wb') as file:
+        file.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, 0, len(stages), start, len(names)))
+        for record in records:
+            file.write(record)
+        file.write(names)
+        for offset, (_, _, _, data) in zip(offsets, blobs):
+            file.write(b"\0" * (offset - file.tell()))
+            file.write(data)
+    os.replace(temp, output)
+    return stages
+
+
+def main():
+    campaign = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else CAMPAIGN_PATH)
+    output = os.path.abspath(sys.argv[2] if len(sys.argv) > 2 else PACK_PATH)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))   # Level paths are relative to the game folder
+    stages = build_pack(campaign, output)
+    pack = LevelPack(output)
+    pack.verify()
+    print(f"Packed {len(stages)} stages from {campaign} into {output} ({os.path.getsize(output)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,31 @@
 import pygame
 from pygame.locals import *
-from time import time
+from time import time, perf_counter, perf_counter_ns
 from datetime import datetime, timedelta
+from array import array
+import argparse
+import asyncio
+import gc
+import glob
 import json
+import mmap
+import os
 import sys
+import threading
+import tracemalloc
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from bundle import open_bundle, palettize
+from levelpack import PACK_PATH, CAMPAIGN_PATH, ROUTES, LevelPack, open_pack, parse_campaign
+from saves import SAVE_SLOTS, SaveGame, SaveError, read_save, slot_path, write_save
+from ghosts import GhostError, add_visit, decode_track, ghost_path, read_ghosts, write_ghosts
+try:
+    from pygame._sdl2 import error as RendererError
+    from pygame._sdl2.video import Window, Renderer, Texture, WINDOWPOS_CENTERED
+except ImportError:                     # pygame builds without the SDL2 window and render API only support blitting
+    Renderer = None
+    Window = None
 
 # Define FPS
 FPS = 60                            # Cap at 60 FPS
@@ -21,10 +43,96 @@ JUMP_MIN = -3                       # Set minimum jump velocity
 JUMP_WINDOW = 6                     # Set frame window where jump can be performed after falling off platform
 MAX_FALL_SPEED = 14                 # This prevents a glitch where player moves through floor before check
 
+# Define tile and chunk dimensions for large levels
+TILE_SIZE = 16
+CHUNK_COLS = 20                         # Tiles per chunk horizontally
+CHUNK_ROWS = 15                         # Tiles per chunk vertically
+CHUNK_LOAD_MARGIN = 1                   # Chunks around the camera view that are instantiated ahead of time
+CHUNK_KEEP_MARGIN = 2                   # Chunks further away than this from the view are released
+CHUNK_LOADS_PER_FRAME = 2               # Off screen chunks instantiated per frame at most
+
+# Define input and frame pacing values
+PACING_MARGIN = 0.002                   # Seconds kept spare before the frame deadline in low latency mode
+PACING_SLICE = 0.001                    # Sleep granularity while waiting, events are pumped between slices
+PACING_SMOOTHING = 0.1                  # Weight of the newest frame in the smoothed frame work time
+OVERRUNS_REPORTED = 10                  # Slowest frames listed in the overrun report
+
+# Define background work values
+IO_THREADS = 2                          # Threads for file reads and writes kept off the game loop
+THREADLESS_PLATFORMS = ("emscripten", "wasi")   # Browser hosts, where background work runs inline instead
+
+# Define display values
+RENDERERS = ("blit", "gpu", "software")    # CPU blits onto the window, or images uploaded once as textures
+DISPLAY_MODES = ("window", "scaled", "fullscreen")     # Cycled with F, the frame itself is always 640x480
+BLENDMODE_NONE = 0                      # SDL_BLENDMODE_NONE, copies pixels as they are
+BLENDMODE_BLEND = 1                     # SDL_BLENDMODE_BLEND, alpha blending like a blit of an SRCALPHA surface
+
+# Define power saving values
+PAUSED_FPS = 4                          # Wakeups per second while the window is in the background
+
+# Define audio values
+MIXER_FREQUENCY = 44100
+MIXER_BUFFER = 256                      # Samples per mix, smaller is lower latency but risks crackling on slow machines
+MIXER_CHANNELS = {                      # Voices reserved per sound category so busy categories cannot starve others
+    "music": 3,
+    "ui": 2,
+    "player": 3,
+    "pickup": 4,
+    "world": 3,
+}
+
+# Define text values
+FONT_FILE = "res/misc/Bitmgothic.ttf"
+HUD_FONT_SIZE = 16
+HUD_POSITION = (20, 0)                  # Over the top row of wall tiles
+GLYPH_PAGE_SIZE = (512, 256)            # Size of each glyph atlas page
+TEXT_CACHE_SIZE = 64                    # Whole strings kept ready to blit
+
+# Define tracing values
+TRACE_EVENTS = 1 << 19                  # Events kept by the tracer, the oldest are overwritten once it is full
+
+# Define stage cache values
+STAGE_CACHE_BYTES = 16 * 1024 * 1024    # Budget for fully built stages kept in memory
+SPRITE_OVERHEAD_BYTES = 512             # Rough per-sprite cost of the python objects besides its surface
+
+# Define memory report values
+MEMORY_TOP_ALLOCATORS = 10              # Source lines listed per allocation diff
+MEMORY_PLAY_FRAMES = 600                # Frames of play after each stage load that allocations are followed for
+MEMORY_DIFFED = ("traced", "surfaces", "sounds", "sprites", "groups")  # Report sections compared between stages
+
+# Define animations: image files, game frames each one is shown for, and whether it loops or stays on the last one
+Animation = namedtuple("Animation", ("frames", "durations", "loop"))
+ANIMATIONS = {
+    "badleaf": Animation(("res/img/badleaf.bmp", "res/img/badleaf2.bmp"), (30, 30), True),
+    "exit": Animation(("res/img/exit.bmp", "res/img/exit2.bmp"), (210, 30), True),
+    "coin": Animation(tuple(f"res/img/coin{n}.bmp" for n in range(1, 5)), (5, 5, 5, 5), True),
+    "respawn": Animation(tuple(f"res/img/respawn{n}.bmp" for n in range(1, 5)), (10, 10, 10, 10), True),
+    "grass": Animation(("res/img/grass.bmp", "res/img/grass2.bmp"), (15, 15), True),
+    "bush": Animation(("res/img/bush.bmp", "res/img/bush2.bmp"), (30, 30), True),
+    "lockleaf": Animation(("res/img/lockleaf.bmp", "res/img/lockleaf2.bmp"), (30, 30), True),
+    "lock": Animation(("res/img/lock.bmp", "res/img/lock2.bmp"), (30, 30), True),
+    "key": Animation(tuple(f"res/img/key{n}.bmp" for n in range(1, 6)), (10, 10, 10, 10, 10), True),
+    "specialkey": Animation(tuple(f"res/img/specialkey{n}.bmp" for n in range(1, 5)), (10, 10, 10, 10), True),
+    "ring": Animation(tuple(f"res/img/ring{n}.bmp" for n in range(1, 4)), (10, 10, 10), True),
+    "sword": Animation(("res/img/sword.bmp", "res/img/sword2.bmp"), (20, 20), True),
+    "special": Animation(tuple(f"res/img/special{n}.bmp" for n in range(1, 4)), (10, 10, 10), True),
+    "specialsecond": Animation(tuple(f"res/img/specialsecond{n}.bmp" for n in range(1, 4)), (10, 10, 10), True),
+}
+
+# Define ghost values
+GHOST_ALPHA = 96                        # Opacity of the players replaying earlier visits, out of 255
+GHOST_ATTEMPTS = 3                      # Latest visits of each stage kept as ghosts, besides its best run
+
 # Define RGB color primitives
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 
+# Define images made by swapping colors in the palette of another image, which they share pixels with
+PALETTE_SWAPS = {
+    "res/img/wall2.bmp": ("res/img/wall.bmp", {WHITE: (178, 0, 255)}),     # Walls of stages 10 to 17
+    "res/img/wall3.bmp": ("res/img/wall.bmp", {WHITE: (0, 234, 255)}),     # Walls from stage 18 on
+}
+
 # Define global arrays
 TileArray = []                      # Define array that stores all bounding objects
 HazardArray = []                    # Define array that stores objects dangerous to player
@@ -51,22 +159,296 @@ FinalDoorArray = []
 
 # Definitions for convenience
 vec = pygame.math.Vector2           # Defining simple reference to Vector2
-SK1_COINS = 35
-SK2_COINS = 94
 FINAL_COINS = 158
-has_sk1 = False
-has_sk2 = False
-has_ring = False
-has_sword = False
-has_xcancel = False
-returned = False
+
+# Define game flags tracked by GameState
+GAME_FLAGS = ("has_sk1", "has_sk2", "has_ring", "has_sword", "has_xcancel", "returned")
+
+
+# Holds progress flags and notifies subscribers only when a flag actually changes
+class GameState:
+    def __init__(self):
+        self.flags = {name: False for name in GAME_FLAGS}
+        self.subscribers = {name: [] for name in GAME_FLAGS}
+
+    def __getattr__(self, name):
+        flags = self.__dict__.get("flags", {})
+        if name in flags:
+            return flags[name]
+        raise AttributeError(name)
+
+    def set(self, name, value):
+        if name not in self.flags:
+            raise KeyError(f"Unknown game flag: {name}")
+        value = bool(value)
+        if self.flags[name] == value:           # No event if nothing changed
+            return
+        self.flags[name] = value
+        live = []
+        for ref in self.subscribers[name]:
+            callback = ref()
+            if callback is not None:            # Drop subscribers whose sprite has been garbage collected
+                callback(value)
+                live.append(ref)
+        self.subscribers[name] = live
+
+    def subscribe(self, name, callback):
+        if name not in self.flags:
+            raise KeyError(f"Unknown game flag: {name}")
+        if hasattr(callback, "__self__"):       # Bound methods are held weakly so dead stages can be collected
+            ref = weakref.WeakMethod(callback)
+        else:
+            ref = lambda: callback
+        self.subscribers[name].append(ref)
+        callback(self.flags[name])              # Sync subscriber with current value right away
+
+    def snapshot(self):
+        return dict(self.flags)
+
+    def restore(self, flags):
+        for name, value in flags.items():
+            self.set(name, value)
+
+
+game_state = GameState()
+
+
+# Records timed spans and one-off events into preallocated arrays and writes them as a Chrome trace
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.capacity = 0
+        self.count = 0
+        self.ids = {}                           # Event names are stored once and referred to by number
+        self.names = []
+        self.origin = perf_counter_ns()
+        self.lock = threading.Lock()            # Images are decoded and traced on an io thread too
+
+    def start(self, capacity=TRACE_EVENTS):
+        # Everything is allocated up front so recording never allocates during a frame
+        self.capacity = capacity
+        self.starts = array('q', bytes(8 * capacity))
+        self.durations = array('q', bytes(8 * capacity))   # -1 marks an instant event
+        self.name_ids = array('i', bytes(4 * capacity))
+        self.args = [None] * capacity
+        self.count = 0
+        self.origin = perf_counter_ns()
+        self.enabled = True
+
+    def name_id(self, name):
+        number = self.ids.get(name)
+        if number is None:
+            number = len(self.names)
+            self.ids[name] = number
+            self.names.append(name)
+        return number
+
+    def record(self, name, start, duration, args):
+        with self.lock:
+            slot = self.count % self.capacity
+            self.starts[slot] = start
+            self.durations[slot] = duration
+            self.name_ids[slot] = self.name_id(name)
+            self.args[slot] = args
+            self.count += 1
+
+    def begin(self):
+        if not self.enabled:
+            return 0
+        return perf_counter_ns()
+
+    def end(self, name, start, args=None):
+        if self.enabled:
+            self.record(name, start, perf_counter_ns() - start, args)
+
+    def instant(self, name, args=None):
+        if self.enabled:
+            self.record(name, perf_counter_ns(), -1, args)
+
+    def events(self):
+        first = max(0, self.count - self.capacity)
+        for number in range(first, self.count):
+            slot = number % self.capacity
+            event = {"name": self.names[self.name_ids[slot]], "pid": 1, "tid": 1,
+                     "ts": (self.starts[slot] - self.origin) / 1000}
+            if self.durations[slot] < 0:
+                event["ph"] = "i"
+                event["s"] = "g"
+            else:
+                event["ph"] = "X"
+                event["dur"] = self.durations[slot] / 1000
+            if self.args[slot]:
+                event["args"] = self.args[slot]
+            yield event
+
+    def save(self, filename):
+        with self.lock:
+            events = list(self.events())
+            count = self.count
+        with open(filename, 'w') as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"recorded": count, "dropped": max(0, count - self.capacity)}}, file)
+
+
+tracer = Tracer()                               # Disabled unless the game is started with --trace
+
+
+# Define cache of decoded images shared by every sprite that uses the same file
+IMAGE_CACHE = {}
+image_lock = threading.RLock()              # Held while an image is decoded, preload_images decodes on an io thread
+assets = None                               # Packed asset bundle if one was built, see bundle.py
+
+
+def asset_bundle():
+    global assets
+    if assets is None:
+        assets = open_bundle() or False     # False remembers that there is no bundle to look for
+    return assets
+
+
+def decode_image(filename):
+    if filename in PALETTE_SWAPS:
+        base, colors = PALETTE_SWAPS[filename]
+        return palette_swap(load_image(base), colors)
+    bundle = asset_bundle()
+    if bundle and filename in bundle:
+        return bundle.image(filename)
+    return palettize(pygame.image.load(filename))   # Packed images were palettized when the bundle was built
+
+
+def palette_swap(image, colors):
+    # Recolor of an 8-bit image that shares its pixels, only the palette is its own
+    swapped = image.subsurface(image.get_rect())
+    swapped.set_palette([colors.get(tuple(color[:3]), color) for color in image.get_palette()])
+    return swapped
+
+
+def load_image(filename):
+    image = IMAGE_CACHE.get(filename)
+    if image is None:
+        with image_lock:                    # Reentrant, palette swaps load the image they recolor
+            image = IMAGE_CACHE.get(filename)
+            if image is None:               # Unless preload_images got there first
+                start = tracer.begin()
+                image = decode_image(filename)
+                IMAGE_CACHE[filename] = image
+                tracer.end("load image", start, {"file": filename})
+    return image
+
+
+def preload_images():
+    # Decode every image up front on a background thread, so sprites swapping frames never wait on the disk
+    bundle = asset_bundle()
+    if bundle:
+        filenames = list(bundle.index["images"])
+    else:
+        filenames = sorted(filename.replace(os.sep, "/")
+                           for filename in glob.glob("res/img/*.bmp") + glob.glob("res/img/*.png"))
+    for filename in filenames:
+        load_image(filename)                # One image at a time, so the loop never waits for more than one
+
+
+def load_sound(filename):
+    start = tracer.begin()
+    bundle = asset_bundle()
+    if bundle and filename in bundle:
+        sound = pygame.mixer.Sound(file=bundle.open(filename))
+    else:
+        sound = pygame.mixer.Sound(filename)
+    tracer.end("load sound", start, {"file": filename})
+    return sound
+
+
+def open_asset(filename):
+    bundle = asset_bundle()
+    if bundle and filename in bundle:
+        return bundle.open(filename)
+    return open(filename, 'rb')
+
+
+def asset_location(filename, start=0, size=None):
+    # The file and byte range to read straight from, inside the bundle when it packs the file
+    bundle = asset_bundle()
+    if bundle and filename in bundle:
+        return bundle.location(filename)
+    return filename, start, size
+
+
+def read_text(filename):
+    bundle = asset_bundle()
+    if bundle and filename in bundle:
+        return bundle.read_text(filename)
+    with open(filename, 'r') as file:
+        return file.read()
+
+
+def write_text(filename, text):
+    with open(filename, 'w') as file:
+        file.write(text)
+
+
+# Define cache of collision masks, one per decoded image, so animation frames share theirs like they share pixels
+MASK_CACHE = {}
+
+
+def image_mask(image):
+    mask = MASK_CACHE.get(image)
+    if mask is None:                        # Built once per image, the first time a rect hit needs it
+        mask = MASK_CACHE.setdefault(image, pygame.mask.from_surface(image))
+    return mask
+
+
+def touches_pixels(sprite, hits):
+    # Narrow phase after a rect hit, transparent pixels of either sprite do not count
+    mask = image_mask(sprite.image)
+    for obj in hits:
+        if mask.overlap(image_mask(obj.image), (obj.rect.x - sprite.rect.x, obj.rect.y - sprite.rect.y)):
+            return True
+    return False
+
+
+# One frame counter for every animation, the image each one shows is a function of the counter alone
+class AnimationClock:
+    def __init__(self, animations):
+        self.animations = animations
+        self.tables = {}                        # Frame index for every game frame of one cycle, by animation
+        for name, animation in animations.items():
+            self.tables[name] = [index for index, duration in enumerate(animation.durations) for _ in range(duration)]
+        self.frame = 0
+        self.images = {}                        # Current image by animation, filled as they are drawn
+
+    def image(self, name):
+        image = self.images.get(name)
+        if image is None:
+            animation = self.animations[name]
+            table = self.tables[name]
+            step = self.frame % len(table) if animation.loop else min(self.frame, len(table) - 1)
+            image = self.images[name] = load_image(animation.frames[table[step]])
+        return image
+
+    def tick(self):
+        self.frame += 1
+        self.images.clear()
+
+    def snapshot(self):
+        return self.frame
+
+    def restore(self, frame):
+        self.frame = frame
+        self.images.clear()
+
+
+animation_clock = AnimationClock(ANIMATIONS)
 
 
 # Overriding sprite class to make other classes more atomic
 class Sprite(pygame.sprite.Sprite):
+    static = False                      # Static sprites never move, animate or die and are baked into the stage layer
+    tile_center = (8, 8)                # Where load_stage centres the sprite within its tile
+
     def __init__(self, image, spawn_x, spawn_y):
         super().__init__()
-        self.image = pygame.image.load(image)
+        self.image = load_image(image)              # Shared surface, sprites swap images but never draw into them
         self.rect = self.image.get_rect()
         self.rect.center = [spawn_x, spawn_y]
         self.num_jumps = 0
@@ -79,24 +461,28 @@ class Sprite(pygame.sprite.Sprite):
 
 
 class Player(Sprite):
-    def __init__(self, spawn_x, spawn_y):
+    def __init__(self, spawn_x, spawn_y, bounds=None):
         super().__init__("res/img/player.bmp", spawn_x, spawn_y)
+        if bounds is None:                  # Area the player is kept inside, one screen unless the stage is larger
+            bounds = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.bounds = bounds
         self.pos = vec((spawn_x, spawn_y))
         self.vel = vec((0, 0))
         self.acc = vec((0, 0))
         self.air = 0                    # Manual frame timer for forgiving jump mechanic [see: JUMP_WINDOW]
 
-    def move(self):
+    def move(self, keys=None):
         self.acc = vec(0, GRAV)
 
         # Check for LEFT / RIGHT key presses
-        keys = pygame.key.get_pressed()
+        if keys is None:
+            keys = pygame.key.get_pressed()
         if keys[K_LEFT]:
             self.acc.x = -ACC
         if keys[K_RIGHT]:
             self.acc.x = ACC
         if keys[K_DOWN]:
-            if has_xcancel:
+            if game_state.has_xcancel:
                 self.vel.x = 0
 
         # Handle movement and gravity
@@ -106,12 +492,12 @@ class Player(Sprite):
         self.pos.y += self.vel.y + 0.5 * self.acc.y
 
         # Handle bounds checking and screen wrap
-        if self.pos.x + 24 > SCREEN_WIDTH:
-            self.pos.x = SCREEN_WIDTH - 24
-        if self.pos.x < 24:
-            self.pos.x = 24
-        if self.pos.y < 32:
-            self.pos.y = 32
+        if self.pos.x + 24 > self.bounds.right:
+            self.pos.x = self.bounds.right - 24
+        if self.pos.x < self.bounds.left + 24:
+            self.pos.x = self.bounds.left + 24
+        if self.pos.y < self.bounds.top + 32:
+            self.pos.y = self.bounds.top + 32
             self.vel.y = 0
 
         # Ensure rect is synced with player pos
@@ -129,10 +515,10 @@ class Player(Sprite):
                 self.vel.y = JUMP_MIN
 
     def update(self, obstacles, hazards, stage_exit, collectibles, respawn_point,
-               spikes, slow, keys, skeys, sdoors, chests, returns, rings, swords, fdoors):
+               spikes, slow, keys, skeys, sdoors, chests, returns, rings, swords, fdoors, pressed=None):
         if self.vel.y > MAX_FALL_SPEED:
             self.vel.y = MAX_FALL_SPEED
-        self.move()
+        self.move(pressed)
         on_ground = False
 
         # Handle jumping vertical collision detection
@@ -147,8 +533,8 @@ class Player(Sprite):
         if not on_ground:                                       # Add to airtime frame counter
             self.air += 1
 
-        hazard_hit = pygame.sprite.spritecollideany(self, hazards)
-        if hazard_hit:
+        hazard_hit = pygame.sprite.spritecollideany(self, hazards)     # Rects first, pixels only after a rect hit
+        if hazard_hit and touches_pixels(self, pygame.sprite.spritecollide(self, hazards, False)):
             return 1
 
         exit_hit = pygame.sprite.spritecollideany(self, stage_exit)
@@ -165,7 +551,7 @@ class Player(Sprite):
 
         spike_hit = pygame.sprite.spritecollide(self, spikes, False)
         if self.vel.y > 0:
-            if spike_hit:
+            if spike_hit and touches_pixels(self, spike_hit):
                 return 1
 
         slow_hit = pygame.sprite.spritecollide(self, slow, False)
@@ -201,138 +587,77 @@ class Player(Sprite):
             return 12
 
         fdoor_hit = pygame.sprite.spritecollide(self, fdoors, False)
-        if fdoor_hit and has_sword:
+        if fdoor_hit and game_state.has_sword:
             return 13
 
         return 0
 
 
+# Sprite showing its animation's current image, so every sprite of a type shares one surface and needs no update
+class AnimatedSprite(Sprite):
+    animation = None                    # Name in ANIMATIONS
+
+    def __init__(self, spawn_x, spawn_y):
+        pygame.sprite.Sprite.__init__(self)
+        self.rect = load_image(ANIMATIONS[self.animation].frames[0]).get_rect()
+        self.rect.center = [spawn_x, spawn_y]
+        self.num_jumps = 0
+
+    @property
+    def image(self):
+        return animation_clock.image(self.animation)
+
+
 class Wall(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/wall.bmp", spawn_x, spawn_y)
 
 
 class Wall2(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/wall2.bmp", spawn_x, spawn_y)
 
 
 class Wall3(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/wall3.bmp", spawn_x, spawn_y)
 
 
 class Platform(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/platform.bmp", spawn_x, spawn_y)
+    static = True
 
-
-class BadLeaf(Sprite):
     def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/badleaf.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
+        super().__init__("res/img/platform.bmp", spawn_x, spawn_y)
 
-    def update(self):
-        self.frame_timer += 1                   # Simple animation by swapping image every 30 frames
-        if self.frame_timer == 30:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker % 2 == 0:
-                self.image = pygame.image.load("res/img/badleaf.bmp")
-            if self.ticker % 2 == 1:
-                self.image = pygame.image.load("res/img/badleaf2.bmp")
 
-            if self.ticker == 1000:             # Lazy insurance against overflow exception
-                self.ticker = 0
+class BadLeaf(AnimatedSprite):
+    animation = "badleaf"
 
 
-class Exit(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/exit.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
+class Exit(AnimatedSprite):
+    animation = "exit"
 
-    def update(self):
-        self.frame_timer += 1                   # Simple animation by swapping image every 15 frames
-        if self.frame_timer == 30:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker == 1:
-                self.image = pygame.image.load("res/img/exit.bmp")
-            if self.ticker == 8:
-                self.image = pygame.image.load("res/img/exit2.bmp")
-                self.ticker = 0
-
-
-class Coin(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/coin1.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
 
-    def update(self):
-        self.frame_timer += 1                         # Simple animation by swapping image every 5 frames
-        if self.frame_timer == 5:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker > 4: self.ticker = 1
-            self.image = pygame.image.load(f"res/img/coin{self.ticker}.bmp")
+class Coin(AnimatedSprite):
+    animation = "coin"
 
 
-class Respawn(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/respawn1.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
-
-    def update(self):
-        self.frame_timer += 1                        # Simple animation by swapping image every 10 frames
-        if self.frame_timer == 10:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker > 4: self.ticker = 1
-            self.image = pygame.image.load(f"res/img/respawn{self.ticker}.bmp")
+class Respawn(AnimatedSprite):
+    animation = "respawn"
 
 
-class Grass(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/grass.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
+class Grass(AnimatedSprite):
+    animation = "grass"
 
-    def update(self):
-        self.frame_timer += 1                       # Simple animation by swapping image every 15 frames
-        if self.frame_timer == 15:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker % 2 == 0:
-                self.image = pygame.image.load("res/img/grass.bmp")
-            if self.ticker % 2 == 1:
-                self.image = pygame.image.load("res/img/grass2.bmp")
 
-            if self.ticker == 1000:                 # Lazy insurance against overflow exception
-                self.ticker = 0
-
-
-class Bush(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/bush.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
-
-    def update(self):
-        self.frame_timer += 1                       # Simple animation by swapping image every 30 frames
-        if self.frame_timer == 30:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker % 2 == 0:
-                self.image = pygame.image.load("res/img/bush.bmp")
-            if self.ticker % 2 == 1:
-                self.image = pygame.image.load("res/img/bush2.bmp")
-
-            if self.ticker == 1000:                 # Lazy insurance against overflow exception
-                self.ticker = 0
+class Bush(AnimatedSprite):
+    animation = "bush"
 
 
 class Spike(Sprite):
@@ -340,107 +665,42 @@ class Spike(Sprite):
         super().__init__("res/img/spike2.bmp", spawn_x, spawn_y)
 
 
-class LockLeaf(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/lockleaf.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
-
-    def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 30 frames
-        if self.frame_timer == 30:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker % 2 == 0:
-                self.image = pygame.image.load("res/img/lockleaf.bmp")
-            if self.ticker % 2 == 1:
-                self.image = pygame.image.load("res/img/lockleaf2.bmp")
+class LockLeaf(AnimatedSprite):
+    animation = "lockleaf"
 
-            if self.ticker == 1000:  # Lazy insurance against overflow exception
-                self.ticker = 0
 
+class Lock(AnimatedSprite):
+    animation = "lock"
 
-class Lock(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/lock.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
 
-    def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 30 frames
-        if self.frame_timer == 30:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker % 2 == 0:
-                self.image = pygame.image.load("res/img/lock.bmp")
-            if self.ticker % 2 == 1:
-                self.image = pygame.image.load("res/img/lock2.bmp")
-
-            if self.ticker == 1000:  # Lazy insurance against overflow exception
-                self.ticker = 0
-
-
-class Key(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/key1.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
-
-    def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 10 frames
-        if self.frame_timer == 10:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker > 5: self.ticker = 1
-            self.image = pygame.image.load(f"res/img/key{self.ticker}.bmp")
+class Key(AnimatedSprite):
+    animation = "key"
 
 
 class SecretDoor(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/secretdoorclosed.bmp", spawn_x, spawn_y)
-
-    def update(self):
-        if has_sk1:
-            self.image = pygame.image.load("res/img/secretdooropen.bmp")
-
+    flag = "has_sk1"
 
-class SecretDoor2(Sprite):
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/secretdoorclosed.bmp", spawn_x, spawn_y)
+        self.closed_image = self.image
+        self.open_image = load_image("res/img/secretdooropen.bmp")
+        game_state.subscribe(self.flag, self.on_flag)    # Swap image once when key flag flips
 
-    def update(self):
-        if has_sk2:
-            self.image = pygame.image.load("res/img/secretdooropen.bmp")
+    def on_flag(self, value):
+        self.image = self.open_image if value else self.closed_image
 
 
-class SpecialKey(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/specialkey1.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
+class SecretDoor2(SecretDoor):
+    flag = "has_sk2"
 
-    def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 10 frames
-        if self.frame_timer == 10:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker > 4: self.ticker = 1
-            self.image = pygame.image.load(f"res/img/specialkey{self.ticker}.bmp")
 
+class SpecialKey(AnimatedSprite):
+    animation = "specialkey"
+    flag = "has_sk1"                    # Set when picked up, opens the secret doors of the same key
 
-class SpecialKey2(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/specialkey1.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
 
-    def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 10 frames
-        if self.frame_timer == 10:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker > 4: self.ticker = 1
-            self.image = pygame.image.load(f"res/img/specialkey{self.ticker}.bmp")
+class SpecialKey2(SpecialKey):
+    flag = "has_sk2"
 
 
 class Chest(Sprite):
@@ -448,27 +708,42 @@ class Chest(Sprite):
         super().__init__("res/img/chest.bmp", spawn_x, spawn_y)
 
 
+# Define stage looks, picked by each stage's campaign entry instead of its number
+WALLS = (Wall, Wall2, Wall3)                # Wall class by theme, starting at 1
+SPECIAL_KEY_SPRITES = {1: (SpecialKey, SecretDoor), 2: (SpecialKey2, SecretDoor2)}     # By special_key
+
+
 class Tombstone(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/rip.bmp", spawn_x, spawn_y)
 
 
 class BrokenTombstone(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/broken.bmp", spawn_x, spawn_y)
 
 
 class Guts(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/guts.bmp", spawn_x, spawn_y)
 
 
 class ReturnDoor(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/returndoor.bmp", spawn_x, spawn_y)
 
 
 class SWall(Sprite):
+    static = True
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/swall.bmp", spawn_x, spawn_y)
 
@@ -479,12 +754,18 @@ class FloatingPlatform(Sprite):
         self.x = spawn_x
         self.y = spawn_y
         self.speed = 2
+        self.spawn_rect = self.rect.copy()
+        self.left = spawn_x // SCREEN_WIDTH * SCREEN_WIDTH      # Bounce within the screen it was placed on
+
+    def reset(self):
+        self.rect = self.spawn_rect.copy()
+        self.speed = 2
 
     def update(self):
         self.rect.x += self.speed
-        if self.rect.x < 32:
+        if self.rect.x < self.left + 32:
             self.speed *= -1
-        if self.rect.x > SCREEN_WIDTH - 48:
+        if self.rect.x > self.left + SCREEN_WIDTH - 48:
             self.speed *= -1
 
 
@@ -492,101 +773,83 @@ class EyeEnemy(Sprite):
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/eye.bmp", spawn_x, spawn_y)
         self.speed = 3
+        self.spawn_rect = self.rect.copy()
+        self.top = spawn_y // SCREEN_HEIGHT * SCREEN_HEIGHT     # Wrap within the screen it was placed on
+
+    def reset(self):
+        self.rect = self.spawn_rect.copy()
 
     def update(self):
         self.rect.y += self.speed
-        if self.rect.y > SCREEN_HEIGHT - 32:
-            self.rect.y = SCREEN_HEIGHT / 2
+        if self.rect.y > self.top + SCREEN_HEIGHT - 32:
+            self.rect.y = self.top + SCREEN_HEIGHT / 2
 
 
 class EyeEnemyInvert(Sprite):
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/eye.bmp", spawn_x, spawn_y)
         self.speed = 3
+        self.spawn_rect = self.rect.copy()
+        self.top = spawn_y // SCREEN_HEIGHT * SCREEN_HEIGHT
 
-    def update(self):
-        self.rect.y -= self.speed
-        if self.rect.y < 16:
-            self.rect.y = SCREEN_HEIGHT - 32
-
-
-class Ring(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/ring1.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
+    def reset(self):
+        self.rect = self.spawn_rect.copy()
 
     def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 10 frames
-        if self.frame_timer == 10:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker > 3: self.ticker = 1
-            self.image = pygame.image.load(f"res/img/ring{self.ticker}.bmp")
+        self.rect.y -= self.speed
+        if self.rect.y < self.top + 16:
+            self.rect.y = self.top + SCREEN_HEIGHT - 32
 
 
-class Sword(Sprite):
-    def __init__(self, spawn_x, spawn_y):
-        super().__init__("res/img/sword.bmp", spawn_x, spawn_y)
-        self.frame_timer = 0
-        self.ticker = 0
+class Ring(AnimatedSprite):
+    animation = "ring"
 
-    def update(self):
-        self.frame_timer += 1  # Simple animation by swapping image every 20 frames
-        if self.frame_timer == 20:
-            self.frame_timer = 0
-            self.ticker += 1
-            if self.ticker % 2 == 0:
-                self.image = pygame.image.load("res/img/sword.bmp")
-            if self.ticker % 2 == 1:
-                self.image = pygame.image.load("res/img/sword2.bmp")
 
-            if self.ticker == 1000:  # Lazy insurance against overflow exception
-                self.ticker = 0
+class Sword(AnimatedSprite):
+    animation = "sword"
 
 
 class FinalDoor(Sprite):
+    tile_center = (16, 24)
+
     def __init__(self, spawn_x, spawn_y):
         super().__init__("res/img/fdoorclosed.bmp", spawn_x, spawn_y)
+        self.closed_image = self.image
+        self.open_image = load_image("res/img/fdoor3.bmp")
+        game_state.subscribe("has_sword", self.on_flag)
 
-    def update(self):
-        if has_sword:
-            self.image = pygame.image.load("res/img/fdoor3.bmp")
-
-def load_names():
-    with open("res/levels/names.json") as json_file:
-        data = json.load(json_file)
-    return data
+    def on_flag(self, value):
+        self.image = self.open_image if value else self.closed_image
 
 
 def load_stage(filename, obstacles, hazards, stage_exit, collectibles, respawn,
                spikes, slow, decorative, locks, lockleafs, keys, skeys, sdoors,
                tombstones, chests, returns, floats, coins, current_stage, rings,
-               swords, fdoors):
-    with open(filename, 'r') as file:               # Open specified text file
-        stage = file.read()
-    x_count = 0                                     # Create coordinates to traverse screen
-    y_count = 0
+               swords, fdoors, text=None, origin=(0, 0), key_coins=None):
+    if text is None:
+        stage = read_text(filename)                 # Open specified text file
+    else:
+        stage = text                                # Already read, e.g. one chunk of a large level
+    info = levels.info(current_stage)
+    wall_class = WALLS[info["theme"] - 1]
+    skey_class, sdoor_class = SPECIAL_KEY_SPRITES[info["special_key"]]
+    x_count = origin[0]                             # Create coordinates to traverse screen
+    y_count = origin[1]
     x_pos_str = stage[0:3]
     y_pos_str = stage[3:6]
-    global returned
     if stage[7] == 'x':
         return vec(-1, -1)
     else:
         for tile in stage[7:]:                              # Step through file and interpret delimiters
             if tile == ',':
                 x_count += 16
-                if x_count >= SCREEN_WIDTH:
-                    x_count = 0
+                if x_count - origin[0] >= SCREEN_WIDTH:
+                    x_count = origin[0]
             if tile == '\n':
+                x_count = origin[0]
                 y_count += 16
             if tile == '1':                             # Create wall at current (x,y) location
-                if current_stage < 10:
-                    new_wall = Wall(x_count + 8, y_count + 8)
-                elif current_stage < 18:
-                    new_wall = Wall2(x_count + 8, y_count + 8)
-                else:
-                    new_wall = Wall3(x_count + 8, y_count + 8)
+                new_wall = wall_class(x_count + 8, y_count + 8)
                 obstacles.append(new_wall)
             if tile == '2':                             # Create platform at current (x,y) location
                 new_platform = Platform(x_count + 8, y_count + 8)
@@ -597,7 +860,7 @@ def load_stage(filename, obstacles, hazards, stage_exit, collectibles, respawn,
             if tile == '4':                             # Create stage exit at current (x,y) location
                 new_exit = Exit(x_count + 8, y_count + 8)
                 stage_exit.append(new_exit)
-            if tile == '5' and not returned:                             # Create coin at current (x,y) location
+            if tile == '5' and not game_state.returned:                             # Create coin at current (x,y) location
                 new_coin = Coin(x_count + 8, y_count + 8)
                 collectibles.append(new_coin)
             if tile == '6':                             # Create respawn point at current (x,y) location
@@ -621,20 +884,12 @@ def load_stage(filename, obstacles, hazards, stage_exit, collectibles, respawn,
             if tile == 'K':
                 new_key = Key(x_count + 8, y_count + 8)
                 keys.append(new_key)
-            if tile == 's':
-                if current_stage == 6 and coins >= SK1_COINS:
-                    new_skey = SpecialKey(x_count + 8, y_count + 8)
-                    skeys.append(new_skey)
-                if current_stage > 6 and coins >= SK2_COINS:
-                    new_skey = SpecialKey2(x_count + 8, y_count + 8)
-                    skeys.append(new_skey)
+            if tile == 's' and key_coins is not None and coins >= key_coins:     # Only with enough coins
+                new_skey = skey_class(x_count + 8, y_count + 8)
+                skeys.append(new_skey)
             if tile == 'D':
-                if current_stage == 7:
-                    new_sdoor = SecretDoor(x_count + 8, y_count + 8)
-                    sdoors.append(new_sdoor)
-                if current_stage > 7:
-                    new_sdoor = SecretDoor2(x_count + 8, y_count + 8)
-                    sdoors.append(new_sdoor)
+                new_sdoor = sdoor_class(x_count + 8, y_count + 8)
+                sdoors.append(new_sdoor)
             if tile == 'r':
                 new_rip = Tombstone(x_count + 8, y_count + 8)
                 tombstones.append(new_rip)
@@ -666,7 +921,7 @@ def load_stage(filename, obstacles, hazards, stage_exit, collectibles, respawn,
                 new_brip = BrokenTombstone(x_count + 8, y_count + 8)
                 tombstones.append(new_brip)
             if tile == 'S':
-                if has_ring:
+                if game_state.has_ring:
                     new_sword = Sword(x_count + 8, y_count + 8)
                     swords.append(new_sword)
             if tile == 'f':
@@ -675,18 +930,1525 @@ def load_stage(filename, obstacles, hazards, stage_exit, collectibles, respawn,
         return vec(int(x_pos_str), int(y_pos_str))
 
 
-def main():
+# Define arrays filled by load_stage, in the order a stage adds them
+LOAD_ARRAYS = (TileArray, HazardArray, StageExitArray, CollectibleArray, RespawnPointArray, SpikeArray,
+               SlowArray, DecorativeArray, LockArray, LockLeafArray, KeyArray, SpecialKeyArray,
+               SecretDoorArray, TombstoneArray, ChestArray, ReturnArray, FloatArray, RingArray,
+               SwordArray, FinalDoorArray)
+
+# Define groups updated every frame, in order, with the name of their trace span
+# Only moving sprites update, animations follow animation_clock
+UPDATE_GROUPS = tuple((name, f"update {name}") for name in ("hazards", "floats"))
+
+# Define names of the sprite groups owned by a stage
+STAGE_GROUPS = ("sprites", "obstacles", "hazards", "stage_exit", "collectibles", "respawn_point",
+                "spikes", "slow", "decorative", "lockleafs", "keys", "skeys", "sdoors", "chests",
+                "returns", "floats", "rings", "swords", "fdoors")
+
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+def image_bytes(surface):
+    if surface.get_parent() is not None:        # Bundled images share their pixels with a sprite sheet
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+    return surface_bytes(surface)
+
+
+def sound_bytes(sound):
+    frequency, size, channels = pygame.mixer.get_init()
+    return round(sound.get_length() * frequency) * channels * abs(size) // 8
+
+
+def is_large_level(filename):
+    # Large levels have an "x,y" spawn header in pixels instead of the fixed six digit one
+    with open_asset(filename) as file:
+        return b',' in file.readline()
+
+
+# Stages kept as loose level files, routed by the campaign description that lists them
+class LooseLevels:
+    def __init__(self, filename):
+        self.start, stages = parse_campaign(read_text(filename), filename)
+        self.stages_by_id = {stage["id"]: stage for stage in stages}
+
+    def __len__(self):
+        return len(self.stages_by_id)
+
+    def __contains__(self, stage):
+        return stage in self.stages_by_id
+
+    def info(self, stage):
+        return self.stages_by_id[stage]
+
+    def stages(self):
+        return iter(sorted(self.stages_by_id))
+
+    def location(self, stage):
+        return self.stages_by_id[stage]["file"], 0, None    # Whole file
+
+    def text(self, stage):
+        return read_text(self.stages_by_id[stage]["file"])
+
+    def is_large(self, stage):
+        return is_large_level(self.stages_by_id[stage]["file"])
+
+
+levels = None                               # Where stages come from, see open_levels
+
+
+def open_levels(filename=None, loose=False):
+    # The pack asked for, else the built one unless the loose files are being edited, else the loose files
+    global levels
+    if filename:
+        levels = LevelPack(filename)
+    else:
+        levels = (None if loose else open_pack(PACK_PATH)) or LooseLevels(CAMPAIGN_PATH)
+    return levels
+
+
+level_texts = {}                            # Level text read ahead of time by prefetch_level, by stage
+
+
+def prefetch_level(number):
+    # Read a stage the player can go to next on a background thread, so building it does not wait on the disk
+    if number not in level_texts and not levels.is_large(number):    # Large levels stream their chunks anyway
+        level_texts[number] = levels.text(number)
+
+
+def level_cells(text):
+    # Tile characters by the top left corner of the cell load_stage builds them in
+    cells = {}
+    x_count = 0
+    y_count = 0
+    for tile in text[7:]:
+        if tile == ',':
+            x_count += TILE_SIZE
+            if x_count >= SCREEN_WIDTH:
+                x_count = 0
+        elif tile == '\n':
+            x_count = 0
+            y_count += TILE_SIZE
+        else:
+            cells[(x_count, y_count)] = cells.get((x_count, y_count), '') + tile
+    return cells
+
+
+def tile_of(obj):
+    rect = getattr(obj, "spawn_rect", obj.rect)     # Moving sprites remember where they were built
+    return rect.centerx - obj.tile_center[0], rect.centery - obj.tile_center[1]
+
+
+# Fully built stage holding its sprite groups, spawn points and a pre-rendered layer of static tiles
+class Stage:
+    def __init__(self, number, coins):
+        self.number = number
+        self.coins = coins
+        self.key_coins = levels.info(number)["key_coins"]
+        self.filename = levels.location(number)[0]
+        for name in STAGE_GROUPS:
+            setattr(self, name, pygame.sprite.Group())
+        self.respawn = None
+        self.unlocked = False
+        self.bounds = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        start = tracer.begin()
+        self.text = level_texts.pop(number, None) or levels.text(number)     # Kept to diff edits against
+        self.spawn = load_stage(self.filename,
+                                TileArray, HazardArray, StageExitArray,
+                                CollectibleArray, RespawnPointArray,
+                                SpikeArray, SlowArray, DecorativeArray,
+                                LockArray, LockLeafArray, KeyArray,
+                                SpecialKeyArray, SecretDoorArray,
+                                TombstoneArray, ChestArray, ReturnArray,
+                                FloatArray, coins, number, RingArray,
+                                SwordArray, FinalDoorArray, text=self.text, key_coins=self.key_coins)
+        tracer.end("load_stage", start, {"stage": number})
+        self.game_over = self.spawn == vec(-1, -1)
+        self.coins_removed = game_state.returned
+        self.complete = not self.coins_removed      # Stages built on return are missing their coins
+
+        for obj in RespawnPointArray:               # Stage respawn point if one exists
+            self.respawn = vec(obj.rect.x + 8, obj.rect.y - 8)
+        self.add_loaded()
+        self.layer = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+        self.layer.fill((0, 0, 0, 0))               # Transparent so special stage backgrounds show through
+        self.static_sprites = self.bake_static(self.sprites.sprites(), self.layer, (0, 0))
+
+        self.members = {name: list(getattr(self, name)) for name in STAGE_GROUPS}
+
+    def add_loaded(self):
+        # Move everything load_stage created into this stage's groups, in the order it is drawn
+        self.add(TileArray, "obstacles")
+        self.add(HazardArray, "hazards")
+        self.add(StageExitArray, "stage_exit")
+        self.add(CollectibleArray, "collectibles")
+        self.add(RespawnPointArray, "respawn_point")
+        self.add(SpikeArray, "spikes")
+        self.add(SlowArray, "slow")
+        self.add(DecorativeArray, "decorative")
+        self.add(LockArray, "lockleafs", "hazards")
+        self.add(LockLeafArray, "lockleafs", "hazards")
+        self.add(KeyArray, "keys")
+        self.add(SpecialKeyArray, "skeys")
+        self.add(SecretDoorArray, "sdoors")
+        self.add(TombstoneArray, "decorative")
+        self.add(ChestArray, "chests")
+        self.add(ReturnArray, "returns")
+        self.add(FloatArray, "floats", "obstacles")
+        self.add(RingArray, "rings")
+        self.add(SwordArray, "swords")
+        self.add(FinalDoorArray, "fdoors")
+
+    def add(self, array, *group_names):
+        for obj in array:
+            for name in group_names:
+                getattr(self, name).add(obj)
+            self.sprites.add(obj)
+        array.clear()                               # Clear array used for loading for next cycle
+
+    def bake_static(self, sprites, layer, origin):
+        # Static sprites go into the layer unless something drawn before them overlaps, which would change the result
+        baked = []
+        drawn = []
+        for obj in sprites:
+            if obj.static and obj.rect.collidelist(drawn) == -1:
+                layer.blit(obj.image, obj.rect.move(-origin[0], -origin[1]))
+                self.sprites.remove(obj)
+                baked.append(obj)
+            else:
+                drawn.append(obj.rect)
+        return baked
+
+    def stream(self, view):
+        pass                                        # Classic stages are fully built up front
+
+    def draw(self, screen, camera):
+        screen.blit(self.layer, (0, 0))             # Render pre-rendered static tiles
+        for obj in self.sprites:                    # Render all other game objects
+            obj.draw(screen)
+
+    def keys_remaining(self):
+        return len(self.keys)
+
+    def unlock(self):
+        self.unlocked = True                        # Also keeps locks out of tiles built later
+        for leaf in self.lockleafs:
+            leaf.kill()
+
+    def reload(self):
+        # Rebuild only the tiles that differ from the text the stage was built from, everything else stays as it is
+        with open(self.filename, 'r') as file:
+            text = file.read()
+        if text == self.text or not text[0:6].isdigit() or text[7:8] == 'x':     # Unchanged or saved half way
+            return False
+        start = tracer.begin()
+        old_cells = level_cells(self.text)
+        new_cells = level_cells(text)
+        changed = {cell for cell in old_cells.keys() | new_cells.keys() if old_cells.get(cell) != new_cells.get(cell)}
+        self.text = text
+        self.spawn = vec(int(text[0:3]), int(text[3:6]))
+
+        built = set(self.static_sprites)
+        for members in self.members.values():
+            built.update(members)
+        removed = {obj for obj in built if tile_of(obj) in changed}
+        for obj in removed:
+            obj.kill()
+        added = []
+        for cell in changed:
+            if cell not in new_cells:
+                continue
+            load_stage(self.filename,
+                       TileArray, HazardArray, StageExitArray,
+                       CollectibleArray, RespawnPointArray,
+                       SpikeArray, SlowArray, DecorativeArray,
+                       LockArray, LockLeafArray, KeyArray,
+                       SpecialKeyArray, SecretDoorArray,
+                       TombstoneArray, ChestArray, ReturnArray,
+                       FloatArray, self.coins, self.number, RingArray,
+                       SwordArray, FinalDoorArray,
+                       text="000000\n" + new_cells[cell], origin=cell, key_coins=self.key_coins)
+            for array in LOAD_ARRAYS:               # Same rules as the rest of the stage was built with
+                array[:] = [obj for obj in array
+                            if not (self.unlocked and isinstance(obj, (Lock, LockLeaf)))
+                            and not (not self.complete and isinstance(obj, Coin))]
+                added.extend(array)
+            self.add_loaded()
+
+        self.static_sprites = [obj for obj in self.static_sprites if obj not in removed]
+        self.layer.fill((0, 0, 0, 0))               # Baked tiles can't be taken out, so the layer is drawn again
+        for obj in self.static_sprites:
+            self.layer.blit(obj.image, obj.rect)
+        self.static_sprites += self.bake_static(self.sprites.sprites(), self.layer, (0, 0))   # New ones are last
+        for name in STAGE_GROUPS:
+            group = getattr(self, name)
+            self.members[name] = [obj for obj in self.members[name] if obj not in removed] + \
+                                 [obj for obj in added if group.has(obj)]
+        self.respawn = None
+        for obj in sorted(self.members["respawn_point"], key=lambda obj: tile_of(obj)[::-1]):
+            self.respawn = vec(obj.rect.x + 8, obj.rect.y - 8)      # The last one in the file wins
+        tracer.end("reload level", start, {"stage": self.number, "tiles": len(changed)})
+        return True
+
+    def progress(self):
+        # Sprites collected or destroyed so far, by kind and tile
+        return tuple((type(obj).__name__, *tile_of(obj)) for obj in self.members["sprites"] if not obj.alive())
+
+    def restore_progress(self, removed, unlocked):
+        removed = set(removed)
+        for obj in self.members["sprites"]:
+            if (type(obj).__name__, *tile_of(obj)) in removed:
+                obj.kill()
+        if unlocked:
+            self.unlock()
+
+    def reset(self, returned):
+        # Put every sprite back the way it was built, since the last visit may have killed or moved some
+        self.unlocked = False
+        self.coins_removed = returned
+        for name in STAGE_GROUPS:
+            group = getattr(self, name)
+            group.empty()
+            group.add(*self.members[name])
+        for obj in self.members["sprites"]:
+            if hasattr(obj, "reset"):
+                obj.reset()
+        if returned:                                # Coins disappear while the player is in a special stage
+            for obj in self.members["collectibles"]:
+                obj.kill()
+
+    def estimate_size(self):
+        return sprites_size(self.owned_sprites(), [self.layer])
+
+    def owned_sprites(self):
+        sprites = set(self.static_sprites)
+        for members in self.members.values():
+            sprites.update(members)
+        return sprites
+
+    def owned_surfaces(self):
+        return [("layer", self.layer)]
+
+
+def sprites_size(sprites, surfaces):
+    unique = {id(surface): surface for surface in surfaces}
+    for obj in sprites:
+        for value in vars(obj).values():
+            if isinstance(value, pygame.Surface):
+                unique[id(value)] = value
+    return (sum(surface_bytes(surface) for surface in unique.values())
+            + len(sprites) * SPRITE_OVERHEAD_BYTES)
+
+
+# Part of a large level that is instantiated while it is near the camera
+class Chunk:
+    def __init__(self, rect):
+        self.rect = rect
+        self.sprites = []
+        self.layer = pygame.Surface(rect.size, pygame.SRCALPHA)
+        self.layer.fill((0, 0, 0, 0))
+
+
+# Level many screens in size, indexed up front and instantiated chunk by chunk around the camera
+class LargeStage(Stage):
+    def __init__(self, number, coins):
+        self.number = number
+        self.coins = coins
+        self.key_coins = levels.info(number)["key_coins"]
+        self.filename, start, size = levels.location(number)                 # The level may sit inside a pack
+        self.source, self.start, self.size = asset_location(self.filename, start, size)     # Or in the bundle
+        for name in STAGE_GROUPS:
+            setattr(self, name, pygame.sprite.Group())
+        self.chunks = {}                            # Loaded chunks by (column, row)
+        self.removed = set()                        # Sprites collected or destroyed in chunks that were released
+        self.unlocked = False
+        self.coins_removed = game_state.returned
+        self.game_over = False
+        self.complete = True                        # Coins are dropped per chunk, so returning does not matter
+        self.index_level()
+        self.bounds = pygame.Rect(0, 0, self.cols * TILE_SIZE, len(self.row_offsets) * TILE_SIZE)
+
+    def index_level(self):
+        # Record where every tile row starts so chunks can be read without parsing the rest of the file
+        self.row_offsets = []
+        self.total_keys = 0
+        self.respawn = None
+        with open(self.source, 'rb') as file:
+            self.mtime = os.fstat(file.fileno()).st_mtime_ns
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.end = len(data) if self.size is None else self.start + self.size
+                header_end = data.find(b'\n', self.start, self.end)
+                x_pos, y_pos = data[self.start:header_end].split(b',')
+                self.spawn = vec(int(x_pos), int(y_pos))
+                offset = header_end + 1
+                while offset < self.end and data[offset:offset + 1] not in (b'\n', b'\r'):
+                    self.row_offsets.append(offset)
+                    offset = data.find(b'\n', offset, self.end)
+                    if offset == -1:
+                        break
+                    offset += 1
+                first_end = data.find(b'\n', self.row_offsets[0], self.end)
+                if first_end == -1:
+                    first_end = self.end
+                self.cols = (len(data[self.row_offsets[0]:first_end].rstrip()) + 1) // 2
+                for block in range(header_end, self.end, 1 << 20):
+                    self.total_keys += data[block:min(block + (1 << 20), self.end)].count(b'K')
+                last_respawn = data.rfind(b'6', header_end, self.end)
+                if last_respawn != -1:                  # Same rule as classic stages: the last respawn point wins
+                    row = 0
+                    while row + 1 < len(self.row_offsets) and self.row_offsets[row + 1] <= last_respawn:
+                        row += 1
+                    col = (last_respawn - self.row_offsets[row]) // 2
+                    self.respawn = vec(col * TILE_SIZE + 8, row * TILE_SIZE - 8)
+
+    def chunk_rect(self, key):
+        width = CHUNK_COLS * TILE_SIZE
+        height = CHUNK_ROWS * TILE_SIZE
+        return pygame.Rect(key[0] * width, key[1] * height, width, height)
+
+    def chunk_keys(self, area):
+        area = area.clip(self.bounds)
+        if not area.width or not area.height:
+            return []
+        width = CHUNK_COLS * TILE_SIZE
+        height = CHUNK_ROWS * TILE_SIZE
+        return [(col, row)
+                for row in range(area.top // height, (area.bottom - 1) // height + 1)
+                for col in range(area.left // width, (area.right - 1) // width + 1)]
+
+    def load_chunk(self, key):
+        start = tracer.begin()
+        rect = self.chunk_rect(key)
+        first_row = key[1] * CHUNK_ROWS
+        rows = []
+        with open(self.source, 'rb') as file:
+            for offset in self.row_offsets[first_row:first_row + CHUNK_ROWS]:
+                file.seek(offset + key[0] * CHUNK_COLS * 2)
+                rows.append(file.read(max(0, min(CHUNK_COLS * 2, self.end - file.tell()))).decode().split('\n')[0])
+        load_stage(self.filename,
+                   TileArray, HazardArray, StageExitArray,
+                   CollectibleArray, RespawnPointArray,
+                   SpikeArray, SlowArray, DecorativeArray,
+                   LockArray, LockLeafArray, KeyArray,
+                   SpecialKeyArray, SecretDoorArray,
+                   TombstoneArray, ChestArray, ReturnArray,
+                   FloatArray, self.coins, self.number, RingArray,
+                   SwordArray, FinalDoorArray,
+                   text="000000\n" + "\n".join(rows), origin=rect.topleft, key_coins=self.key_coins)
+
+        chunk = Chunk(rect)
+        for array in LOAD_ARRAYS:                   # Skip whatever was already taken before the chunk was released
+            kept = []
+            for obj in array:
+                obj.tile_key = (type(obj).__name__, obj.rect.topleft)
+                if obj.tile_key in self.removed:
+                    continue
+                if self.unlocked and isinstance(obj, (Lock, LockLeaf)):
+                    continue
+                if self.coins_removed and isinstance(obj, Coin):
+                    continue
+                kept.append(obj)
+            array[:] = kept
+            chunk.sprites.extend(kept)
+        self.add_loaded()
+        self.bake_static(chunk.sprites, chunk.layer, rect.topleft)
+        self.chunks[key] = chunk
+        tracer.end("load chunk", start, {"chunk": list(key)})
+
+    def unload_chunk(self, key):
+        chunk = self.chunks.pop(key)
+        for obj in chunk.sprites:
+            if not obj.alive():
+                self.removed.add(obj.tile_key)
+            obj.kill()
+
+    def stream(self, view):
+        load_area = view.inflate(2 * CHUNK_LOAD_MARGIN * CHUNK_COLS * TILE_SIZE,
+                                 2 * CHUNK_LOAD_MARGIN * CHUNK_ROWS * TILE_SIZE)
+        keep_area = view.inflate(2 * CHUNK_KEEP_MARGIN * CHUNK_COLS * TILE_SIZE,
+                                 2 * CHUNK_KEEP_MARGIN * CHUNK_ROWS * TILE_SIZE)
+        for key in list(self.chunks):
+            if not self.chunk_rect(key).colliderect(keep_area):
+                self.unload_chunk(key)
+        for key in self.chunk_keys(view):           # Chunks on screen are needed right now
+            if key not in self.chunks:
+                self.load_chunk(key)
+        budget = CHUNK_LOADS_PER_FRAME              # The ones ahead of the camera are spread over frames
+        for key in self.chunk_keys(load_area):
+            if budget and key not in self.chunks:
+                self.load_chunk(key)
+                budget -= 1
+
+    def draw(self, screen, camera):
+        view = camera.rect
+        for chunk in self.chunks.values():          # Only blit chunks and sprites that are on screen
+            if chunk.rect.colliderect(view):
+                screen.blit(chunk.layer, (chunk.rect.x - view.x, chunk.rect.y - view.y))
+        for obj in self.sprites:
+            if obj.rect.colliderect(view):
+                screen.blit(obj.image, obj.rect.move(-view.x, -view.y))
+
+    def keys_remaining(self):
+        taken = sum(1 for kind, _ in self.removed if kind == "Key")
+        for chunk in self.chunks.values():
+            taken += sum(1 for obj in chunk.sprites if isinstance(obj, Key) and not obj.alive())
+        return self.total_keys - taken
+
+    def reload(self):
+        # Chunks are read from the file as they come into view, so only the index and the loaded chunks go stale
+        if os.stat(self.source).st_mtime_ns == self.mtime:
+            return False
+        start = tracer.begin()
+        for key in list(self.chunks):               # What was collected is remembered by tile, see load_chunk
+            self.unload_chunk(key)
+        self.index_level()
+        self.bounds = pygame.Rect(0, 0, self.cols * TILE_SIZE, len(self.row_offsets) * TILE_SIZE)
+        tracer.end("reload level", start, {"stage": self.number})
+        return True
+
+    def progress(self):
+        removed = set(self.removed)
+        for chunk in self.chunks.values():
+            removed.update(obj.tile_key for obj in chunk.sprites if not obj.alive())
+        return tuple((kind, x, y) for kind, (x, y) in sorted(removed))
+
+    def restore_progress(self, removed, unlocked):
+        for key in list(self.chunks):               # Chunks are rebuilt without what was removed, see load_chunk
+            self.unload_chunk(key)
+        self.removed.update((kind, (x, y)) for kind, x, y in removed)
+        self.unlocked = unlocked
+
+    def reset(self, returned):
+        for key in list(self.chunks):
+            self.unload_chunk(key)
+        self.removed.clear()
+        self.unlocked = False
+        self.coins_removed = returned
+
+    def owned_sprites(self):
+        sprites = set(self.sprites)
+        for chunk in self.chunks.values():
+            sprites.update(chunk.sprites)
+        return sprites
+
+    def owned_surfaces(self):
+        return [(f"chunk {key[0]},{key[1]}", chunk.layer) for key, chunk in self.chunks.items()]
+
+    def estimate_size(self):
+        # Budget for a full window of loaded chunks, which is as large as this stage gets
+        window = (2 * CHUNK_KEEP_MARGIN + SCREEN_WIDTH // (CHUNK_COLS * TILE_SIZE) + 1) * \
+                 (2 * CHUNK_KEEP_MARGIN + SCREEN_HEIGHT // (CHUNK_ROWS * TILE_SIZE) + 1)
+        chunk = CHUNK_COLS * CHUNK_ROWS * (TILE_SIZE * TILE_SIZE * 4 + SPRITE_OVERHEAD_BYTES)
+        return len(self.row_offsets) * 8 + window * chunk
+
+
+# Viewport into the stage that follows the player and stays within the stage bounds
+class Camera:
+    def __init__(self):
+        self.rect = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    def follow(self, pos, bounds):
+        self.rect.center = (round(pos.x), round(pos.y) - TILE_SIZE)
+        self.rect.clamp_ip(bounds)
+
+
+# Least recently used cache of built stages, bounded by their estimated size in bytes
+class StageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.stages = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        stage = self.stages.get(key)
+        if stage is None:
+            self.misses += 1
+            return None
+        self.stages.move_to_end(key)
+        self.hits += 1
+        return stage
+
+    def put(self, key, stage):
+        if key in self.stages:
+            del self.stages[key]
+            self.bytes -= self.sizes.pop(key)
+        size = stage.estimate_size()
+        if size > self.max_bytes:                   # Would evict everything and still not fit
+            return
+        self.stages[key] = stage
+        self.sizes[key] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, _ = self.stages.popitem(last=False)
+            self.bytes -= self.sizes.pop(old_key)
+            self.evictions += 1
+
+    def clear(self):
+        self.stages.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "stages": len(self.stages), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+stage_cache = StageCache(STAGE_CACHE_BYTES)
+
+
+def stage_key(number, coins):
+    # Everything besides the stage number that changes what load_stage builds
+    key_coins = levels.info(number)["key_coins"]
+    return number, key_coins is not None and coins >= key_coins, game_state.has_ring
+
+
+def get_stage(number, coins):
+    key = stage_key(number, coins)
+    stage = stage_cache.get(key)
+    if stage is not None:
+        tracer.instant("stage cache hit", {"stage": number})
+        stage.reset(game_state.returned)
+        return stage
+    if levels.is_large(number):
+        stage = LargeStage(number, coins)
+    else:
+        stage = Stage(number, coins)
+    if stage.complete:
+        stage_cache.put(key, stage)
+    return stage
+
+
+# Development aid that rebuilds the current stage whenever its level file is saved
+class LevelWatcher:
+    def __init__(self):
+        self.stage = None
+        self.mtime = None
+
+    def poll(self, stage):
+        try:
+            mtime = os.stat(stage.filename).st_mtime_ns     # One stat per frame, the file is only read once it changes
+        except OSError:                                     # Some editors replace the file when saving
+            return False
+        if stage is self.stage and mtime == self.mtime:
+            return False
+        self.stage = stage
+        self.mtime = mtime
+        return stage.reload()                   # Also catches edits made while the stage was cached
+
+
+def playtime_text(seconds):
+    d = datetime(1, 1, 1) + timedelta(seconds=int(seconds))
+    return "%d:%d:%d" % (d.hour, d.minute, d.second)
+
+
+# Draws text from glyphs rasterized once into atlas pages, keeping recently used strings ready to blit
+class TextRenderer:
+    def __init__(self, font, color, antialias=True, cache_size=TEXT_CACHE_SIZE):
+        self.font = font
+        self.color = color
+        self.antialias = antialias
+        self.cache_size = cache_size
+        self.height = font.get_height()
+        self.pages = []
+        self.cursor = [0, 0]                    # Where the next glyph goes on the newest page
+        self.glyphs = {}                        # (page, area) by character
+        self.strings = OrderedDict()
+        self.new_page()
+
+    def new_page(self):
+        page = pygame.Surface(GLYPH_PAGE_SIZE, pygame.SRCALPHA)
+        page.fill((*self.color, 0))
+        self.pages.append(page)
+        self.cursor = [0, 0]
+
+    def glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            image = self.font.render(char, self.antialias, self.color)
+            width = image.get_width()
+            if self.cursor[0] + width > GLYPH_PAGE_SIZE[0]:     # Row is full, start the next one
+                self.cursor = [0, self.cursor[1] + self.height]
+            if self.cursor[1] + self.height > GLYPH_PAGE_SIZE[1]:
+                self.new_page()
+            page = self.pages[-1]
+            area = pygame.Rect(self.cursor[0], self.cursor[1], width, image.get_height())
+            page.blit(image, area)
+            self.cursor[0] += width
+            metrics = self.font.metrics(char)[0]
+            if metrics is None:                 # Character missing from the font, treat it as a plain advance
+                metrics = (0, 0, 0, 0, width)
+            bearing = min(0, metrics[0])        # Glyphs that overhang to the left are rendered that far wider
+            glyph = (page, area, bearing, metrics[4])
+            self.glyphs[char] = glyph
+        return glyph
+
+    def render(self, text):
+        surface = self.strings.get(text)
+        if surface is not None:
+            self.strings.move_to_end(text)
+            return surface
+        glyphs = [self.glyph(char) for char in text]
+        surface = pygame.Surface((max(1, self.font.size(text)[0]), self.height), pygame.SRCALPHA)
+        surface.fill((*self.color, 0))          # Text colour at zero alpha so blending keeps the glyph colour exact
+        x = -glyphs[0][2] if glyphs else 0
+        for page, area, bearing, advance in glyphs:
+            surface.blit(page, (x + bearing, 0), area)
+            x += advance
+        self.strings[text] = surface
+        if len(self.strings) > self.cache_size:
+            self.strings.popitem(last=False)
+        return surface
+
+
+# Live stats drawn over the stage, only rebuilt when one of them changes
+class Hud:
+    def __init__(self, text):
+        self.text = text
+        self.values = None
+        self.surface = None
+
+    def update(self, coins, deaths, jumps, seconds):
+        values = (coins, deaths, jumps, int(seconds))
+        if values != self.values:
+            self.values = values
+            self.surface = self.text.render(f"Coins {coins}  Deaths {deaths}  Jumps {jumps}  "
+                                            f"Time {playtime_text(seconds)}")
+
+    def draw(self, screen):
+        screen.blit(self.surface, HUD_POSITION)
+
+
+# Named sound that plays through the audio engine, used like a pygame Sound
+class SoundHandle:
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+
+    def play(self, loops=0):
+        self.engine.play(self.name, loops)
+
+    def stop(self):
+        self.engine.stop(self.name)
+
+
+# Plays sounds on a fixed pool of channels per category, decoding each file only once
+class AudioEngine:
+    def __init__(self, categories):
+        self.samples = {}                       # Decoded sounds by file, shared by every name that uses the file
+        self.sounds = {}                        # (sample, volume, category) by name
+        self.pools = {}                         # Reserved channels by category
+        self.current = {}                       # Name and start time of what each channel was last given
+        self.play_counts = {}
+        self.steals = {category: 0 for category in categories}
+        total = sum(categories.values())
+        if pygame.mixer.get_num_channels() < total:
+            pygame.mixer.set_num_channels(total)
+        pygame.mixer.set_reserved(total)        # Keep Sound.play from grabbing pooled channels
+        first = 0
+        for category, count in categories.items():
+            self.pools[category] = [pygame.mixer.Channel(number) for number in range(first, first + count)]
+            first += count
+
+    def load(self, name, filename, volume, category):
+        sample = self.samples.get(filename)
+        if sample is None:
+            sample = load_sound(filename)
+            self.samples[filename] = sample
+        self.sounds[name] = (sample, volume, category)   # Volume is applied per channel so samples can be shared
+        self.play_counts[name] = 0
+        return SoundHandle(self, name)
+
+    def play(self, name, loops=0):
+        sample, volume, category = self.sounds[name]
+        pool = self.pools[category]
+        channel = None
+        for candidate in pool:
+            if not candidate.get_busy():
+                channel = candidate
+                break
+        if channel is None:                     # Every voice in the category is busy, steal the oldest one
+            channel = min(pool, key=lambda candidate: self.current[candidate][1])
+            channel.stop()
+            self.steals[category] += 1
+        channel.set_volume(volume)
+        channel.play(sample, loops)
+        self.current[channel] = (name, perf_counter())
+        self.play_counts[name] += 1
+
+    def stop(self, name):
+        for channel, (playing, _) in self.current.items():
+            if playing == name and channel.get_busy():
+                channel.stop()
+
+    def stats(self):
+        return {"samples": len(self.samples), "plays": dict(self.play_counts), "steals": dict(self.steals)}
+
+
+def present_rect(size):
+    # Largest whole number scale of the frame that fits, centred with black bars around it
+    scale = max(1, min(size[0] // SCREEN_WIDTH, size[1] // SCREEN_HEIGHT))
+    return pygame.Rect((size[0] - SCREEN_WIDTH * scale) // 2, (size[1] - SCREEN_HEIGHT * scale) // 2,
+                       SCREEN_WIDTH * scale, SCREEN_HEIGHT * scale)
+
+
+# Window the fixed size frame is presented in, switched between modes without touching the frame
+class Display:
+    def __init__(self, window):
+        self.window = window
+        self.mode = 0                               # Index into DISPLAY_MODES
+
+    def next_mode(self):
+        self.mode = (self.mode + 1) % len(DISPLAY_MODES)
+        tracer.instant("display mode", {"mode": DISPLAY_MODES[self.mode]})
+        if self.window is None:
+            self.set_mode()
+            return
+        if DISPLAY_MODES[self.mode] == "fullscreen":
+            self.window.set_fullscreen(desktop=True)
+            return
+        self.window.set_windowed()
+        self.window.size = self.window_size()
+        self.window.position = WINDOWPOS_CENTERED
+
+    def window_size(self):
+        scale = 1
+        if DISPLAY_MODES[self.mode] == "scaled":
+            desktop_width, desktop_height = pygame.display.get_desktop_sizes()[0]
+            scale = max(1, min(desktop_width // SCREEN_WIDTH, desktop_height // SCREEN_HEIGHT))
+        return (SCREEN_WIDTH * scale, SCREEN_HEIGHT * scale)
+
+    def set_mode(self):
+        # Without pygame's SDL2 window object the display surface is set again, the frame drawn into stays the same
+        flags = pygame.HWSURFACE | pygame.DOUBLEBUF
+        if DISPLAY_MODES[self.mode] == "fullscreen":
+            pygame.display.set_mode((0, 0), flags | pygame.FULLSCREEN, vsync=1)     # Desktop resolution
+        else:
+            pygame.display.set_mode(self.window_size(), flags, vsync=1)
+
+    def set_caption(self, caption):
+        if self.window is None:
+            pygame.display.set_caption(caption)
+        else:
+            self.window.title = caption
+
+    def set_icon(self, icon):
+        if self.window is None:
+            pygame.display.set_icon(icon)
+        else:
+            self.window.set_icon(icon)
+
+
+# Frame drawn with CPU blits onto an offscreen surface and scaled onto the display surface when presented
+class SurfaceDisplay(Display):
+    def __init__(self):
+        pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF, vsync=1)
+        super().__init__(None if Window is None else Window.from_display_module())
+        self.screen = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))     # Never replaced, whatever the window does
+        self.rect = self.screen.get_rect()
+        self.output = None                          # Display surface and area the frame was last scaled into
+
+    def present(self, dirty=None):
+        # Only rescale what changed, unless the window surface was replaced by a mode switch
+        window = pygame.display.get_surface()
+        area = present_rect(window.get_size())
+        if self.output != (window, area):
+            self.output = (window, area)
+            window.fill(BLACK)
+            dirty = None
+        scale = area.width // SCREEN_WIDTH
+        updated = []
+        for rect in [self.rect] if dirty is None else dirty:
+            rect = rect.clip(self.rect)
+            if not rect.width or not rect.height:
+                continue
+            target = pygame.Rect(area.x + rect.x * scale, area.y + rect.y * scale,
+                                 rect.width * scale, rect.height * scale)
+            if scale == 1:
+                window.blit(self.screen, target, rect)
+            else:
+                pygame.transform.scale(self.screen.subsurface(rect), target.size, window.subsurface(target))
+            updated.append(target)
+        if dirty is None:
+            pygame.display.flip()
+        elif updated:
+            pygame.display.update(updated)
+
+    def refresh(self):
+        self.present()
+
+    def snapshot(self):
+        return self.screen
+
+
+# Stands in for the screen surface, turning blits into texture copies onto a frame texture kept on the renderer
+class TextureCanvas:
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.rect = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.frame = Texture(renderer, self.rect.size, target=True)    # Keeps its pixels between frames like a surface
+        self.frame.blend_mode = BLENDMODE_NONE
+        self.textures = weakref.WeakKeyDictionary()     # Uploaded texture by surface, None for translucent ones
+        self.scratch = {}                       # Streaming textures by size for translucent blits
+        self.begin()
+
+    def begin(self):
+        self.renderer.target = self.frame
+
+    def get_size(self):
+        return self.rect.size
+
+    def texture(self, surface):
+        if surface in self.textures:
+            return self.textures[surface]
+        texture = None
+        # Colorkeyed images are uploaded with the key as alpha, so they blend like per-pixel alpha ones
+        alpha = surface.get_flags() & pygame.SRCALPHA or surface.get_colorkey() is not None
+        translucent = surface.get_alpha() not in (None, 255)      # Alpha of the whole surface, like ghosts
+        # SDL rounds partial alpha differently from pygame, so those surfaces are blended on the CPU instead
+        if not translucent and (not alpha or
+                                not pygame.image.tobytes(surface, "RGBA")[3::4].translate(None, b"\x00\xff")):
+            texture = Texture.from_surface(self.renderer, surface)
+            texture.blend_mode = BLENDMODE_BLEND if alpha else BLENDMODE_NONE
+        self.textures[surface] = texture
+        return texture
+
+    def fill(self, color):
+        self.renderer.draw_color = (*color[:3], 255)
+        self.renderer.clear()
+
+    def blit(self, surface, dest, area=None):
+        area = pygame.Rect(area) if area is not None else surface.get_rect()
+        rect = pygame.Rect(dest[0], dest[1], area.width, area.height)
+        texture = self.texture(surface)
+        if texture is not None:
+            texture.draw(srcrect=area, dstrect=rect)    # Queued, SDL batches copies until the frame is presented
+            return rect.clip(self.rect)
+        region = rect.clip(self.rect)
+        if region.width and region.height:
+            self.blend([(surface, rect, area)], region)
+        return region
+
+    def blits(self, blit_sequence, doreturn=True):
+        # Translucent surfaces are blended together after the others with one read back, however many there are
+        rects = []
+        translucent = []
+        for surface, dest in blit_sequence:
+            rect = pygame.Rect(dest, surface.get_size())
+            texture = self.texture(surface)
+            if texture is not None:
+                texture.draw(dstrect=rect)
+            elif rect.colliderect(self.rect):
+                translucent.append((surface, rect, None))
+            rects.append(rect.clip(self.rect))
+        if translucent:
+            self.blend(translucent, translucent[0][1].unionall([rect for _, rect, _ in translucent]).clip(self.rect))
+        return rects if doreturn else None
+
+    def blend(self, blits, region):
+        # Read back what is underneath, blend exactly as blits would and copy the result over it
+        under = pygame.Surface(region.size)
+        self.renderer.to_surface(under, region)
+        for surface, rect, area in blits:
+            under.blit(surface, (rect.x - region.x, rect.y - region.y), area)
+        scratch = self.scratch.get(region.size)
+        if scratch is None:
+            scratch = Texture(self.renderer, region.size, streaming=True)
+            self.scratch[region.size] = scratch
+        scratch.update(under)
+        scratch.draw(dstrect=region)
+
+    def snapshot(self):
+        return self.renderer.to_surface(pygame.Surface(self.rect.size))
+
+
+# Window drawn by SDL's 2D renderer from textures uploaded once, on the GPU or with SDL's software renderer
+class TextureDisplay(Display):
+    def __init__(self, accelerated):
+        os.environ.setdefault("SDL_RENDER_BATCHING", "1")   # Let SDL merge consecutive copies into few draw calls
+        super().__init__(Window("Lymynal Labrynthe", (SCREEN_WIDTH, SCREEN_HEIGHT)))
+        self.renderer = None
+        if accelerated:
+            try:
+                self.renderer = Renderer(self.window, accelerated=1, vsync=True, target_texture=True)
+            except RendererError:               # No usable GPU driver, SDL's software renderer draws the same pixels
+                pass
+        if self.renderer is None:
+            self.renderer = Renderer(self.window, accelerated=0, vsync=True, target_texture=True)
+        self.screen = TextureCanvas(self.renderer)
+        self.screen.fill(BLACK)
+
+    def present(self, dirty=None):
+        self.refresh()                              # Copying the whole frame texture is cheap on the renderer
+
+    def refresh(self):
+        self.renderer.target = None
+        self.renderer.draw_color = (0, 0, 0, 255)
+        self.renderer.clear()
+        self.screen.frame.draw(dstrect=present_rect(self.renderer.get_viewport().size))
+        self.renderer.present()
+        self.screen.begin()
+
+    def snapshot(self):
+        return self.screen.snapshot()
+
+
+def open_display(renderer):
+    if renderer == "blit" or Renderer is None:
+        return SurfaceDisplay()
+    return TextureDisplay(accelerated=renderer == "gpu")
+
+
+# Wall clock play time that stops counting while the game is paused
+class PlayClock:
+    def __init__(self):
+        self.start = time()
+        self.paused_at = None
+        self.paused_total = 0.0
+        self.stopped = False
+
+    def pause(self):
+        if self.paused_at is None:
+            self.paused_at = time()
+
+    def resume(self):
+        if self.paused_at is not None and not self.stopped:
+            self.paused_total += time() - self.paused_at
+            self.paused_at = None
+
+    def stop(self):
+        self.pause()
+        self.stopped = True                     # Final time is kept even if the window regains focus later
+
+    def elapsed(self):
+        now = time() if self.paused_at is None else self.paused_at
+        return now - self.start - self.paused_total
+
+    def set_elapsed(self, seconds):
+        now = time() if self.paused_at is None else self.paused_at
+        self.start = now - seconds - self.paused_total
+
+
+# Tracks whether the window is focused and visible, pausing play time and sound while it is not
+class WindowFocus:
+    def __init__(self, play_clock, display):
+        self.play_clock = play_clock
+        self.display = display
+        self.focused = True
+        self.visible = True
+        self.paused = False
+
+    def handle(self, event):
+        if event.type == pygame.WINDOWFOCUSLOST:
+            self.focused = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            self.focused = True
+        elif event.type in (pygame.WINDOWMINIMIZED, pygame.WINDOWHIDDEN):
+            self.visible = False
+        elif event.type in (pygame.WINDOWRESTORED, pygame.WINDOWSHOWN, pygame.WINDOWMAXIMIZED):
+            self.visible = True
+        elif event.type == pygame.WINDOWEXPOSED and self.paused:
+            self.display.refresh()              # Repaint the last frame without simulating a new one
+            return
+        else:
+            return
+        paused = not (self.focused and self.visible)
+        if paused != self.paused:
+            self.paused = paused
+            tracer.instant("pause" if paused else "resume")
+            if paused:
+                self.play_clock.pause()
+                pygame.mixer.pause()
+            else:
+                self.play_clock.resume()
+                pygame.mixer.unpause()
+                self.display.refresh()          # Show the window's contents again even if it is never exposed
+
+
+# Collects input with timestamps right before the physics step so the simulation sees the freshest state
+class InputSampler:
+    def __init__(self):
+        self.queue = []                         # (time first seen, event) pumped since the last sample
+        self.pressed = None
+        self.sample_time = perf_counter()
+        self.oldest_input = None                # When the oldest key event handled this frame arrived
+        self.deferred = []                      # Events kept from while the game was paused
+
+    def poll(self):
+        now = perf_counter()
+        for event in pygame.event.get():
+            self.queue.append((now, event))
+
+    def defer(self, event):
+        # Handed to the first frame after the pause, left out of the input latency since it waited on purpose
+        self.deferred.append(event)
+
+    def sample(self):
+        self.poll()
+        events = self.queue
+        self.queue = []
+        self.pressed = pygame.key.get_pressed()
+        self.sample_time = perf_counter()
+        seen = [when for when, event in events if event.type in (pygame.KEYDOWN, pygame.KEYUP)]
+        self.oldest_input = min(seen) if seen else None
+        deferred = self.deferred
+        self.deferred = []
+        return deferred + [event for _, event in events]
+
+
+# Paces the game loop, optionally sleeping before input is sampled rather than after the frame is shown
+class FramePacer:
+    def __init__(self, clock, fps, low_latency):
+        self.clock = clock
+        self.fps = fps
+        self.period = 1 / fps
+        self.low_latency = low_latency
+        self.next_present = perf_counter() + self.period
+        self.frame_start = perf_counter()
+        self.idle_start = perf_counter()
+        self.work = 0.0                         # Smoothed seconds from input sample to present
+        self.frames = 0
+        self.overruns = []                      # (frame, milliseconds) for frames whose work took longer than a period
+
+    async def wait(self, controls):
+        if self.low_latency:
+            # Start the frame as late as possible so it is shown right after input is read, with nothing queued
+            deadline = self.next_present - self.work - PACING_MARGIN
+            while True:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, PACING_SLICE))
+                controls.poll()                 # Timestamp events as they arrive instead of when the frame starts
+        self.frame_start = perf_counter()
+
+    async def idle(self, fps):
+        # Fixed rate wait for the title, results and paused loops, which have no input to pace
+        await asyncio.sleep(max(0.0, self.idle_start + 1 / fps - perf_counter()))
+        self.idle_start = perf_counter()
+        self.clock.tick()
+
+    def resync(self):
+        # Start a fresh schedule after a pause so there is no burst of frames to catch up
+        self.next_present = perf_counter() + self.period
+        self.clock.tick()
+
+    async def presented(self, controls):
+        now = perf_counter()
+        self.work += (now - controls.sample_time - self.work) * PACING_SMOOTHING
+        self.frames += 1
+        work = now - self.frame_start
+        if work > self.period:                  # Nothing the loop waited on, only its own work, made it late
+            self.overruns.append((self.frames, work * 1000))
+            tracer.instant("overrun", {"ms": round(work * 1000, 3)})
+        self.clock.tick()                       # Keep clock statistics, asyncio does the sleeping
+        if self.low_latency:
+            self.next_present += self.period
+            if self.next_present < now:         # Fell behind, start a fresh schedule instead of catching up
+                self.next_present = now + self.period
+            await asyncio.sleep(0)              # Still hand control back once a frame
+        else:
+            await asyncio.sleep(max(0.0, self.next_present - now))
+            self.next_present += self.period
+            if self.next_present < perf_counter():
+                self.next_present = perf_counter() + self.period
+        return now
+
+    def overrun_report(self):
+        if not self.overruns:
+            return f"no frame overran its {self.period * 1000:.2f} ms budget in {self.frames} frames"
+        slowest = sorted(self.overruns, key=lambda overrun: -overrun[1])[:OVERRUNS_REPORTED]
+        return (f"{len(self.overruns)} of {self.frames} frames overran their {self.period * 1000:.2f} ms budget, "
+                f"slowest: " + ", ".join(f"frame {frame} {ms:.2f} ms" for frame, ms in slowest))
+
+
+# Runs blocking file work off the game loop on a few threads, or inline on hosts without threads
+class BackgroundIO:
+    def __init__(self, workers):
+        if sys.platform in THREADLESS_PLATFORMS:
+            self.executor = None
+        else:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="io")
+        self.pending = set()
+
+    def submit(self, function, *args):
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            future = loop.create_future()
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                future.set_exception(error)
+        else:
+            future = loop.run_in_executor(self.executor, function, *args)
+        self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        self.pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:      # Nobody awaits most of these
+            print(f"Background work failed: {future.exception()!r}", file=sys.stderr)
+
+    async def drain(self):
+        # Let screenshots and logs finish writing before the game exits
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# Writes saves of one slot, or the ghosts, in the background in the order they were taken
+class Autosaver:
+    def __init__(self, io, filename, writer=write_save):
+        self.io = io
+        self.filename = filename
+        self.writer = writer
+        self.writing = None
+        self.queued = None                      # Newest save taken while another was being written
+
+    def save(self, save):
+        if self.writing is not None and not self.writing.done():
+            self.queued = save                  # An older save must never be the last one to land
+            return
+        self.write(save)
+
+    def write(self, save):
+        tracer.instant("autosave", {"file": self.filename})
+        self.writing = self.io.submit(self.writer, self.filename, save)
+        self.writing.add_done_callback(self.written)
+
+    def written(self, future):
+        if self.queued is not None:
+            save = self.queued
+            self.queued = None
+            self.write(save)
+
+
+def take_save(stage, coins, deaths, jumps, play_time, spawn):
+    flags = game_state.snapshot()
+    flags["returned"] = stage.coins_removed     # So the stage is rebuilt without coins it was built without
+    return SaveGame(stage.number, coins, deaths, jumps, play_time,
+                    sum(1 << number for number, name in enumerate(GAME_FLAGS) if flags[name]),
+                    (round(spawn.x), round(spawn.y)), stage.unlocked, stage.progress())
+
+
+def read_slot(slot, campaign):
+    filename = slot_path(slot, campaign)
+    try:
+        save = read_save(filename)
+    except (SaveError, OSError) as error:
+        print(f"Save slot {slot} can't be read, starting it over: {error}", file=sys.stderr)
+        return None
+    if save is not None and save.stage not in levels:
+        print(f"Save slot {slot} is for stage {save.stage}, which this campaign does not have", file=sys.stderr)
+        return None
+    return save
+
+
+def read_ghost_file(filename):
+    try:
+        return read_ghosts(filename)
+    except (GhostError, OSError) as error:
+        print(f"Ghosts can't be read, starting without them: {error}", file=sys.stderr)
+        return []
+
+
+# Records where the player is drawn on every frame of a stage visit, and plays the stage's best run and latest
+# visits back from arrays decoded once when the stage is entered
+class Ghosts:
+    def __init__(self, autosave, tracks, attempts):
+        self.autosave = autosave                # Writes every track of every stage after each visit
+        self.tracks = tracks
+        self.attempts = attempts
+        self.stage = None                       # Stage of the visit being recorded
+        self.xs = array('i')
+        self.ys = array('i')
+        self.playback = []                      # (xs, ys) of every ghost of the stage
+
+    def enter(self, stage):
+        self.leave(False)                       # Left some other way than the exit, e.g. a secret door
+        self.stage = stage
+        self.playback = [decode_track(track) for track in self.tracks if track.stage == stage]
+
+    def leave(self, exited):
+        if self.stage is not None and self.xs:
+            # Only keeps the arrays, deflating them is left to the writer so a long visit can't stall this frame
+            self.tracks = add_visit(self.tracks, self.stage, self.xs, self.ys, exited, self.attempts)
+            self.autosave.save(self.tracks)
+        self.stage = None
+        self.xs = array('i')
+        self.ys = array('i')
+        self.playback = []
+
+    def record(self, rect):
+        self.xs.append(rect.x)
+        self.ys.append(rect.y)
+
+    def draw(self, screen, view, image):
+        frame = len(self.xs) - 1                # Ghosts are as far into their visit as the player is into this one
+        screen.blits([(image, (xs[frame] - view.x, ys[frame] - view.y))
+                      for xs, ys in self.playback if 0 <= frame < len(xs)], doreturn=False)
+
+
+# Records how long input took to reach the screen for every frame
+class LatencyLog:
+    def __init__(self):
+        self.sample_ms = array('d')             # Key state sample to present
+        self.event_ms = array('d')              # Oldest key event to present, -1 when there was none
+
+    def record(self, controls, present_time):
+        self.sample_ms.append((present_time - controls.sample_time) * 1000)
+        if controls.oldest_input is None:
+            self.event_ms.append(-1)
+        else:
+            self.event_ms.append((present_time - controls.oldest_input) * 1000)
+
+    def summary(self):
+        lines = []
+        for name, values in (("sample to present", list(self.sample_ms)),
+                             ("key event to present", [value for value in self.event_ms if value >= 0])):
+            if values:
+                values.sort()
+                lines.append(f"{name}: mean {sum(values) / len(values):.2f} ms, "
+                             f"p95 {values[int(len(values) * 0.95)]:.2f} ms, max {values[-1]:.2f} ms "
+                             f"over {len(values)} frames")
+        return "\n".join(lines)
+
+    def save(self, filename):
+        with open(filename, 'w') as file:
+            file.write("frame,sample_to_present_ms,event_to_present_ms\n")
+            for frame, (sample, event) in enumerate(zip(self.sample_ms, self.event_ms)):
+                file.write(f"{frame},{sample:.3f},{event:.3f}\n")
+
+
+# Wall clock time each startup step finished at, from entering main to the first title frame, for startup.py
+class StartupReport:
+    def __init__(self):
+        self.marks = [("main", time())]         # Wall clock, so the launching process can line them up with its own
+
+    def mark(self, name):
+        self.marks.append((name, time()))
+
+    def dump(self):
+        return json.dumps({"pid": os.getpid(), "marks": self.marks})
+
+
+def count_by_class(sprites):
+    counts = {}
+    for obj in sprites:
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return dict(sorted(counts.items()))
+
+
+def count_diff(new, old):
+    # Nested counts that changed between two reports, as new minus old
+    diff = {}
+    for key in sorted(new.keys() | old.keys()):
+        new_value = new.get(key, 0)
+        old_value = old.get(key, 0)
+        if isinstance(new_value, dict) or isinstance(old_value, dict):
+            changed = count_diff(new_value or {}, old_value or {})
+            if changed:
+                diff[key] = changed
+        elif new_value != old_value:
+            diff[key] = new_value - old_value
+    return diff
+
+
+# Accounts for the surfaces, sounds and sprites held at every stage load, with allocation diffs from tracemalloc
+class MemoryReport:
+    def __init__(self, play_frames):
+        self.play_frames = play_frames
+        self.entries = []
+        self.before_load = None
+        self.before_play = None                 # Allocations when the current stage finished loading
+        self.loaded = None                      # Report of the current stage's load, which play diffs are added to
+        self.frames = 0
+        tracemalloc.start()
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")))
+
+    def top_allocators(self, after, before):
+        top = []
+        for stat in after.compare_to(before, "lineno")[:MEMORY_TOP_ALLOCATORS]:
+            frame = stat.traceback[0]
+            top.append({"line": f"{frame.filename}:{frame.lineno}", "bytes": stat.size_diff,
+                        "blocks": stat.count_diff, "total_bytes": stat.size})
+        return top
+
+    def begin_load(self):
+        self.end_play()                         # Leaving a stage early reports the frames it did get
+        self.before_load = self.snapshot()
+
+    def stage_loaded(self, stage, name, cached, audio):
+        after = self.snapshot()
+        entry = self.measure("load", stage, name, audio)
+        entry["cached"] = cached                # Cache hits reset a built stage instead of calling load_stage
+        entry["load"] = self.top_allocators(after, self.before_load)
+        self.add(entry)
+        self.loaded = entry
+        self.before_play = after
+        self.frames = 0
+
+    def frame(self):
+        if self.before_play is not None:
+            self.frames += 1
+            if self.frames == self.play_frames:
+                self.end_play()
+
+    def end_play(self):
+        if self.before_play is not None and self.frames:
+            self.loaded["play"] = {"frames": self.frames,
+                                   "top": self.top_allocators(self.snapshot(), self.before_play)}
+        self.before_play = None
+
+    def measure(self, event, stage, name, audio):
+        gc.collect()                            # Only count sprites that something still refers to
+        current, peak = tracemalloc.get_traced_memory()
+        entry = {"event": event, "stage": stage.number, "name": name,
+                 "traced": {"current_bytes": current, "peak_bytes": peak}}
+
+        with image_lock:
+            images = {filename: image_bytes(image) for filename, image in sorted(IMAGE_CACHE.items())}
+        layers = {label: surface_bytes(surface) for label, surface in stage.owned_surfaces()}
+        cached_layers = sum(surface_bytes(surface) for other in stage_cache.stages.values() if other is not stage
+                            for _, surface in other.owned_surfaces())
+        bundle = asset_bundle()
+        sheets = {}
+        if bundle:
+            with bundle.lock:                   # preload_images may still be mapping sheets
+                sheets = {sheet: surface_bytes(surface) for sheet, surface in bundle.sheets.items()}
+        entry["surfaces"] = {"images": images, "stage": layers, "cached_stages_bytes": cached_layers,
+                             "total_bytes": sum(images.values()) + sum(layers.values()) + cached_layers,
+                             "collision_masks_bytes": sum((mask.get_size()[0] + 7) // 8 * mask.get_size()[1]
+                                                          for mask in list(MASK_CACHE.values())),
+                             # Mapped from the bundle file, only pages that were drawn from are resident
+                             "bundle_sheets": sheets}
+        samples = {filename: sound_bytes(sample) for filename, sample in sorted(audio.samples.items())}
+        entry["sounds"] = {"samples": samples, "total_bytes": sum(samples.values())}
+
+        owned = stage.owned_sprites() | set(stage.sprites)
+        cached = set()
+        for other in stage_cache.stages.values():
+            if other is not stage:
+                cached.update(other.owned_sprites())
+        loading = {obj for array in LOAD_ARRAYS for obj in array}
+        live = [obj for obj in gc.get_objects() if isinstance(obj, pygame.sprite.Sprite)]
+        stray = [obj for obj in live if obj not in owned and obj not in cached]
+        entry["sprites"] = {"live": count_by_class(live), "stage": count_by_class(owned),
+                            "cached_stages": count_by_class(cached - owned),
+                            # Alive without belonging to a stage that is played or cached, so leaked
+                            "stray": count_by_class(stray),
+                            "stray_in_load_arrays": count_by_class(obj for obj in stray if obj in loading),
+                            "stray_in_groups": count_by_class(obj for obj in stray if obj.groups())}
+        entry["groups"] = {group: len(getattr(stage, group)) for group in STAGE_GROUPS}
+        entry["stage_cache"] = stage_cache.stats()
+        return entry
+
+    def add(self, entry):
+        if self.entries:
+            previous = self.entries[-1]
+            entry["diff"] = count_diff({key: entry[key] for key in MEMORY_DIFFED},
+                                       {key: previous[key] for key in MEMORY_DIFFED})
+        self.entries.append(entry)
+
+    def dump(self, event, stage, name, audio):
+        self.add(self.measure(event, stage, name, audio))
+        return json.dumps({"play_frames": self.play_frames, "entries": self.entries}, indent=1)
+
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def non_negative_int(text):
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must be at least 0, got {value}")
+    return value
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Lymynal Labrynthe")
+    parser.add_argument("--low-latency", action="store_true",
+                        help="sleep before reading input instead of after showing the frame")
+    parser.add_argument("--latency-log", metavar="FILE",
+                        help="write input to display latency of every frame to FILE as CSV")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record a timeline of every frame and write it to FILE as a Chrome trace")
+    parser.add_argument("--trace-events", type=positive_int, default=TRACE_EVENTS, metavar="N",
+                        help="number of most recent trace events kept")
+    parser.add_argument("--hud", action="store_true",
+                        help="start with the coins, deaths, jumps and time overlay shown (toggle with H)")
+    parser.add_argument("--renderer", choices=RENDERERS, default="blit",
+                        help="draw with CPU blits, or with textures on the GPU (falling back to SDL's software "
+                             "renderer when there is no GPU) or on SDL's software renderer")
+    parser.add_argument("--ghosts", action="store_true",
+                        help="start with ghosts of the best run and latest visits of each stage shown (toggle with G)")
+    parser.add_argument("--ghost-attempts", type=non_negative_int, default=GHOST_ATTEMPTS, metavar="N",
+                        help="latest visits of each stage kept as ghosts, besides its best run (0 keeps only the best)")
+    parser.add_argument("--slot", type=int, choices=range(1, SAVE_SLOTS + 1), default=1, metavar="N",
+                        help="save slot selected on the title screen")
+    parser.add_argument("--campaign", metavar="PACK",
+                        help="play the stages of a level pack built with levelpack.py")
+    parser.add_argument("--watch-levels", action="store_true",
+                        help="rebuild the tiles of the current level that change whenever its file is saved")
+    parser.add_argument("--report-overruns", action="store_true",
+                        help="list the frames whose own work took longer than a frame when the game exits")
+    parser.add_argument("--memory-report", metavar="FILE",
+                        help="account for the memory held at every stage load and write it to FILE as JSON "
+                             "on exit or when M is pressed")
+    parser.add_argument("--memory-frames", type=int, default=MEMORY_PLAY_FRAMES, metavar="N",
+                        help="frames of play after each stage load that allocations are followed for")
+    parser.add_argument("--startup-report", metavar="FILE",
+                        help="quit once the title screen has been shown and write when each startup step "
+                             "finished to FILE as JSON (see startup.py)")
+    parser.add_argument("--audio-buffer", type=int, default=MIXER_BUFFER, metavar="SAMPLES",
+                        help="mixer buffer size, raise it if sound crackles")
+    return parser.parse_args(args)
+
+
+async def main():
+    startup = StartupReport()
+    options = parse_args(sys.argv[1:])
+    if options.trace:
+        tracer.start(options.trace_events)
+    memory = MemoryReport(options.memory_frames) if options.memory_report else None   # Traces from here on
+    pygame.mixer.pre_init(MIXER_FREQUENCY, -16, 2, options.audio_buffer)     # Must precede pygame.init
     pygame.init()
     pygame.mixer.init()
-    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                     pygame.HWSURFACE | pygame.DOUBLEBUF, vsync=1)    # | pygame.SCALED
-    bigscreen = False
-    pygame.display.set_caption("Lymynal Labrynthe")   # Assign name to window
-    game_icon = pygame.image.load("res/img/icon.png")
-    pygame.display.set_icon(game_icon)
+    startup.mark("pygame init")
+    display = open_display(options.renderer)
+    screen = display.screen                         # Fixed size frame, presented scaled to fit the window
+    display.set_caption("Lymynal Labrynthe")        # Assign name to window
+    game_icon = load_image("res/img/icon.png")
+    display.set_icon(game_icon)
+    startup.mark("display")
     clock = pygame.time.Clock()                     # Clock for syncing updates to frame rate
+    controls = InputSampler()                       # Input read right before each physics step
+    pacer = FramePacer(clock, FPS, options.low_latency)
+    latency = LatencyLog() if options.latency_log else None
+    watcher = LevelWatcher() if options.watch_levels else None
+    open_levels(options.campaign, loose=options.watch_levels)   # Edits go to the loose files, not the built pack
+    startup.mark("levels")
+    io = BackgroundIO(IO_THREADS)
+    io.submit(preload_images)
+    screenshot_requested = False
     stage_loaded = False                            # Defining bool to ensure stage is loaded
-    current_stage = 0                               # Defining int to keep track of current stage
+    current_stage = levels.start                    # Defining int to keep track of current stage
+    stage_info = None                               # Name and routing of the current stage
     player_deaths = 0                               # Defining int to keep track of player deaths
     coins = 0                                       # Defining int to keep track of collected coins
     total_jumps = 0
@@ -695,90 +2457,57 @@ def main():
     screenshot_num = 0
 
     player = Player(spawn.x, spawn.y)               # Spawn player
+    stage = None                                    # Currently loaded Stage, see get_stage
+    camera = Camera()                               # Viewport that scrolls over stages larger than the screen
 
-    sprites = pygame.sprite.Group()                 # Create group for all game objects
-    sprites.add(player)                             # Add player to master sprite group
-    obstacles = pygame.sprite.Group()               # Create group for decorative and platform objects
-    hazards = pygame.sprite.Group()                 # Create group for objects dangerous to player
-    stage_exit = pygame.sprite.Group()              # Create group for stage exit objects
-    collectibles = pygame.sprite.Group()            # Create group for collectible game objects
-    respawn_point = pygame.sprite.Group()           # Create group for respawn objects
-    spikes = pygame.sprite.Group()                  # Create group for spike objects
-    slow = pygame.sprite.Group()                    # Create group for objects that slow the player
-    decorative = pygame.sprite.Group()              # Create group for decorative objects
-    lockleafs = pygame.sprite.Group()
-    keys = pygame.sprite.Group()
-    skeys = pygame.sprite.Group()
-    sdoors = pygame.sprite.Group()
-    chests = pygame.sprite.Group()
-    returns = pygame.sprite.Group()
-    floats = pygame.sprite.Group()
-    rings = pygame.sprite.Group()
-    swords = pygame.sprite.Group()
-    fdoors = pygame.sprite.Group()
-
-    special_timer = 0
-    special_ticker = 1
-    special_timer2 = 0
-    special_ticker2 = 1
-
-    global has_sk1
-    global has_sk2
-    global has_ring
-    global has_sword
-    global has_xcancel
-    global returned
 
     font_color = WHITE
-    font = pygame.font.Font("res/misc/Bitmgothic.ttf", 24)
-
-    stage_names = load_names()
-
-    start_time = time()
-
-    ambient_fx = pygame.mixer.Sound("res/audio/background.ogg")
-    ambient_fx.set_volume(0.6)
-    title_fx = pygame.mixer.Sound("res/audio/title.wav")
-    title_fx.set_volume(0.8)
-    select_fx = pygame.mixer.Sound("res/audio/title2.wav")
-    select_fx.set_volume(0.8)
-    jump_fx = pygame.mixer.Sound("res/audio/jump.flac")
-    jump_fx.set_volume(0.2)
-    coin_fx = pygame.mixer.Sound("res/audio/coin.wav")
-    coin_fx.set_volume(0.4)
-    next_fx = pygame.mixer.Sound("res/audio/next.flac")
-    next_fx.set_volume(1.0)
-    death_fx = pygame.mixer.Sound("res/audio/death.wav")
-    death_fx.set_volume(0.4)
-    respawn_fx = pygame.mixer.Sound("res/audio/respawn.wav")
-    respawn_fx.set_volume(1.0)
-    chest_fx = pygame.mixer.Sound("res/audio/chest.wav")
-    chest_fx.set_volume(0.3)
-    skey1_fx = pygame.mixer.Sound("res/audio/specialkey1.wav")
-    skey1_fx.set_volume(0.3)
-    skey2_fx = pygame.mixer.Sound("res/audio/specialkey1.wav")
-    skey2_fx.set_volume(0.3)
-    sdoor_fx = pygame.mixer.Sound("res/audio/specialdoor.wav")
-    sdoor_fx.set_volume(0.2)
-    return_fx = pygame.mixer.Sound("res/audio/return.wav")
-    return_fx.set_volume(0.2)
-    open_fx = pygame.mixer.Sound("res/audio/open.wav")
-    open_fx.set_volume(0.2)
-    partial_fx = pygame.mixer.Sound("res/audio/partial.wav")
-    partial_fx.set_volume(0.2)
-    sbkgd1_fx = pygame.mixer.Sound("res/audio/sbkgd1.ogg")
-    sbkgd1_fx.set_volume(0.5)
-    sbkgd2_fx = pygame.mixer.Sound("res/audio/sbkgd2.ogg")
-    sbkgd2_fx.set_volume(0.6)
-    sbkgd3_fx = pygame.mixer.Sound("res/audio/sbkgd3.ogg")
-    sbkgd3_fx.set_volume(0.5)
-    ring_fx = pygame.mixer.Sound("res/audio/chest.wav")     # PUT A DIFFERENT SOUND HERE
-    ring_fx.set_volume(0.3)
-    sword_fx = pygame.mixer.Sound("res/audio/sword.wav")
-    sword_fx.set_volume(0.3)
+    font = pygame.font.Font(open_asset(FONT_FILE), 24)
+    text = TextRenderer(font, font_color)
+    small_font = pygame.font.Font(open_asset(FONT_FILE), HUD_FONT_SIZE)
+    small_text = TextRenderer(small_font, font_color)
+    # Drawn every frame, so its glyphs are fully opaque or fully transparent: the texture renderers can then
+    # blend it on the GPU without reading the frame back, and every renderer draws the same pixels
+    hud = Hud(TextRenderer(small_font, font_color, antialias=False))
+    show_hud = options.hud
+    startup.mark("fonts")
+
+    play_clock = PlayClock()                        # Total play time, paused while the window is in the background
+    focus = WindowFocus(play_clock, display)
+
+    audio = AudioEngine(MIXER_CHANNELS)
+    ambient_fx = audio.load("ambient", "res/audio/background.ogg", 0.6, "music")
+    title_fx = audio.load("title", "res/audio/title.wav", 0.8, "ui")
+    select_fx = audio.load("select", "res/audio/title2.wav", 0.8, "ui")
+    jump_fx = audio.load("jump", "res/audio/jump.flac", 0.2, "player")
+    coin_fx = audio.load("coin", "res/audio/coin.wav", 0.4, "pickup")
+    next_fx = audio.load("next", "res/audio/next.flac", 1.0, "ui")
+    death_fx = audio.load("death", "res/audio/death.wav", 0.4, "player")
+    respawn_fx = audio.load("respawn", "res/audio/respawn.wav", 1.0, "player")
+    chest_fx = audio.load("chest", "res/audio/chest.wav", 0.3, "pickup")
+    skey1_fx = audio.load("skey1", "res/audio/specialkey1.wav", 0.3, "pickup")
+    skey2_fx = audio.load("skey2", "res/audio/specialkey1.wav", 0.3, "pickup")
+    sdoor_fx = audio.load("sdoor", "res/audio/specialdoor.wav", 0.2, "world")
+    return_fx = audio.load("return", "res/audio/return.wav", 0.2, "world")
+    open_fx = audio.load("open", "res/audio/open.wav", 0.2, "world")
+    partial_fx = audio.load("partial", "res/audio/partial.wav", 0.2, "world")
+    audio.load("sbkgd1", "res/audio/sbkgd1.ogg", 0.5, "music")      # Stage music, played by the name a stage's
+    audio.load("sbkgd2", "res/audio/sbkgd2.ogg", 0.6, "music")      # campaign entry gives
+    audio.load("sbkgd3", "res/audio/sbkgd3.ogg", 0.5, "music")
+    ring_fx = audio.load("ring", "res/audio/chest.wav", 0.3, "pickup")     # PUT A DIFFERENT SOUND HERE
+    sword_fx = audio.load("sword", "res/audio/sword.wav", 0.3, "pickup")
+    startup.mark("sounds")
 
     title_fx.play()
 
+    title_image = load_image("res/img/title.bmp")
+    startup.mark("title image")
+    slot = options.slot
+    slot_saves = [read_slot(number, options.campaign) for number in range(1, SAVE_SLOTS + 1)]
+    startup.mark("saves")
+    slot_changed = True
+    resume = None                                   # Save the first stage is continued from
+
     title = True
     quit_from_title = False
     while title:
@@ -787,245 +2516,206 @@ def main():
                 title = False
                 quit_from_title = True
             if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN:
+                if event.key == pygame.K_RETURN:    # Continue the slot, or start it if it is empty
+                    resume = slot_saves[slot - 1]
+                    title = False
+                if event.key == pygame.K_n:         # Start over, the old save is replaced at the first stage
                     title = False
+                if pygame.K_1 <= event.key < pygame.K_1 + SAVE_SLOTS:
+                    slot = event.key - pygame.K_1 + 1
+                    slot_changed = True
                 if event.key == pygame.K_f:
-                    if bigscreen:
-                        bigscreen = False
-                        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                                         pygame.HWSURFACE | pygame.DOUBLEBUF, vsync=1)
-                    else:
-                        bigscreen = True
-                        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                                         pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.SCALED, vsync=1)
+                    display.next_mode()
                 if event.key == pygame.K_ESCAPE:
                     title = False
                     quit_from_title = True
-        title_image = pygame.image.load("res/img/title.bmp")
-        screen.blit(title_image, title_image.get_rect())
-        pygame.display.flip()
-
+            focus.handle(event)
+        if focus.paused:
+            await pacer.idle(PAUSED_FPS)
+            continue
+        if slot_changed:
+            save = slot_saves[slot - 1]
+            if save is None:
+                slot_text = text.render(f"Slot {slot}: new game")
+            else:
+                slot_text = text.render(f"Slot {slot}: {levels.info(save.stage)['name']}, "
+                                        f"{save.coins} coins, {playtime_text(save.play_time)}")
+                io.submit(prefetch_level, save.stage)   # Read the saved stage while the title is up
+            hint_text = small_text.render(f"1-{SAVE_SLOTS} slot, ENTER continue, N new game")
+            screen.blit(title_image, title_image.get_rect())
+            screen.blit(slot_text, slot_text.get_rect(center=(SCREEN_WIDTH / 2, 400)))
+            screen.blit(hint_text, hint_text.get_rect(center=(SCREEN_WIDTH / 2, 432)))
+            dirty = None                            # Whole frame is presented once, after that nothing changes
+            slot_changed = False
+        display.present(dirty)
+        if options.startup_report:                  # Only how long the title took to show up is wanted
+            startup.mark("first frame")
+            title = False
+            quit_from_title = True
+        dirty = []
+        await pacer.idle(FPS)
+
+    autosave = Autosaver(io, slot_path(slot, options.campaign))
+    ghosts = Ghosts(Autosaver(io, ghost_path(options.campaign), write_ghosts),
+                    read_ghost_file(ghost_path(options.campaign)), options.ghost_attempts)
+    ghost_image = load_image("res/img/player.bmp").copy()
+    ghost_image.set_colorkey(BLACK)                 # The player is drawn with its black background, ghosts are not
+    ghost_image.set_alpha(GHOST_ALPHA)
+    show_ghosts = options.ghosts
     select_fx.play()
     ambient_fx.play(-1)
+    if resume is not None:
+        current_stage = resume.stage
+        coins = resume.coins
+        player_deaths = resume.deaths
+        total_jumps = resume.jumps
+        game_state.restore({name: bool(resume.flags >> number & 1) for number, name in enumerate(GAME_FLAGS)})
+        play_clock.set_elapsed(resume.play_time)
+        resume_info = levels.info(resume.stage)
+        if resume_info["returns"]:                  # Special stages have their own music instead of the ambience
+            ambient_fx.stop()
+        elif any(levels.info(number)["final"] == resume.stage for number in levels.stages()):
+            ambient_fx.stop()
 
     GameOver = False
     running = True
     while running and not quit_from_title:
-        for event in pygame.event.get():
+        if focus.paused:                            # In the background: no simulation, no drawing, few wakeups
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                if event.type == pygame.KEYUP:      # Keys let go of in the background, e.g. ending a jump
+                    controls.defer(event)
+                focus.handle(event)
+            await pacer.idle(PAUSED_FPS)
+            if not focus.paused:
+                pacer.resync()
+            continue
+
+        frame_start = tracer.begin()
+        span = tracer.begin()
+        await pacer.wait(controls)                  # Low latency mode sleeps here instead of after the flip
+        tracer.end("wait", span)
+
+        if not stage_loaded:                        # Load stage if not loaded
+            tracer.instant("stage transition", {"stage": current_stage})
+            span = tracer.begin()
+            if memory:
+                memory.begin_load()
+            cache_hits = stage_cache.hits
+            next_stage = get_stage(current_stage, coins)
+            tracer.end("load stage", span, {"stage": current_stage})
+            if next_stage.game_over:
+                play_clock.stop()
+                GameOver = True
+                running = False
+            else:
+                stage = next_stage
+                stage_info = levels.info(current_stage)
+                display.set_caption(f"Lymynal Labrynthe - {stage_info['name']}")
+                if stage_info["music"] is not None:
+                    audio.play(stage_info["music"])
+                spawn = stage.spawn
+                if stage.respawn is not None:
+                    respawn = stage.respawn
+                if resume is not None:                  # Pick up where the save left off within the stage
+                    stage.restore_progress(resume.removed, resume.unlocked)
+                    spawn = vec(resume.spawn)
+                    resume = None
+                ghosts.enter(current_stage)
+
+                total_jumps += player.num_jumps
+                player.kill()                           # Remove current instance of player
+                player = Player(spawn.x, spawn.y, stage.bounds)     # Spawn new player at stage spawn location
+                stage.sprites.add(player)
+                stage_loaded = True                     # Confirm loading of stage
+                autosave.save(take_save(stage, coins, player_deaths, total_jumps, play_clock.elapsed(), spawn))
+                if memory:
+                    memory.stage_loaded(stage, stage_info["name"], stage_cache.hits > cache_hits, audio)
+                for route in ROUTES:                    # Read where this stage leads while it is being played
+                    if stage_info[route] is not None:
+                        io.submit(prefetch_level, stage_info[route])
+
+        if watcher:
+            span = tracer.begin()
+            old_spawn = stage.spawn
+            if watcher.poll(stage):                 # The player keeps its position, speed and everything collected
+                if spawn == old_spawn:
+                    spawn = stage.spawn
+                if stage.respawn is not None:
+                    respawn = stage.respawn
+                player.kill()                       # Drawn over the tiles that were just added
+                stage.sprites.add(player)
+            tracer.end("watch level", span)
+
+        span = tracer.begin()
+        events = controls.sample()
+        tracer.end("event pump", span)
+        for event in events:                        # Sample input as late as possible before the physics step
             if event.type == pygame.QUIT:           # Handle window exit gracefully
                 running = False
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_UP:        # Begin jump logic process
                     player.jump(jump_fx)
                 if event.key == pygame.K_s:
-                    pygame.image.save(screen, f"screenshot{screenshot_num}.jpeg")
-                    screenshot_num += 1
+                    screenshot_requested = True     # Saved once the current frame has been drawn
+                    tracer.instant("screenshot", {"number": screenshot_num})
                 if event.key == pygame.K_f:
-                    if bigscreen:
-                        bigscreen = False
-                        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                                         pygame.HWSURFACE | pygame.DOUBLEBUF, vsync=1)
-                    else:
-                        bigscreen = True
-                        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                                         pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.SCALED, vsync=1)
+                    display.next_mode()
+                if event.key == pygame.K_h:
+                    show_hud = not show_hud
+                if event.key == pygame.K_g:
+                    show_ghosts = not show_ghosts
+                if event.key == pygame.K_m and memory:
+                    tracer.instant("memory report", {"stage": current_stage})
+                    io.submit(write_text, options.memory_report, memory.dump("key", stage, stage_info["name"], audio))
                 if event.key == pygame.K_ESCAPE:
                     running = False
             if event.type == pygame.KEYUP:
                 if event.key == pygame.K_UP:        # End jump logic process
                     player.cancel_jump()
-
-        if not stage_loaded:                        # Load stage if not loaded
-            spawn = load_stage(f"res/levels/level{current_stage}.txt",
-                               TileArray, HazardArray, StageExitArray,
-                               CollectibleArray, RespawnPointArray,
-                               SpikeArray, SlowArray, DecorativeArray,
-                               LockArray, LockLeafArray, KeyArray,
-                               SpecialKeyArray, SecretDoorArray,
-                               TombstoneArray, ChestArray, ReturnArray,
-                               FloatArray, coins, current_stage, RingArray,
-                               SwordArray, FinalDoorArray)
-            if spawn == vec(-1, -1):
-                end_time = time()
-                GameOver = True
-                running = False
-            else:
-                pygame.display.set_caption(f"Lymynal Labrynthe - {stage_names[str(current_stage)]}")
-                if current_stage == 13:
-                    sbkgd2_fx.play()
-                sprites.empty()                         # Clear sprites, obstacles to make room for new stage
-                obstacles.empty()
-                for obj in TileArray:                   # Load new obstacles
-                    obstacles.add(obj)
-                    sprites.add(obj)
-                TileArray.clear()                       # Clear array used for loading obstacles for next cycle
-                hazards.empty()                         # Clear hazards
-                for obj in HazardArray:                 # Load new hazards
-                    hazards.add(obj)
-                    sprites.add(obj)
-                HazardArray.clear()                     # Clear array used for loading hazards for next cycle
-                stage_exit.empty()                         # Clear stage_exit
-                for obj in StageExitArray:                # Load new stage_exit objects
-                    stage_exit.add(obj)
-                    sprites.add(obj)
-                StageExitArray.clear()                  # Clear array used for loading stage exit for next cycle
-                collectibles.empty()                    # Clear collectibles
-                for obj in CollectibleArray:            # Load new collectibles
-                    collectibles.add(obj)
-                    sprites.add(obj)
-                CollectibleArray.clear()                # Clear array used for loading collectibles for next cycle
-                respawn_point.empty()
-                if RespawnPointArray:
-                    for obj in RespawnPointArray:       # Load stage respawn point if one exists
-                        respawn = vec(obj.rect.x + 8, obj.rect.y - 8)
-                        respawn_point.add(obj)
-                        sprites.add(obj)
-                    RespawnPointArray.clear()           # Clear array used for loading respawn points for next cycle
-                spikes.empty()
-                if SpikeArray:
-                    for obj in SpikeArray:
-                        spikes.add(obj)
-                        sprites.add(obj)
-                    SpikeArray.clear()
-                slow.empty()
-                if SlowArray:
-                    for obj in SlowArray:
-                        slow.add(obj)
-                        sprites.add(obj)
-                    SlowArray.clear()
-                decorative.empty()
-                if DecorativeArray:
-                    for obj in DecorativeArray:
-                        decorative.add(obj)
-                        sprites.add(obj)
-                    DecorativeArray.clear()
-                lockleafs.empty()
-                if LockArray:
-                    for obj in LockArray:
-                        lockleafs.add(obj)
-                        hazards.add(obj)
-                        sprites.add(obj)
-                    LockArray.clear()
-                if LockLeafArray:
-                    for obj in LockLeafArray:
-                        lockleafs.add(obj)
-                        hazards.add(obj)
-                        sprites.add(obj)
-                    LockLeafArray.clear()
-                keys.empty()
-                if KeyArray:
-                    for obj in KeyArray:
-                        keys.add(obj)
-                        sprites.add(obj)
-                    KeyArray.clear()
-                skeys.empty()
-                if SpecialKeyArray:
-                    for obj in SpecialKeyArray:
-                        skeys.add(obj)
-                        sprites.add(obj)
-                    SpecialKeyArray.clear()
-                sdoors.empty()
-                if SecretDoorArray:
-                    for obj in SecretDoorArray:
-                        sdoors.add(obj)
-                        sprites.add(obj)
-                    SecretDoorArray.clear()
-                if TombstoneArray:
-                    for obj in TombstoneArray:
-                        decorative.add(obj)
-                        sprites.add(obj)
-                    TombstoneArray.clear()
-                chests.empty()
-                if ChestArray:
-                    for obj in ChestArray:
-                        chests.add(obj)
-                        sprites.add(obj)
-                    ChestArray.clear()
-                returns.empty()
-                if ReturnArray:
-                    for obj in ReturnArray:
-                        returns.add(obj)
-                        sprites.add(obj)
-                    ReturnArray.clear()
-                floats.empty()
-                if FloatArray:
-                    for obj in FloatArray:
-                        floats.add(obj)
-                        obstacles.add(obj)
-                        sprites.add(obj)
-                    FloatArray.clear()
-                rings.empty()
-                if RingArray:
-                    for obj in RingArray:
-                        rings.add(obj)
-                        sprites.add(obj)
-                    RingArray.clear()
-                swords.empty()
-                if SwordArray:
-                    for obj in SwordArray:
-                        swords.add(obj)
-                        sprites.add(obj)
-                    SwordArray.clear()
-                fdoors.empty()
-                if FinalDoorArray:
-                    for obj in FinalDoorArray:
-                        fdoors.add(obj)
-                        sprites.add(obj)
-                    FinalDoorArray.clear()
-
-                total_jumps += player.num_jumps
-                player.kill()                           # Remove current instance of player
-                player = Player(spawn.x, spawn.y)       # Spawn new player at spawn location specified for new stage
-                sprites.add(player)
-                stage_loaded = True                     # Confirm loading of stage
-
-        pygame.event.pump()                         # Update current event log
-        if current_stage == 8:                          # Handle special stage bg and animation
-            special_image = pygame.image.load(f"res/img/special{special_ticker}.bmp")
-            special_timer += 1
-            if special_timer == 10:
-                special_timer = 0
-                special_ticker += 1
-                if special_ticker > 3: special_ticker = 1
-            screen.blit(special_image, special_image.get_rect())
-        elif current_stage == 17:
-            special_image2 = pygame.image.load(f"res/img/specialsecond{special_ticker}.bmp")
-            special_timer2 += 1
-            if special_timer2 == 10:
-                special_timer2 = 0
-                special_ticker2 += 1
-                if special_ticker2 > 3: special_ticker2 = 1
-            screen.blit(special_image2, special_image2.get_rect())
-        elif current_stage == 20:
-            special_image3 = pygame.image.load(f"res/img/win.bmp")
-            screen.blit(special_image3, special_image3.get_rect())
-
+            focus.handle(event)
+
+        span = tracer.begin()
+        background = stage_info["background"]
+        if background in ANIMATIONS:                    # Handle special stage bg and animation
+            background_image = animation_clock.image(background)
+            screen.blit(background_image, background_image.get_rect())
+        elif background is not None:
+            background_image = load_image(background)
+            screen.blit(background_image, background_image.get_rect())
         else:
             screen.fill(BLACK)                          # Fill window background with black
 
-        if returned:
-            returned = False
-
-        check = player.update(obstacles, hazards,   # Update player
-                              stage_exit, collectibles,
-                              respawn_point, spikes, slow,
-                              keys, skeys, sdoors, chests,
-                              returns, rings, swords, fdoors)
+        if game_state.returned:
+            game_state.set("returned", False)
+
+        tracer.end("background", span)
+
+        span = tracer.begin()
+        camera.follow(player.pos, stage.bounds)     # Instantiate chunks near the player before colliding
+        stage.stream(camera.rect)
+        tracer.end("stream", span)
+        span = tracer.begin()
+        check = player.update(stage.obstacles, stage.hazards,   # Update player
+                              stage.stage_exit, stage.collectibles,
+                              stage.respawn_point, stage.spikes, stage.slow,
+                              stage.keys, stage.skeys, stage.sdoors, stage.chests,
+                              stage.returns, stage.rings, stage.swords, stage.fdoors,
+                              controls.pressed)
+        tracer.end("Player.update", span)
         if check == 1:                              # Player death case
+            tracer.instant("death", {"stage": current_stage})
             total_jumps += player.num_jumps
             player.kill()
             player_deaths += 1
-            player = Player(spawn.x, spawn.y)
-            sprites.add(player)
+            player = Player(spawn.x, spawn.y, stage.bounds)
+            stage.sprites.add(player)
             death_fx.play()
-        if check == 2:                              # Player next stage case
+        if check == 2 and stage_info["exit"] is not None:      # Player next stage case
+            ghosts.leave(True)
             stage_loaded = False
-            if current_stage == 7:
-                current_stage = 9
-            elif current_stage == 16:
-                current_stage = 18
-            else:
-                current_stage += 1
+            current_stage = stage_info["exit"]
             next_fx.play()
         if check == 3:                              # Player collect coin case
             coins += 1
@@ -1033,6 +2723,8 @@ def main():
         if check == 4:
             spawn = respawn
             respawn_fx.play()
+            autosave.save(take_save(stage, coins, player_deaths, total_jumps + player.num_jumps,
+                                    play_clock.elapsed(), spawn))
         if check == 5:
             player.air = 0
             if player.vel.x > 2:
@@ -1044,112 +2736,104 @@ def main():
             elif player.vel.y < -5:
                 player.vel.y = -5
         if check == 6:
-            if not keys:
-                for leaf in lockleafs:
-                    leaf.kill()
+            if not stage.keys_remaining():
+                stage.unlock()
                 open_fx.play()
             else:
                 partial_fx.play()
         if check == 7:
-            if current_stage <= 6:
-                has_sk1 = True
-                skey1_fx.play()
-            else:
-                has_sk2 = True
-                skey2_fx.play()
+            skey_class = SPECIAL_KEY_SPRITES[stage_info["special_key"]][0]
+            game_state.set(skey_class.flag, True)
+            (skey1_fx if stage_info["special_key"] == 1 else skey2_fx).play()
         if check == 8:
-            has_xcancel = True
+            game_state.set("has_xcancel", True)
             chest_fx.play()
-        if check == 9:
-            if has_sk1:
+        if check == 9 and stage_info["door"] is not None:
+            sdoor_flag = SPECIAL_KEY_SPRITES[stage_info["special_key"]][0].flag    # Only the key this door shows
+            if getattr(game_state, sdoor_flag):
                 stage_loaded = False
-                current_stage = 8
+                current_stage = stage_info["door"]
                 sdoor_fx.play()
-                ambient_fx.stop()
-                sbkgd1_fx.play()
-            if has_sk2:
-                stage_loaded = False
-                current_stage = 17
-                sdoor_fx.play()
-                ambient_fx.stop()
-                sbkgd3_fx.play()
-        if check == 10:
-            if current_stage == 18:
-                stage_loaded = False
-                current_stage = 19
-                next_fx.play()
-                ambient_fx.stop()
-            if current_stage == 20:
-                stage_loaded = False
-                current_stage = 19
-                next_fx.play()
-                ambient_fx.stop()
-            else:
-                returned = True
-                stage_loaded = False
-                current_stage -= 1
-                has_sk1 = False
-                has_sk2 = False
+                ambient_fx.stop()                   # The special stage plays its own music once it loads
+        if check == 10 and stage_info["back"] is not None:
+            stage_loaded = False
+            current_stage = stage_info["back"]
+            if stage_info["returns"]:               # Back to the stage the secret door is in
+                game_state.set("returned", True)
+                game_state.set("has_sk1", False)
+                game_state.set("has_sk2", False)
                 return_fx.play()
-                sbkgd1_fx.stop()
-                sbkgd3_fx.stop()
+                if stage_info["music"] is not None:
+                    audio.stop(stage_info["music"])
                 ambient_fx.play(-1)
+            else:                                   # Return doors that end the game
+                next_fx.play()
+                ambient_fx.stop()
         if check == 11:
-            has_ring = True
+            game_state.set("has_ring", True)
             ring_fx.play()
         if check == 12:
-            has_sword = True
+            game_state.set("has_sword", True)
             sword_fx.play()
-        if check == 13:
-            if has_sword:
+        if check == 13 and stage_info["final"] is not None:
+            if game_state.has_sword:
                 stage_loaded = False
-                current_stage = 20
+                current_stage = stage_info["final"]
                 ambient_fx.stop()
 
 
-        for obj in sprites:                         # Render all game objects
-            obj.draw(screen)
-        for obj in hazards:                         # Handle hazard animations
-            obj.update()
-        for obj in collectibles:                    # Handle collectible animations
-            obj.update()
-        for obj in stage_exit:                      # Handle stage exit animations
-            obj.update()
-        if respawn_point:                           # Handle respawn point animations
-            for obj in respawn_point:
-                obj.update()
-        if spikes:                                   # handle spikeable tile animations
-            for obj in spikes:
-                obj.update()
-        if slow:                                    # Handle slowing tile animations
-            for obj in slow:
-                obj.update()
-        if decorative:
-            for obj in decorative:
+        ghosts.record(player.rect)
+
+        span = tracer.begin()
+        camera.follow(player.pos, stage.bounds)
+        stage.draw(screen, camera)                  # Render all game objects
+        if show_ghosts:
+            ghosts.draw(screen, camera.rect, ghost_image)
+        if show_hud:
+            hud.update(coins, player_deaths, total_jumps + player.num_jumps, play_clock.elapsed())
+            hud.draw(screen)
+        tracer.end("draw", span)
+        animation_clock.tick()                      # Every animation moves on by one frame
+        for name, span_name in UPDATE_GROUPS:       # Handle movement of each group
+            span = tracer.begin()
+            for obj in getattr(stage, name):
                 obj.update()
-        if keys:
-            for obj in keys:
-                obj.update()
-        if skeys:
-            for obj in skeys:
-                obj.update()
-        if sdoors:
-            for obj in sdoors:
-                obj.update()
-        if floats:
-            for obj in floats:
-                obj.update()
-        if rings:
-            for obj in rings:
-                obj.update()
-        if swords:
-            for obj in swords:
-                obj.update()
-        if fdoors:
-            for obj in fdoors:
-                obj.update()
-        pygame.display.flip()                       # Update window
-        clock.tick(FPS)                             # Sync main loop to specified FPS
+            tracer.end(span_name, span)
+        span = tracer.begin()
+        # Gameplay is always a full present: the stage layer is blitted whole every frame, coins, doors and
+        # enemies animate all over it and large stages scroll with the camera, so there is no smaller area to rescale
+        display.present()                           # Update window
+        tracer.end("flip", span)
+        span = tracer.begin()
+        present_time = await pacer.presented(controls)
+        tracer.end("tick", span)
+        if latency:
+            latency.record(controls, present_time)
+        if memory:
+            memory.frame()
+        if screenshot_requested:
+            io.submit(pygame.image.save, display.snapshot().copy(), f"screenshot{screenshot_num}.jpeg")
+            screenshot_num += 1
+            screenshot_requested = False
+        tracer.end("frame", frame_start)
+
+    if GameOver:
+        time_text = text.render(f"Total time: {playtime_text(play_clock.elapsed())}")
+        time_text_rect = time_text.get_rect(center=(SCREEN_WIDTH / 2, 96))
+        deaths_text = text.render(f"Deaths: {player_deaths}")
+        deaths_text_rect = deaths_text.get_rect(center=(SCREEN_WIDTH / 2, 192))
+        coins_text = text.render(f"Coins: {coins}")
+        coins_text_rect = coins_text.get_rect(center=(SCREEN_WIDTH / 2, 288))
+        jumps_text = text.render(f"Jumps: {total_jumps}")
+        jumps_text_rect = jumps_text.get_rect(center=(SCREEN_WIDTH / 2, 384))
+
+        score_image = load_image("res/img/score.bmp")
+        screen.blit(score_image, score_image.get_rect())
+        screen.blit(time_text, time_text_rect)
+        screen.blit(deaths_text, deaths_text_rect)
+        screen.blit(coins_text, coins_text_rect)
+        screen.blit(jumps_text, jumps_text_rect)
+    dirty = None                                    # Play time stopped at game over, so the results never change
 
     while GameOver:
         for event in pygame.event.get():
@@ -1159,38 +2843,34 @@ def main():
                 if event.key == pygame.K_RETURN:
                     GameOver = False
                 if event.key == pygame.K_s:
-                    pygame.image.save(screen, "score.jpeg")
+                    io.submit(pygame.image.save, display.snapshot().copy(), "score.jpeg")
                 if event.key == pygame.K_f:
-                    if bigscreen:
-                        bigscreen = False
-                        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                                         pygame.HWSURFACE | pygame.DOUBLEBUF, vsync=1)
-                    else:
-                        bigscreen = True
-                        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT),
-                                                         pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.SCALED, vsync=1)
+                    display.next_mode()
                 if event.key == pygame.K_ESCAPE:
                     GameOver = False
-
-        sec = timedelta(seconds=int(end_time - start_time))
-        d = datetime(1, 1, 1) + sec
-        time_text = font.render(f"Total time: %d:%d:%d" % (d.hour, d.minute, d.second), True, font_color)
-        time_text_rect = time_text.get_rect(center=(SCREEN_WIDTH / 2, 96))
-        deaths_text = font.render(f"Deaths: {player_deaths}", True, font_color)
-        deaths_text_rect = deaths_text.get_rect(center=(SCREEN_WIDTH / 2, 192))
-        coins_text = font.render(f"Coins: {coins}", True, font_color)
-        coins_text_rect = coins_text.get_rect(center=(SCREEN_WIDTH / 2, 288))
-        jumps_text = font.render(f"Jumps: {total_jumps}", True, font_color)
-        jumps_text_rect = jumps_text.get_rect(center=(SCREEN_WIDTH / 2, 384))
-
-        score_image = pygame.image.load("res/img/score.bmp")
-        screen.blit(score_image, score_image.get_rect())
-        screen.blit(time_text, time_text_rect)
-        screen.blit(deaths_text, deaths_text_rect)
-        screen.blit(coins_text, coins_text_rect)
-        screen.blit(jumps_text, jumps_text_rect)
-
-        pygame.display.flip()
+            focus.handle(event)
+        if focus.paused:
+            await pacer.idle(PAUSED_FPS)
+            continue
+
+        display.present(dirty)
+        dirty = []
+        await pacer.idle(FPS)
+
+    if options.trace:
+        io.submit(tracer.save, options.trace)
+    if latency:
+        io.submit(latency.save, options.latency_log)
+        print(latency.summary())
+    if options.report_overruns:
+        print(pacer.overrun_report())
+    ghosts.leave(False)                             # The visit quit from is kept too
+    if options.startup_report:
+        io.submit(write_text, options.startup_report, startup.dump())
+    if memory and stage:
+        memory.end_play()
+        io.submit(write_text, options.memory_report, memory.dump("exit", stage, stage_info["name"], audio))
+    await io.drain()
 
     pygame.display.quit()                           # More graceful exit handling
     pygame.mixer.quit()
@@ -1199,4 +2879,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())                         # Also how browser hosts expect to be handed the game loop
@@ -0,0 +1,88 @@
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+# Define save file layout
+SAVE_MAGIC = b"LLSV"
+SAVE_VERSION = 1
+SAVE_HEADER = struct.Struct("<4sHHII")      # Magic, version, reserved, body size, body crc32
+SAVE_BODY = struct.Struct("<iiiidHHiiI")    # Stage, coins, deaths, jumps, play seconds, game flags, save flags,
+                                            # spawn x, spawn y (a respawn point once one is reached), removed count
+SAVE_REMOVED = struct.Struct("<iiB")        # Tile x, tile y, size of the sprite kind that follows
+SAVE_FOLDER = "saves"
+SAVE_SLOTS = 3
+
+# Define save flags
+UNLOCKED = 1                                # Every key in the saved stage was collected
+
+# Progress at one moment of play, nothing in it can change once it has been taken
+SaveGame = namedtuple("SaveGame", ("stage", "coins", "deaths", "jumps", "play_time", "flags",
+                                   "spawn", "unlocked", "removed"))
+
+
+class SaveError(Exception):
+    pass
+
+
+def campaign_prefix(campaign):
+    # Each campaign keeps its own files, stage numbers mean nothing in another one
+    return f"{os.path.splitext(os.path.basename(campaign))[0]}-" if campaign else ""
+
+
+def slot_path(slot, campaign=None, folder=SAVE_FOLDER):
+    return f"{folder}/{campaign_prefix(campaign)}slot{slot}.sav"
+
+
+def encode(save):
+    body = bytearray(SAVE_BODY.pack(save.stage, save.coins, save.deaths, save.jumps, save.play_time, save.flags,
+                                    UNLOCKED if save.unlocked else 0, *save.spawn, len(save.removed)))
+    for kind, x, y in save.removed:         # Sprites collected or destroyed in the saved stage
+        name = kind.encode()
+        body += SAVE_REMOVED.pack(x, y, len(name)) + name
+    return SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, 0, len(body), zlib.crc32(body)) + body
+
+
+def decode(data, filename):
+    if len(data) < SAVE_HEADER.size:
+        raise SaveError(f"{filename} is too small to be a save")
+    magic, version, _, size, crc = SAVE_HEADER.unpack_from(data, 0)
+    if magic != SAVE_MAGIC:
+        raise SaveError(f"{filename} is not a save")
+    if version != SAVE_VERSION:
+        raise SaveError(f"{filename} is save version {version}, expected {SAVE_VERSION}")
+    body = memoryview(data)[SAVE_HEADER.size:SAVE_HEADER.size + size]
+    if len(body) != size or zlib.crc32(body) != crc:
+        raise SaveError(f"{filename} is corrupt")
+    stage, coins, deaths, jumps, play_time, flags, save_flags, spawn_x, spawn_y, count = SAVE_BODY.unpack_from(body, 0)
+    removed = []
+    offset = SAVE_BODY.size
+    for _ in range(count):
+        x, y, name_size = SAVE_REMOVED.unpack_from(body, offset)
+        offset += SAVE_REMOVED.size
+        removed.append((str(body[offset:offset + name_size], "utf-8"), x, y))
+        offset += name_size
+    return SaveGame(stage, coins, deaths, jumps, play_time, flags, (spawn_x, spawn_y),
+                    bool(save_flags & UNLOCKED), tuple(removed))
+
+
+def read_save(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as file:
+        return decode(file.read(), filename)
+
+
+def write_atomic(filename, data):
+    # Written next to the file and swapped in, so a crash mid write leaves the previous one intact
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    temp = filename + ".tmp"
+    with open(temp, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, filename)
+
+
+def write_save(filename, save):
+    write_atomic(filename, encode(save))
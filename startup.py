@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+from importlib import metadata, util
+
+# Define benchmark values
+RUNS = 5                                    # Launches measured per file cache condition
+IMPORTS_LISTED = 10                         # Slowest top level imports printed per condition
+REGRESSION_PERCENT = 10                     # Slower to the title than the baseline by more than this fails
+OUTPUT_PATH = "startup.json"
+CONDITIONS = ("cold", "warm")
+
+# Define phases, the game marks when each of its own steps ended (see StartupReport in main.py)
+LAUNCH_PHASE = "interpreter and imports"    # Process start until main() is entered
+EXIT_PHASE = "exit"                         # First title frame until the process is gone
+TITLE = "to title"                          # Process start until the first title frame
+
+
+def game_folder():
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def cached_folders():
+    # Everything a launch reads: the game, pygame with the libraries it ships and the standard library
+    pygame = os.path.dirname(util.find_spec("pygame").origin)     # Found without importing it
+    folders = [game_folder(), pygame]
+    folders += [os.path.join(os.path.dirname(pygame), name)
+                for name in ("pygame.libs", "pygame-" + metadata.version("pygame") + ".dist-info")]
+    folders += [sysconfig.get_paths()["stdlib"], sysconfig.get_paths()["platstdlib"]]
+    return sorted(set(folder for folder in folders if os.path.isdir(folder)))
+
+
+def evict(folders, drop_caches):
+    # Push the files a launch reads out of the OS file cache, so the next launch reads them from disk
+    os.sync()
+    if drop_caches:
+        with open("/proc/sys/vm/drop_caches", 'w') as file:
+            file.write("3\n")                   # Every clean page of every file, needs root
+        return
+    files = [os.path.realpath(sys.executable)]
+    for folder in folders:
+        for root, _, names in os.walk(folder):
+            files += [os.path.join(root, name) for name in names]
+    for filename in files:
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def parse_imports(stderr):
+    # -X importtime lines: "import time: self [us] | cumulative | imported package", each nested import two
+    # spaces further in
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports[name.strip()] = {"self_ms": int(own) / 1000, "cumulative_ms": int(cumulative) / 1000,
+                                 "depth": depth}
+    return imports
+
+
+def launch(game_args):
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    with tempfile.TemporaryDirectory() as folder:
+        report = os.path.join(folder, "startup.json")
+        started = time.time()
+        result = subprocess.run([sys.executable, "-X", "importtime", "main.py", "--startup-report", report,
+                                 *game_args], cwd=game_folder(), env=env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True)
+        ended = time.time()
+        if result.returncode != 0 or not os.path.exists(report):
+            errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+            raise RuntimeError(f"the game exited with {result.returncode} before showing the title:\n"
+                               + "\n".join(errors[-20:]))
+        with open(report, 'r') as file:
+            marks = json.load(file)["marks"]
+    phases = {LAUNCH_PHASE: (marks[0][1] - started) * 1000}
+    for (_, before), (name, at) in zip(marks, marks[1:]):
+        phases[name] = (at - before) * 1000
+    phases[EXIT_PHASE] = (ended - marks[-1][1]) * 1000
+    return {"phases": phases, TITLE: (marks[-1][1] - started) * 1000, "imports": parse_imports(result.stderr)}
+
+
+def spread(values):
+    return {"median": statistics.median(values), "min": min(values), "max": max(values)}
+
+
+def summarize(runs):
+    phases = {name: spread([run["phases"][name] for run in runs]) for name in runs[0]["phases"]}
+    imports = {}
+    for name, first in runs[0]["imports"].items():
+        timed = [run["imports"][name] for run in runs if name in run["imports"]]
+        imports[name] = {"self_ms": statistics.median(entry["self_ms"] for entry in timed),
+                         "cumulative_ms": statistics.median(entry["cumulative_ms"] for entry in timed),
+                         "depth": first["depth"]}
+    return {"runs": len(runs), TITLE: spread([run[TITLE] for run in runs]), "phases": phases,
+            "imports": dict(sorted(imports.items(), key=lambda entry: -entry[1]["cumulative_ms"])),
+            "launches": [run[TITLE] for run in runs]}
+
+
+def benchmark(conditions, runs, game_args, drop_caches):
+    results = {}
+    folders = cached_folders()
+    for condition in conditions:
+        if condition == "warm":
+            launch(game_args)                   # Fills the file cache, not measured
+        measured = []
+        for _ in range(runs):
+            if condition == "cold":
+                evict(folders, drop_caches)
+            measured.append(launch(game_args))
+        results[condition] = summarize(measured)
+    return results
+
+
+def print_results(results):
+    for condition, result in results.items():
+        print(f"{condition} ({result['runs']} launches): {result[TITLE]['median']:.0f} ms to the title screen "
+              f"(min {result[TITLE]['min']:.0f}, max {result[TITLE]['max']:.0f})")
+        for name, timing in result["phases"].items():
+            print(f"  {name:<24} {timing['median']:8.1f} ms")
+        top = [(name, entry) for name, entry in result["imports"].items() if entry["depth"] == 0]
+        print("  slowest imports: " + ", ".join(f"{name} {entry['cumulative_ms']:.1f} ms"
+                                               for name, entry in top[:IMPORTS_LISTED]))
+
+
+def compare(results, baseline, threshold):
+    # Median time to the title and per phase against a baseline run, fails when the title got slower than allowed
+    ok = True
+    for condition, result in results.items():
+        before = baseline["conditions"].get(condition)
+        if before is None:
+            continue
+        print(f"{condition} against the baseline:")
+        for name, timing in [(TITLE, result[TITLE])] + list(result["phases"].items()):
+            old = before[TITLE] if name == TITLE else before["phases"].get(name)
+            if old is None:
+                print(f"  {name:<24} {timing['median']:8.1f} ms (new)")
+                continue
+            change = (timing["median"] - old["median"]) / old["median"] * 100 if old["median"] else 0
+            print(f"  {name:<24} {old['median']:8.1f} -> {timing['median']:8.1f} ms ({change:+.1f}%)")
+            if name == TITLE and change > threshold:
+                print(f"  {condition} start is {change:.1f}% slower, more than the {threshold}% allowed")
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch the game headless until its title screen shows, with "
+                                                 "cold and warm file caches, and time every startup step and import")
+    parser.add_argument("game_args", nargs="*", help="arguments passed on to main.py, after --")
+    parser.add_argument("--runs", type=int, default=RUNS, help="launches measured per condition")
+    parser.add_argument("--condition", choices=CONDITIONS, action="append",
+                        help="file cache condition to measure, can be given twice (default: both)")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="empty the whole OS file cache before cold launches instead of only the files a "
+                             "launch reads (Linux, needs root)")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="JSON file the results are written to")
+    parser.add_argument("--baseline", metavar="FILE", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_PERCENT,
+                        help="percent slower to the title than the baseline that fails the comparison")
+    options = parser.parse_args()
+
+    conditions = options.condition or list(CONDITIONS)
+    if "cold" in conditions and not options.drop_caches and not hasattr(os, "posix_fadvise"):
+        print("cold launches need posix_fadvise or --drop-caches, measuring warm launches only")
+        conditions = [condition for condition in conditions if condition != "cold"]
+    results = {"python": platform.python_version(), "pygame": metadata.version("pygame"),
+               "platform": platform.platform(), "game_args": options.game_args,
+               "conditions": benchmark(conditions, max(1, options.runs), options.game_args, options.drop_caches)}
+    with open(options.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    print_results(results["conditions"])
+    if options.baseline:
+        with open(options.baseline, 'r') as file:
+            baseline = json.load(file)
+        sys.exit(0 if compare(results["conditions"], baseline, options.threshold) else 1)
+
+
+if __name__ == "__main__":
+    main()